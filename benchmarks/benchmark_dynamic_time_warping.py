@@ -0,0 +1,46 @@
+"""
+Cells per second of the DTW recurrence (dynamic_time_warping._make_dtw_matrix)
+against the previous np.array / np.argmax kernel kept in tests/test_dynamic_time_warping.py
+
+Run from the repository root:
+    python benchmarks/benchmark_dynamic_time_warping.py [sizes ...]
+"""
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from caretta import dynamic_time_warping as dtw
+from tests.test_dynamic_time_warping import reference_make_dtw_matrix
+
+
+def cells_per_second(kernel, score_matrix, repeats=5):
+    """
+    Best of repeats runs of kernel(score_matrix, 1.0, 0.01), in DTW cells per second
+    """
+    kernel(score_matrix[:2, :2], 1.0, 0.01)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        kernel(score_matrix, 1.0, 0.01)
+        times.append(time.perf_counter() - start)
+    return score_matrix.size / min(times)
+
+
+def main(sizes):
+    rng = np.random.default_rng(0)
+    print(f"{'n x n':>8} {'reference':>18} {'_make_dtw_matrix':>18} {'speedup':>8}")
+    for n in sizes:
+        score_matrix = rng.random((n, n))
+        reference = cells_per_second(reference_make_dtw_matrix, score_matrix)
+        current = cells_per_second(dtw._make_dtw_matrix, score_matrix)
+        print(
+            f"{n:>8} {reference / 1e6:>12.1f} M/s {current / 1e6:>12.1f} M/s {current / reference:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [500, 1000, 2000])
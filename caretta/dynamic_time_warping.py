@@ -1,5 +1,6 @@
 import numba as nb
 import numpy as np
+from caretta import score_functions
 
 MIN_FLOAT64 = np.finfo(np.float64).min
 
@@ -12,6 +13,7 @@ def _make_dtw_matrix(
 ):
     """
     Make cost matrix using dynamic time warping
+    (each cell with _dtw_cell, without temporary arrays)
 
     Parameters
     ----------
@@ -24,16 +26,16 @@ def _make_dtw_matrix(
 
     Returns
     -------
-    accumulated cost matrix; shape = (n, m)
+    accumulated cost matrix (in the precision of score_matrix), backtrack (int8); shape = (n + 1, m + 1, 3)
     """
     gap_open_penalty *= -1
     gap_extend_penalty *= -1
     n, m = score_matrix.shape
-    matrix = np.zeros((n + 1, m + 1, 3), dtype=np.float64)
+    matrix = np.zeros((n + 1, m + 1, 3), dtype=score_matrix.dtype)
     matrix[:, 0, :] = MIN_FLOAT64
     matrix[0, :, :] = MIN_FLOAT64
     matrix[0, 0] = 0
-    backtrack = np.zeros((n + 1, m + 1, 3), dtype=np.int64)
+    backtrack = np.zeros((n + 1, m + 1, 3), dtype=np.int8)
     for i in range(1, n + 1):
         matrix[i, 0, 0] = 0
         matrix[i, 0, 1] = 0
@@ -48,36 +50,23 @@ def _make_dtw_matrix(
 
     for i in range(1, n + 1):
         for j in range(1, m + 1):
-            scores_lower = np.array(
-                [
-                    matrix[i - 1, j, 0] + gap_extend_penalty,
-                    matrix[i - 1, j, 1] + gap_open_penalty,
-                ]
+            (
+                matrix[i, j, 0],
+                backtrack[i, j, 0],
+                matrix[i, j, 1],
+                backtrack[i, j, 1],
+                matrix[i, j, 2],
+                backtrack[i, j, 2],
+            ) = _dtw_cell(
+                matrix[i - 1, j, 0],
+                matrix[i - 1, j, 1],
+                matrix[i - 1, j - 1, 1],
+                matrix[i, j - 1, 1],
+                matrix[i, j - 1, 2],
+                score_matrix[i - 1, j - 1],
+                gap_open_penalty,
+                gap_extend_penalty,
             )
-            index_lower = np.argmax(scores_lower)
-            matrix[i, j, 0] = scores_lower[index_lower]
-            backtrack[i, j, 0] = index_lower
-
-            scores_upper = np.array(
-                [
-                    matrix[i, j - 1, 1] + gap_open_penalty,
-                    matrix[i, j - 1, 2] + gap_extend_penalty,
-                ]
-            )
-            index_upper = np.argmax(scores_upper)
-            matrix[i, j, 2] = scores_upper[index_upper]
-            backtrack[i, j, 2] = index_upper + 1
-
-            scores = np.array(
-                [
-                    matrix[i, j, 0],
-                    matrix[i - 1, j - 1, 1] + score_matrix[i - 1, j - 1],
-                    matrix[i, j, 2],
-                ]
-            )
-            index = np.argmax(scores)
-            matrix[i, j, 1] = scores[index]
-            backtrack[i, j, 1] = index
     return matrix, backtrack
 
 
@@ -169,3 +158,964 @@ def dtw_align(
     index = np.argmax(scores)
     aln_1, aln_2 = _get_dtw_alignment(index, backtrack, n, m)
     return aln_1, aln_2, scores[index]
+
+
+@nb.njit
+def _dtw_cell(
+    lower_0,
+    lower_1,
+    diagonal_1,
+    upper_1,
+    upper_2,
+    score,
+    gap_open_penalty,
+    gap_extend_penalty,
+):
+    """
+    One cell of the DTW recurrence, using scalar comparisons only
+    (ties go to the lowest index, like np.argmax)
+
+    Parameters
+    ----------
+    lower_0, lower_1
+        channels 0 and 1 of cell (i - 1, j)
+    diagonal_1
+        channel 1 of cell (i - 1, j - 1)
+    upper_1, upper_2
+        channels 1 and 2 of cell (i, j - 1)
+    score
+        score of aligning i - 1 with j - 1
+    gap_open_penalty
+        already negated
+    gap_extend_penalty
+        already negated
+
+    Returns
+    -------
+    value_0, direction_0, value_1, direction_1, value_2, direction_2
+    """
+    value_0 = lower_0 + gap_extend_penalty
+    direction_0 = 0
+    if lower_1 + gap_open_penalty > value_0:
+        value_0 = lower_1 + gap_open_penalty
+        direction_0 = 1
+
+    value_2 = upper_1 + gap_open_penalty
+    direction_2 = 1
+    if upper_2 + gap_extend_penalty > value_2:
+        value_2 = upper_2 + gap_extend_penalty
+        direction_2 = 2
+
+    value_1 = value_0
+    direction_1 = 0
+    if diagonal_1 + score > value_1:
+        value_1 = diagonal_1 + score
+        direction_1 = 1
+    if value_2 > value_1:
+        value_1 = value_2
+        direction_1 = 2
+    return value_0, direction_0, value_1, direction_1, value_2, direction_2
+
+
+@nb.njit
+def get_diagonal_band(n, m):
+    """
+    Band seed following the diagonal of an (n + 1) x (m + 1) DTW matrix
+
+    Returns
+    -------
+    lower, upper; seed column of each DTW row, shape = (n + 1,)
+    """
+    lower = np.zeros(n + 1, dtype=np.int64)
+    for i in range(n + 1):
+        lower[i] = (2 * i * m + n) // (2 * n)
+    return lower, lower.copy()
+
+
+@nb.njit
+def get_path_band(aln_1, aln_2, n):
+    """
+    Band seed following a previous warping path (as returned by dtw_align) over the same two objects
+
+    Returns
+    -------
+    lower, upper; first and last column the path visits in each DTW row, shape = (n + 1,)
+    """
+    lower = np.full(n + 1, -1, dtype=np.int64)
+    upper = np.zeros(n + 1, dtype=np.int64)
+    lower[0] = 0
+    i, j = 0, 0
+    for k in range(aln_1.shape[0]):
+        if aln_1[k] != -1:
+            i += 1
+        if aln_2[k] != -1:
+            j += 1
+        if lower[i] == -1:
+            lower[i] = j
+        upper[i] = j
+    return lower, upper
+
+
+@nb.njit
+def get_coarse_path_band(aln_1, aln_2, n, m, factor):
+    """
+    Band seed following a warping path between the two objects downsampled by factor
+    (segments of factor consecutive points each), projected back to full resolution
+
+    Returns
+    -------
+    lower, upper; first and last column the projected path may visit in each DTW row, shape = (n + 1,)
+    """
+    lower_coarse, upper_coarse = get_path_band(aln_1, aln_2, (n + factor - 1) // factor)
+    lower = np.zeros(n + 1, dtype=np.int64)
+    upper = np.zeros(n + 1, dtype=np.int64)
+    for i in range(n + 1):
+        # segment of the last point of row i
+        i_coarse = (i + factor - 1) // factor
+        lower[i] = max(0, (lower_coarse[i_coarse] - 1) * factor)
+        upper[i] = min(m, upper_coarse[i_coarse] * factor)
+    return lower, upper
+
+
+@nb.njit
+def make_band(lower: np.ndarray, upper: np.ndarray, band_width: int, m: int):
+    """
+    Widens a band seed by band_width columns on either side and makes it a valid DTW band
+    (starts at (0, 0), ends at (n, m), bounds never decrease and consecutive rows overlap)
+
+    Parameters
+    ----------
+    lower
+        seed start column of each DTW row
+    upper
+        seed end column of each DTW row
+    band_width
+    m
+        length of second sequence
+
+    Returns
+    -------
+    lo, hi; first and last DTW column of each row (inclusive)
+    offsets; position of each row in flat band storage
+    """
+    n = lower.shape[0] - 1
+    lo = np.zeros(n + 1, dtype=np.int64)
+    hi = np.zeros(n + 1, dtype=np.int64)
+    for i in range(n + 1):
+        lo[i] = max(0, lower[i] - band_width)
+        hi[i] = min(m, upper[i] + band_width)
+    lo[0] = 0
+    hi[n] = m
+    for i in range(1, n + 1):
+        lo[i] = min(max(lo[i], lo[i - 1]), hi[i - 1] + 1)
+        hi[i] = max(hi[i], hi[i - 1], lo[i])
+    offsets = np.zeros(n + 2, dtype=np.int64)
+    for i in range(n + 1):
+        offsets[i + 1] = offsets[i] + hi[i] - lo[i] + 1
+    return lo, hi, offsets
+
+
+@nb.njit
+def get_band_scores(
+    score_matrix: np.ndarray, lo: np.ndarray, hi: np.ndarray, offsets: np.ndarray
+) -> np.ndarray:
+    """
+    Flat band storage of the scores in score_matrix that fall inside a band made by make_band
+    """
+    band_scores = np.zeros(offsets[-1], dtype=score_matrix.dtype)
+    for i in range(1, lo.shape[0]):
+        for j in range(max(lo[i], 1), hi[i] + 1):
+            band_scores[offsets[i] + j - lo[i]] = score_matrix[i - 1, j - 1]
+    return band_scores
+
+
+@nb.njit
+def _make_banded_dtw_matrix(
+    band_scores: np.ndarray,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    offsets: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+):
+    """
+    Same as _make_dtw_matrix but only fills cells inside a band made by make_band
+    Cells outside the band count as unreachable
+
+    Returns
+    -------
+    accumulated cost matrix, backtrack; flat band storage, shape = (offsets[-1], 3)
+    """
+    gap_open_penalty *= -1
+    gap_extend_penalty *= -1
+    n = lo.shape[0] - 1
+    matrix = np.zeros((offsets[-1], 3), dtype=band_scores.dtype)
+    backtrack = np.zeros((offsets[-1], 3), dtype=np.int8)
+    for j in range(1, hi[0] + 1):
+        matrix[j, 0] = MIN_FLOAT64 - gap_open_penalty
+        backtrack[j] = 1
+
+    for i in range(1, n + 1):
+        for j in range(lo[i], hi[i] + 1):
+            k = offsets[i] + j - lo[i]
+            if j == 0:
+                matrix[k, 2] = MIN_FLOAT64 - gap_open_penalty
+                continue
+            lower_0 = lower_1 = diagonal_1 = upper_1 = upper_2 = MIN_FLOAT64
+            if lo[i - 1] <= j <= hi[i - 1]:
+                k_lower = offsets[i - 1] + j - lo[i - 1]
+                lower_0, lower_1 = matrix[k_lower, 0], matrix[k_lower, 1]
+            if lo[i - 1] <= j - 1 <= hi[i - 1]:
+                diagonal_1 = matrix[offsets[i - 1] + j - 1 - lo[i - 1], 1]
+            if j - 1 >= lo[i]:
+                upper_1, upper_2 = matrix[k - 1, 1], matrix[k - 1, 2]
+            (
+                matrix[k, 0],
+                backtrack[k, 0],
+                matrix[k, 1],
+                backtrack[k, 1],
+                matrix[k, 2],
+                backtrack[k, 2],
+            ) = _dtw_cell(
+                lower_0,
+                lower_1,
+                diagonal_1,
+                upper_1,
+                upper_2,
+                band_scores[k],
+                gap_open_penalty,
+                gap_extend_penalty,
+            )
+    return matrix, backtrack
+
+
+@nb.njit
+def _get_banded_dtw_alignment(
+    start_direction, backtrack: np.ndarray, lo: np.ndarray, offsets: np.ndarray, n1, m1
+):
+    """
+    Same as _get_dtw_alignment for a backtrack matrix in flat band storage
+    """
+    indices_1 = np.zeros(n1 + m1 + 1, dtype=np.int64)
+    indices_2 = np.zeros(n1 + m1 + 1, dtype=np.int64)
+    index = 0
+    n, m = n1, m1
+    direction = start_direction
+    while not (n == 0 and m == 0):
+        if m == 0:
+            n -= 1
+            indices_1[index] = n
+            indices_2[index] = -1
+            index += 1
+        elif n == 0:
+            m -= 1
+            indices_1[index] = -1
+            indices_2[index] = m
+            index += 1
+        else:
+            k = offsets[n] + m - lo[n]
+            if direction == 0:
+                direction = backtrack[k, 0]
+                n -= 1
+                indices_1[index] = n
+                indices_2[index] = -1
+                index += 1
+            elif direction == 1:
+                direction = backtrack[k, 1]
+                if direction == 1:
+                    n -= 1
+                    m -= 1
+                    indices_1[index] = n
+                    indices_2[index] = m
+                    index += 1
+            elif direction == 2:
+                direction = backtrack[k, 2]
+                m -= 1
+                indices_1[index] = -1
+                indices_2[index] = m
+                index += 1
+    return indices_1[:index][::-1], indices_2[:index][::-1]
+
+
+@nb.njit
+def touches_band_edge(aln_1, aln_2, lo: np.ndarray, hi: np.ndarray, m: int) -> bool:
+    """
+    True if a warping path runs along an inner edge of its band,
+    i.e. a wider band could have given a better path
+    """
+    i, j = 0, 0
+    for k in range(aln_1.shape[0]):
+        if aln_1[k] != -1:
+            i += 1
+        if aln_2[k] != -1:
+            j += 1
+        if (j == lo[i] and lo[i] > 0) or (j == hi[i] and hi[i] < m):
+            return True
+    return False
+
+
+@nb.njit
+def dtw_align_band(
+    band_scores: np.ndarray,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    offsets: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+):
+    """
+    Align two objects using dynamic time warping restricted to a band
+
+    Parameters
+    ----------
+    band_scores
+        scores in flat band storage (see get_band_scores)
+    lo, hi, offsets
+        band made by make_band
+    gap_open_penalty
+    gap_extend_penalty
+
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    matrix, backtrack = _make_banded_dtw_matrix(
+        band_scores, lo, hi, offsets, gap_open_penalty, gap_extend_penalty
+    )
+    n = lo.shape[0] - 1
+    m = hi[n]
+    k = offsets[n] + m - lo[n]
+    scores = np.array([matrix[k, 0], matrix[k, 1], matrix[k, 2]])
+    index = np.argmax(scores)
+    aln_1, aln_2 = _get_banded_dtw_alignment(index, backtrack, lo, offsets, n, m)
+    return aln_1, aln_2, scores[index]
+
+
+@nb.njit
+def _get_score_matrix_band(score_matrix, _, gamma, lo, hi, offsets):
+    """
+    Band function for a precomputed score matrix
+    """
+    return get_band_scores(score_matrix, lo, hi, offsets)
+
+
+@nb.njit
+def dtw_align_in_band(
+    objects_1,
+    objects_2,
+    band_function,
+    gamma,
+    n: int,
+    m: int,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    band_width: int,
+):
+    """
+    DTW alignment restricted to a band around a seed (get_diagonal_band or get_path_band),
+    doubling the band width until the warping path no longer touches its edges.
+    Scores inside the band are made by band_function(objects_1, objects_2, gamma, lo, hi, offsets) -> band_scores
+
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    band_width = max(band_width, 1)
+    while True:
+        lo, hi, offsets = make_band(lower, upper, band_width, m)
+        aln_1, aln_2, score = dtw_align_band(
+            band_function(objects_1, objects_2, gamma, lo, hi, offsets),
+            lo,
+            hi,
+            offsets,
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+        if band_width >= max(n, m) or not touches_band_edge(aln_1, aln_2, lo, hi, m):
+            return aln_1, aln_2, score
+        band_width *= 2
+
+
+@nb.njit
+def dtw_align_banded(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    band_width: int,
+):
+    """
+    Align two objects using dynamic time warping restricted to a band around a seed
+    (get_diagonal_band or get_path_band).
+    The band is doubled in width until the warping path no longer touches its edges.
+
+    Parameters
+    ----------
+    score_matrix
+        (n x m) matrix of scores between all points of both objects
+    gap_open_penalty
+    gap_extend_penalty
+    lower, upper
+        band seed
+    band_width
+        initial number of columns on either side of the seed
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    return dtw_align_in_band(
+        score_matrix,
+        score_matrix,
+        _get_score_matrix_band,
+        0.0,
+        score_matrix.shape[0],
+        score_matrix.shape[1],
+        gap_open_penalty,
+        gap_extend_penalty,
+        lower,
+        upper,
+        band_width,
+    )
+
+
+@nb.njit
+def _make_dtw_row(
+    row_scores: np.ndarray,
+    previous_row: np.ndarray,
+    row: np.ndarray,
+    backtrack_row: np.ndarray,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+):
+    """
+    Fills a row of the accumulated cost matrix (and its backtrack) from the previous row,
+    for the first row.shape[0] columns
+
+    Parameters
+    ----------
+    row_scores
+        scores of this row's point against each point of the second object
+    previous_row
+    row
+    backtrack_row
+    gap_open_penalty
+        already negated
+    gap_extend_penalty
+        already negated
+    """
+    row[0, 0] = 0
+    row[0, 1] = 0
+    row[0, 2] = MIN_FLOAT64 - gap_open_penalty
+    backtrack_row[0] = 0
+    # in the precision of row, so that float32 rows are filled without conversions
+    penalties = np.array([gap_open_penalty, gap_extend_penalty]).astype(row.dtype)
+    for j in range(1, row.shape[0]):
+        (
+            row[j, 0],
+            backtrack_row[j, 0],
+            row[j, 1],
+            backtrack_row[j, 1],
+            row[j, 2],
+            backtrack_row[j, 2],
+        ) = _dtw_cell(
+            previous_row[j, 0],
+            previous_row[j, 1],
+            previous_row[j - 1, 1],
+            row[j - 1, 1],
+            row[j - 1, 2],
+            row_scores[j - 1],
+            penalties[0],
+            penalties[1],
+        )
+
+
+@nb.njit
+def _get_score_matrix_row(score_matrix, _, i, gamma, row_scores):
+    """
+    Row function for a precomputed score matrix
+    """
+    return score_matrix[i]
+
+
+@nb.njit
+def _make_first_row(m, gap_open_penalty, dtype=np.float64):
+    """
+    Row 0 of the accumulated cost matrix (gap_open_penalty already negated)
+    """
+    row = np.zeros((m + 1, 3), dtype=dtype)
+    for j in range(1, m + 1):
+        row[j, 0] = MIN_FLOAT64 - gap_open_penalty
+    return row
+
+
+@nb.njit
+def dtw_align_rows(
+    objects_1,
+    objects_2,
+    row_function,
+    gamma,
+    n: int,
+    m: int,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    dtype=np.float64,
+):
+    """
+    Same as dtw_align, with scores made one row at a time by
+    row_function(objects_1, objects_2, i, gamma, row_scores) -> scores of point i of the first object.
+    Only two rows of the accumulated cost matrix are kept, the backtrack is stored as int8.
+    Scores and accumulated costs are stored as dtype (np.float32 halves the memory traffic)
+    """
+    gap_open_penalty *= -1
+    gap_extend_penalty *= -1
+    previous_row = _make_first_row(m, gap_open_penalty, dtype)
+    row = np.zeros((m + 1, 3), dtype=dtype)
+    row_scores = np.zeros(m, dtype=dtype)
+    backtrack = np.zeros((n + 1, m + 1, 3), dtype=np.int8)
+    for i in range(1, n + 1):
+        _make_dtw_row(
+            row_function(objects_1, objects_2, i - 1, gamma, row_scores),
+            previous_row,
+            row,
+            backtrack[i],
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+        previous_row, row = row, previous_row
+    scores = np.array([previous_row[m, 0], previous_row[m, 1], previous_row[m, 2]])
+    index = np.argmax(scores)
+    aln_1, aln_2 = _get_dtw_alignment(index, backtrack, n, m)
+    return aln_1, aln_2, scores[index]
+
+
+@nb.njit(nogil=True)
+def dtw_align_coordinates(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    gamma: float,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+):
+    """
+    Same as dtw_align on make_score_matrix(coords_1, coords_2, get_caretta_score, gamma),
+    computing the scores inside the DTW recurrence instead of storing the score matrix
+    (in the precision of coords_1)
+
+    Parameters
+    ----------
+    coords_1
+        shape = (n, d)
+    coords_2
+        shape = (m, d)
+    gamma
+    gap_open_penalty
+    gap_extend_penalty
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    return dtw_align_rows(
+        coords_1,
+        coords_2,
+        score_functions.make_caretta_score_row,
+        gamma,
+        coords_1.shape[0],
+        coords_2.shape[0],
+        gap_open_penalty,
+        gap_extend_penalty,
+        coords_1.dtype,
+    )
+
+
+@nb.njit
+def dtw_align_low_memory_rows(
+    objects_1,
+    objects_2,
+    row_function,
+    gamma,
+    n: int,
+    m: int,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    block_size: int,
+    dtype=np.float64,
+):
+    """
+    dtw_align_low_memory with scores made one row at a time by row_function (see dtw_align_rows)
+    """
+    if block_size <= 0:
+        block_size = max(1, int(np.sqrt(n)))
+    gap_open_penalty *= -1
+    gap_extend_penalty *= -1
+    num_blocks = (n + block_size - 1) // block_size
+    checkpoints = np.zeros((num_blocks, m + 1, 3), dtype=dtype)
+    checkpoints[0] = _make_first_row(m, gap_open_penalty, dtype)
+    previous_row = checkpoints[0].copy()
+    row = np.zeros((m + 1, 3), dtype=dtype)
+    row_scores = np.zeros(m, dtype=dtype)
+    backtrack = np.zeros((block_size, m + 1, 3), dtype=np.int8)
+    for i in range(1, n + 1):
+        _make_dtw_row(
+            row_function(objects_1, objects_2, i - 1, gamma, row_scores),
+            previous_row,
+            row,
+            backtrack[0],
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+        previous_row, row = row, previous_row
+        if i % block_size == 0 and i // block_size < num_blocks:
+            checkpoints[i // block_size] = previous_row
+    scores = np.array([previous_row[m, 0], previous_row[m, 1], previous_row[m, 2]])
+    direction = np.argmax(scores)
+    score = scores[direction]
+
+    indices_1 = np.zeros(n + m + 1, dtype=np.int64)
+    indices_2 = np.zeros(n + m + 1, dtype=np.int64)
+    index = 0
+    n1, m1 = n, m
+    block = -1
+    while not (n1 == 0 and m1 == 0):
+        if m1 == 0:
+            n1 -= 1
+            indices_1[index] = n1
+            indices_2[index] = -1
+            index += 1
+            continue
+        elif n1 == 0:
+            m1 -= 1
+            indices_1[index] = -1
+            indices_2[index] = m1
+            index += 1
+            continue
+        if (n1 - 1) // block_size != block:
+            # recompute the rows of this block, only up to the current column
+            block = (n1 - 1) // block_size
+            previous_row[: m1 + 1] = checkpoints[block, : m1 + 1]
+            for i in range(block * block_size + 1, min(n, (block + 1) * block_size) + 1):
+                _make_dtw_row(
+                    row_function(objects_1, objects_2, i - 1, gamma, row_scores),
+                    previous_row[: m1 + 1],
+                    row[: m1 + 1],
+                    backtrack[i - block * block_size - 1, : m1 + 1],
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                )
+                previous_row, row = row, previous_row
+        k = n1 - block * block_size - 1
+        if direction == 0:
+            direction = backtrack[k, m1, 0]
+            n1 -= 1
+            indices_1[index] = n1
+            indices_2[index] = -1
+            index += 1
+        elif direction == 1:
+            direction = backtrack[k, m1, 1]
+            if direction == 1:
+                n1 -= 1
+                m1 -= 1
+                indices_1[index] = n1
+                indices_2[index] = m1
+                index += 1
+        elif direction == 2:
+            direction = backtrack[k, m1, 2]
+            m1 -= 1
+            indices_1[index] = -1
+            indices_2[index] = m1
+            index += 1
+    return indices_1[:index][::-1], indices_2[:index][::-1], score
+
+
+@nb.njit
+def dtw_align_low_memory(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+    block_size: int = 0,
+):
+    """
+    Same result as dtw_align, without storing the full accumulated cost and backtrack matrices.
+    The (n x m) score_matrix itself is still needed.
+
+    The forward pass keeps only every block_size-th row as a checkpoint;
+    the traceback recomputes one block of rows at a time from its checkpoint.
+    Memory on top of score_matrix is O(m * (n / block_size + block_size)) instead of O(n * m),
+    for about twice the work.
+
+    Parameters
+    ----------
+    score_matrix
+        (n x m) matrix of scores between all points of both objects
+    gap_open_penalty
+        penalty for opening a (series of) gap(s)
+    gap_extend_penalty
+        penalty for extending an existing series of gaps
+    block_size
+        rows between checkpoints, 0 => sqrt(n)
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    return dtw_align_low_memory_rows(
+        score_matrix,
+        score_matrix,
+        _get_score_matrix_row,
+        0.0,
+        score_matrix.shape[0],
+        score_matrix.shape[1],
+        gap_open_penalty,
+        gap_extend_penalty,
+        block_size,
+        score_matrix.dtype,
+    )
+
+
+@nb.njit(nogil=True)
+def dtw_align_low_memory_coordinates(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    gamma: float,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+    block_size: int = 0,
+):
+    """
+    dtw_align_low_memory with caretta scores computed inside the DTW recurrence (see dtw_align_coordinates),
+    so neither the score matrix nor the DTW matrices are stored
+    """
+    return dtw_align_low_memory_rows(
+        coords_1,
+        coords_2,
+        score_functions.make_caretta_score_row,
+        gamma,
+        coords_1.shape[0],
+        coords_2.shape[0],
+        gap_open_penalty,
+        gap_extend_penalty,
+        block_size,
+        coords_1.dtype,
+    )
+
+
+@nb.njit
+def dtw_score_rows(
+    objects_1,
+    objects_2,
+    row_function,
+    gamma,
+    n: int,
+    m: int,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    dtype=np.float64,
+) -> float:
+    """
+    dtw_score with scores made one row at a time by row_function (see dtw_align_rows)
+    """
+    gap_open_penalty *= -1
+    gap_extend_penalty *= -1
+    previous_row = _make_first_row(m, gap_open_penalty, dtype)
+    row = np.zeros((m + 1, 3), dtype=dtype)
+    row_scores = np.zeros(m, dtype=dtype)
+    backtrack_row = np.zeros((m + 1, 3), dtype=np.int8)
+    for i in range(1, n + 1):
+        _make_dtw_row(
+            row_function(objects_1, objects_2, i - 1, gamma, row_scores),
+            previous_row,
+            row,
+            backtrack_row,
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+        previous_row, row = row, previous_row
+    return max(previous_row[m, 0], previous_row[m, 1], previous_row[m, 2])
+
+
+@nb.njit
+def dtw_score(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+) -> float:
+    """
+    Score of the optimal DTW alignment (same as the score returned by dtw_align),
+    keeping only two rows of the accumulated cost matrix and no backtrack
+
+    Parameters
+    ----------
+    score_matrix
+        (n x m) matrix of scores between all points of both objects
+    gap_open_penalty
+        penalty for opening a (series of) gap(s)
+    gap_extend_penalty
+        penalty for extending an existing series of gaps
+    Returns
+    -------
+    score
+    """
+    return dtw_score_rows(
+        score_matrix,
+        score_matrix,
+        _get_score_matrix_row,
+        0.0,
+        score_matrix.shape[0],
+        score_matrix.shape[1],
+        gap_open_penalty,
+        gap_extend_penalty,
+        score_matrix.dtype,
+    )
+
+
+@nb.njit
+def dtw_score_coordinates(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    gamma: float,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+) -> float:
+    """
+    dtw_score with caretta scores computed inside the DTW recurrence (see dtw_align_coordinates)
+    """
+    return dtw_score_rows(
+        coords_1,
+        coords_2,
+        score_functions.make_caretta_score_row,
+        gamma,
+        coords_1.shape[0],
+        coords_2.shape[0],
+        gap_open_penalty,
+        gap_extend_penalty,
+        coords_1.dtype,
+    )
+
+
+@nb.njit(parallel=True)
+def _make_wavefront_backtrack(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    tile_size: int,
+):
+    """
+    Backtrack matrix of _make_dtw_matrix (as int8), filled in tiles of tile_size x tile_size cells.
+    Tiles on an anti-diagonal of tiles only depend on tiles of earlier anti-diagonals, so they are filled in parallel.
+    Of the accumulated cost matrix, only the last row of each tile row and the last column of each tile column are kept.
+
+    Parameters
+    ----------
+    score_matrix
+    gap_open_penalty
+        already negated
+    gap_extend_penalty
+        already negated
+    tile_size
+
+    Returns
+    -------
+    backtrack, channels of the last cell
+    """
+    n, m = score_matrix.shape
+    n_tiles_1 = (n + tile_size - 1) // tile_size
+    n_tiles_2 = (m + tile_size - 1) // tile_size
+    # row_edges[a] = row a * tile_size, column_edges[b] = column b * tile_size
+    row_edges = np.zeros((n_tiles_1 + 1, m + 1, 3), dtype=score_matrix.dtype)
+    column_edges = np.zeros((n_tiles_2 + 1, n + 1, 3), dtype=score_matrix.dtype)
+    row_edges[0] = _make_first_row(m, gap_open_penalty, score_matrix.dtype)
+    for a in range(1, n_tiles_1 + 1):
+        row_edges[a, 0, 2] = MIN_FLOAT64 - gap_open_penalty
+    for i in range(1, n + 1):
+        column_edges[0, i, 2] = MIN_FLOAT64 - gap_open_penalty
+    backtrack = np.zeros((n + 1, m + 1, 3), dtype=np.int8)
+    backtrack[0, 1:] = 1
+    penalties = np.array([gap_open_penalty, gap_extend_penalty]).astype(
+        score_matrix.dtype
+    )
+    for d in range(n_tiles_1 + n_tiles_2 - 1):
+        for a in nb.prange(max(0, d - n_tiles_2 + 1), min(n_tiles_1, d + 1)):
+            b = d - a
+            start_1, end_1 = a * tile_size + 1, min(n, (a + 1) * tile_size)
+            start_2, end_2 = b * tile_size + 1, min(m, (b + 1) * tile_size)
+            rows = np.zeros((2, end_2 - start_2 + 2, 3), dtype=score_matrix.dtype)
+            rows[0] = row_edges[a, start_2 - 1 : end_2 + 1]
+            for i in range(start_1, end_1 + 1):
+                previous_row = rows[(i - start_1) % 2]
+                row = rows[(i - start_1 + 1) % 2]
+                row[0] = column_edges[b, i]
+                backtrack_row = backtrack[i, start_2 - 1 : end_2 + 1]
+                row_scores = score_matrix[i - 1, start_2 - 1 : end_2]
+                for j in range(1, row.shape[0]):
+                    (
+                        row[j, 0],
+                        backtrack_row[j, 0],
+                        row[j, 1],
+                        backtrack_row[j, 1],
+                        row[j, 2],
+                        backtrack_row[j, 2],
+                    ) = _dtw_cell(
+                        previous_row[j, 0],
+                        previous_row[j, 1],
+                        previous_row[j - 1, 1],
+                        row[j - 1, 1],
+                        row[j - 1, 2],
+                        row_scores[j - 1],
+                        penalties[0],
+                        penalties[1],
+                    )
+                column_edges[b + 1, i] = row[-1]
+            row_edges[a + 1, start_2 : end_2 + 1] = rows[(end_1 - start_1 + 1) % 2, 1:]
+    return backtrack, row_edges[n_tiles_1, m].copy()
+
+
+@nb.njit
+def dtw_align_wavefront(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+    tile_size: int = 256,
+):
+    """
+    Same as dtw_align, with the DTW matrix filled by anti-diagonals of tiles in parallel
+    (threads set with numba.set_num_threads)
+
+    Parameters
+    ----------
+    score_matrix
+        (n x m) matrix of scores between all points of both objects
+    gap_open_penalty
+    gap_extend_penalty
+    tile_size
+        number of rows and columns in a tile
+    Returns
+    -------
+    aligned_indices_1, aligned_indices_2, score
+    """
+    n, m = score_matrix.shape
+    backtrack, scores = _make_wavefront_backtrack(
+        score_matrix, -gap_open_penalty, -gap_extend_penalty, tile_size
+    )
+    index = np.argmax(scores)
+    aln_1, aln_2 = _get_dtw_alignment(index, backtrack, n, m)
+    return aln_1, aln_2, scores[index]
+
+
+@nb.njit
+def dtw_align_parallel_coordinates(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    gamma: float,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+):
+    """
+    Same as dtw_align_coordinates, with the score matrix made by row blocks in parallel
+    and the DTW matrix filled by anti-diagonals of tiles in parallel (stores the (n x m) score matrix)
+    """
+    return dtw_align_wavefront(
+        score_functions.make_caretta_score_matrix_parallel(coords_1, coords_2, gamma),
+        gap_open_penalty,
+        gap_extend_penalty,
+    )
@@ -0,0 +1,355 @@
+import heapq
+
+import numba as nb
+import numpy as np
+
+
+# Guide trees for large numbers of structures, without an all vs. all distance matrix.
+# Each structure is linked to its k nearest neighbours in embedding space
+# (exactly for small sets, with NN-descent otherwise), and clusters are merged bottom-up
+# using only the distances in this graph (single or average linkage).
+# Memory scales with n * k, as does time for NN-descent.
+# The tree is returned in the same format as neighbor_joining.neighbor_joining.
+
+METRICS = ("braycurtis", "euclidean", "cosine")
+LINKAGES = ("average", "single")
+
+
+@nb.njit(nogil=True)
+def _get_distance(vector_1, vector_2, metric):
+    """
+    Distance between two vectors
+
+    Parameters
+    ----------
+    vector_1
+    vector_2
+    metric
+        0 = braycurtis, 1 = euclidean, 2 = cosine (as in METRICS)
+
+    Returns
+    -------
+    distance
+    """
+    if metric == 0:
+        numerator = denominator = 0.0
+        for x in range(vector_1.shape[0]):
+            numerator += abs(vector_1[x] - vector_2[x])
+            denominator += abs(vector_1[x] + vector_2[x])
+        if denominator == 0.0:
+            return 0.0
+        return numerator / denominator
+    elif metric == 1:
+        distance = 0.0
+        for x in range(vector_1.shape[0]):
+            distance += (vector_1[x] - vector_2[x]) ** 2
+        return np.sqrt(distance)
+    else:
+        dot = norm_1 = norm_2 = 0.0
+        for x in range(vector_1.shape[0]):
+            dot += vector_1[x] * vector_2[x]
+            norm_1 += vector_1[x] ** 2
+            norm_2 += vector_2[x] ** 2
+        if norm_1 == 0.0 or norm_2 == 0.0:
+            return 0.0
+        return 1.0 - dot / np.sqrt(norm_1 * norm_2)
+
+
+@nb.njit(nogil=True)
+def _push_neighbour(neighbours, distances, i, j, distance):
+    """
+    Adds j to the neighbours of i (sorted by increasing distance) if it is closer than the furthest one
+
+    Returns
+    -------
+    True if j was added
+    """
+    k = neighbours.shape[1]
+    if distance >= distances[i, k - 1]:
+        return False
+    for x in range(k):
+        if neighbours[i, x] == j:
+            return False
+    x = k - 1
+    while x > 0 and distances[i, x - 1] > distance:
+        neighbours[i, x] = neighbours[i, x - 1]
+        distances[i, x] = distances[i, x - 1]
+        x -= 1
+    neighbours[i, x] = j
+    distances[i, x] = distance
+    return True
+
+
+@nb.njit(parallel=True)
+def get_nearest_neighbours_exact(embedding, k, metric):
+    """
+    k nearest neighbours of each row of embedding, comparing all pairs
+
+    Parameters
+    ----------
+    embedding
+        [n x d]
+    k
+    metric
+        index in METRICS
+
+    Returns
+    -------
+    neighbours [n x k] (-1 if missing), distances [n x k] (inf if missing), sorted by distance
+    """
+    n = embedding.shape[0]
+    neighbours = np.full((n, k), -1, dtype=np.int64)
+    distances = np.full((n, k), np.inf)
+    for i in nb.prange(n):
+        for j in range(n):
+            if j != i:
+                _push_neighbour(
+                    neighbours,
+                    distances,
+                    i,
+                    j,
+                    _get_distance(embedding[i], embedding[j], metric),
+                )
+    return neighbours, distances
+
+
+@nb.njit(parallel=True)
+def get_nearest_neighbours_descent(embedding, k, metric, n_iter=10, delta=0.001, seed=42):
+    """
+    Approximate k nearest neighbours of each row of embedding with NN-descent
+    (neighbours of neighbours are likely to be neighbours)
+
+    Parameters
+    ----------
+    embedding
+        [n x d]
+    k
+    metric
+        index in METRICS
+    n_iter
+        maximum number of iterations
+    delta
+        stops when fewer than delta * n * k neighbours change in an iteration
+    seed
+        for the random initial neighbours
+
+    Returns
+    -------
+    neighbours [n x k], distances [n x k], sorted by distance
+    """
+    n = embedding.shape[0]
+    neighbours = np.full((n, k), -1, dtype=np.int64)
+    distances = np.full((n, k), np.inf)
+    np.random.seed(seed)
+    for i in range(n):
+        while neighbours[i, k - 1] == -1:
+            j = np.random.randint(n)
+            if j != i:
+                _push_neighbour(
+                    neighbours,
+                    distances,
+                    i,
+                    j,
+                    _get_distance(embedding[i], embedding[j], metric),
+                )
+    reverse_neighbours = np.full((n, k), -1, dtype=np.int64)
+    reverse_lengths = np.zeros(n, dtype=np.int64)
+    num_updates = np.zeros(n, dtype=np.int64)
+    for _ in range(n_iter):
+        # neighbours of the previous iteration are read, new ones are written
+        previous_neighbours = neighbours.copy()
+        reverse_lengths[:] = 0
+        for i in range(n):
+            for x in range(k):
+                j = previous_neighbours[i, x]
+                if reverse_lengths[j] < k:
+                    reverse_neighbours[j, reverse_lengths[j]] = i
+                    reverse_lengths[j] += 1
+        for i in nb.prange(n):
+            num_updates[i] = 0
+            for x in range(2 * k):
+                if x < k:
+                    j = previous_neighbours[i, x]
+                elif x - k < reverse_lengths[i]:
+                    j = reverse_neighbours[i, x - k]
+                else:
+                    break
+                candidates = (previous_neighbours[j], reverse_neighbours[j, : reverse_lengths[j]])
+                for c in range(2):
+                    for candidate in candidates[c]:
+                        if candidate != i:
+                            num_updates[i] += _push_neighbour(
+                                neighbours,
+                                distances,
+                                i,
+                                candidate,
+                                _get_distance(embedding[i], embedding[candidate], metric),
+                            )
+                if x >= k:
+                    num_updates[i] += _push_neighbour(
+                        neighbours,
+                        distances,
+                        i,
+                        j,
+                        _get_distance(embedding[i], embedding[j], metric),
+                    )
+        if np.sum(num_updates) < delta * n * k:
+            break
+    return neighbours, distances
+
+
+def get_nearest_neighbours(
+    embedding: np.ndarray,
+    k: int = 10,
+    metric: str = "braycurtis",
+    exact_limit: int = 4096,
+):
+    """
+    k nearest neighbours of each row of embedding
+
+    Parameters
+    ----------
+    embedding
+        [n x d]
+    k
+    metric
+        one of METRICS
+    exact_limit
+        compares all pairs below this many rows, uses NN-descent otherwise
+
+    Returns
+    -------
+    neighbours [n x k], distances [n x k], sorted by distance
+    """
+    if metric not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}, got {metric}")
+    embedding = np.ascontiguousarray(embedding, dtype=np.float64)
+    k = max(1, min(k, embedding.shape[0] - 1))
+    if embedding.shape[0] <= exact_limit:
+        return get_nearest_neighbours_exact(embedding, k, METRICS.index(metric))
+    return get_nearest_neighbours_descent(embedding, k, METRICS.index(metric))
+
+
+def knn_linkage(
+    embedding: np.ndarray,
+    k: int = 10,
+    metric: str = "braycurtis",
+    linkage: str = "average",
+    exact_limit: int = 4096,
+) -> (np.ndarray, np.ndarray):
+    """
+    Makes a guide tree by merging clusters joined by the shortest edges of a k nearest neighbour graph
+    Clusters no longer joined by any edge are linked by the distances between their mean embeddings
+
+    Parameters
+    ----------
+    embedding
+        [n x d] (n >= 3)
+    k
+        number of nearest neighbours of each row
+    metric
+        one of METRICS
+    linkage
+        "average" => distance between clusters is the mean of the graph distances between them
+        "single" => distance between clusters is the shortest graph distance between them (minimum spanning tree)
+    exact_limit
+        compares all pairs below this many rows, uses NN-descent otherwise
+
+    Returns
+    -------
+    tree (node_1, node_2) pairs
+    branch_lengths corresponding to each tree pair
+    (same format as neighbor_joining.neighbor_joining)
+    """
+    if linkage not in LINKAGES:
+        raise ValueError(f"linkage must be one of {LINKAGES}, got {linkage}")
+    length = embedding.shape[0]
+    assert length >= 3
+    neighbours, distances = get_nearest_neighbours(embedding, k, metric, exact_limit)
+
+    # edges[node] = {other node: (sum of distances, number of distances, minimum distance)}
+    edges = [dict() for _ in range(length)]
+    for i in range(length):
+        for j, distance in zip(neighbours[i], distances[i]):
+            if j != -1 and j not in edges[i]:
+                edges[i][j] = edges[j][i] = (distance, 1, distance)
+    heap = []
+
+    def get_cluster_distance(edge):
+        return edge[0] / edge[1] if linkage == "average" else edge[2]
+
+    for i in range(length):
+        for j, edge in edges[i].items():
+            if i < j:
+                heap.append((get_cluster_distance(edge), i, j))
+    heapq.heapify(heap)
+
+    members = [[i] for i in range(length)]
+    heights = np.zeros(2 * length - 1)
+    alive = np.zeros(2 * length - 1, dtype=bool)
+    alive[:length] = True
+    tree = np.zeros((2 * length - 3, 2), dtype=np.uint64)
+    branch_lengths = np.zeros((2 * length - 3, 1), dtype=np.float64)
+    index = 0
+    node = length
+    while node < 2 * length - 1:
+        if not heap:
+            # link the remaining clusters by the distances between their mean embeddings
+            roots = np.where(alive)[0]
+            means = np.array(
+                [embedding[members[r]].mean(axis=0) for r in roots], dtype=np.float64
+            )
+            for x in range(roots.shape[0]):
+                for y in range(x + 1, roots.shape[0]):
+                    distance = _get_distance(means[x], means[y], METRICS.index(metric))
+                    edges[roots[x]][roots[y]] = edges[roots[y]][roots[x]] = (
+                        distance * len(members[roots[x]]) * len(members[roots[y]]),
+                        len(members[roots[x]]) * len(members[roots[y]]),
+                        distance,
+                    )
+                    heap.append(
+                        (get_cluster_distance(edges[roots[x]][roots[y]]), roots[x], roots[y])
+                    )
+            heapq.heapify(heap)
+        distance, i, j = heapq.heappop(heap)
+        if not (alive[i] and alive[j]):
+            continue
+        heights[node] = max(distance / 2, heights[i], heights[j])
+        if node < 2 * length - 2:
+            for child in (i, j):
+                tree[index] = child, node
+                branch_lengths[index] = heights[node] - heights[child]
+                index += 1
+        else:
+            # last merge joins the two remaining clusters
+            tree[index] = i, j
+            branch_lengths[index] = distance
+            index += 1
+        alive[i] = alive[j] = False
+        alive[node] = True
+        # the smaller cluster is moved into the larger one, so each structure is moved O(log n) times
+        larger, smaller = (i, j) if len(members[i]) >= len(members[j]) else (j, i)
+        members[larger].extend(members[smaller])
+        members.append(members[larger])
+        members[i] = members[j] = None
+        edges.append(dict())
+        for child in (i, j):
+            for other, (sum_distance, count, min_distance) in edges[child].items():
+                if other == i or other == j:
+                    continue
+                if other in edges[node]:
+                    sum_0, count_0, min_0 = edges[node][other]
+                    edges[node][other] = (
+                        sum_0 + sum_distance,
+                        count_0 + count,
+                        min(min_0, min_distance),
+                    )
+                else:
+                    edges[node][other] = (sum_distance, count, min_distance)
+                del edges[other][child]
+            edges[child] = None
+        for other, edge in edges[node].items():
+            edges[other][node] = edge
+            heapq.heappush(heap, (get_cluster_distance(edge), other, node))
+        node += 1
+    return tree[:index], branch_lengths[:index]
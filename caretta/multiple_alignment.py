@@ -1,17 +1,20 @@
 import pickle
+import threading
 import typing
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, replace
 from pathlib import Path
 
 import numba as nb
 import numpy as np
 import prody as pd
 import typer
-from geometricus import Structure, MomentInvariants, SplitType, GeometricusEmbedding
-from scipy.spatial.distance import pdist, squareform
+from geometricus import Structure, GeometricusEmbedding
+from scipy.spatial.distance import cdist
 
 from caretta import (
     dynamic_time_warping as dtw,
+    guide_tree as gt,
     neighbor_joining as nj,
     score_functions,
     superposition_functions,
@@ -34,6 +37,80 @@ def tm_score(coords_1, coords_2, l1, l2):
     return max(t1, t2)
 
 
+@nb.njit(parallel=True)
+def get_rmsd_coverage_tm_matrices(coords, offsets, alignment_matrix, superpose):
+    """
+    RMSD, coverage and TM-score of the alignment of each pair of structures, pairs computed in parallel
+    Same as score_functions.get_rmsd, coverage and tm_score on get_common_coordinates of each pair,
+    with the distances of aligned positions computed once
+
+    Parameters
+    ----------
+    coords
+        coordinates of all structures, concatenated
+        structure i is coords[offsets[i] : offsets[i + 1]]
+    offsets
+    alignment_matrix
+        [num_structures x alignment length] indices of aligning residues with gaps as -1s
+    superpose
+        if True, aligned positions of each pair are superposed (superposition_functions.paired_svd_superpose) first
+
+    Returns
+    -------
+    RMSD matrix, coverage matrix, TM-score matrix (nan on the diagonal and for pairs without aligned positions)
+    """
+    num = alignment_matrix.shape[0]
+    rmsd_matrix = np.full((num, num), np.nan)
+    coverage_matrix = np.full((num, num), np.nan)
+    tm_matrix = np.full((num, num), np.nan)
+    num_pairs = num * (num - 1) // 2
+    for k in nb.prange(num_pairs):
+        # k-th pair (i, j) with i < j
+        i = int(num - 2 - np.floor(np.sqrt(-8 * k + 4 * num * (num - 1) - 7) / 2.0 - 0.5))
+        j = int(k + i + 1 - num * (num - 1) // 2 + (num - i) * ((num - i) - 1) // 2)
+        num_common = 0
+        for x in range(alignment_matrix.shape[1]):
+            if alignment_matrix[i, x] != -1 and alignment_matrix[j, x] != -1:
+                num_common += 1
+        if num_common == 0:
+            continue
+        common_coords_1 = np.zeros((num_common, coords.shape[1]))
+        common_coords_2 = np.zeros((num_common, coords.shape[1]))
+        c = 0
+        for x in range(alignment_matrix.shape[1]):
+            if alignment_matrix[i, x] != -1 and alignment_matrix[j, x] != -1:
+                common_coords_1[c] = coords[offsets[i] + alignment_matrix[i, x]]
+                common_coords_2[c] = coords[offsets[j] + alignment_matrix[j, x]]
+                c += 1
+        if superpose:
+            rot, tran = superposition_functions.paired_svd_superpose(
+                common_coords_1, common_coords_2
+            )
+            common_coords_2 = superposition_functions.apply_rotran(
+                common_coords_2, rot, tran
+            )
+        l1, l2 = offsets[i + 1] - offsets[i], offsets[j + 1] - offsets[j]
+        # as in tm_score
+        d1 = 1.24 * (l1 - 15) ** 1 / 3 - 1.8
+        d2 = 1.24 * (l2 - 15) ** 1 / 3 - 1.8
+        sum_squared = sum_1 = sum_2 = 0.0
+        for c in range(num_common):
+            squared = 0.0
+            for d in range(coords.shape[1]):
+                difference = (common_coords_1[c, d] - common_coords_2[c, d]) ** 2
+                squared += difference
+                sum_squared += difference
+            distance = np.sqrt(squared)
+            sum_1 += 1 / (1 + (distance / d1))
+            sum_2 += 1 / (1 + (distance / d2))
+        rmsd_matrix[i, j] = rmsd_matrix[j, i] = np.sqrt(sum_squared / num_common)
+        coverage_matrix[i, j] = coverage_matrix[j, i] = (
+            num_common / alignment_matrix.shape[1]
+        )
+        tm_matrix[i, j] = tm_matrix[j, i] = max((1 / l1) * sum_1, (1 / l2) * sum_2)
+    return rmsd_matrix, coverage_matrix, tm_matrix
+
+
 @nb.njit
 def get_common_coordinates(
     coords_1: np.ndarray, coords_2: np.ndarray, aln_1: np.ndarray, aln_2: np.ndarray
@@ -53,35 +130,233 @@ def get_mean_coords(
     """
     Mean of two coordinate sets (of the same shape)
     """
-    mean_coords = np.zeros((aln_1.shape[0], coords_1.shape[1]))
-    for i, (x, y) in enumerate(zip(aln_1, aln_2)):
+    mean_coords, _ = get_mean_coords_weights(
+        aln_1,
+        coords_1,
+        np.zeros(coords_1.shape[0]),
+        aln_2,
+        coords_2,
+        np.zeros(coords_2.shape[0]),
+    )
+    return mean_coords
+
+
+@nb.njit(nogil=True)
+def get_mean_coords_weights(
+    aln_1, coords_1, weights_1, aln_2, coords_2, weights_2, fraction_1=0.5
+):
+    """
+    Consensus coordinates and weights of two aligned coordinate sets, in one pass over the alignment
+    (same as get_mean_coords and get_mean_weights with fraction_1 = 0.5)
+
+    Parameters
+    ----------
+    aln_1
+    coords_1
+    weights_1
+        one weight per coordinate of coords_1
+    aln_2
+    coords_2
+    weights_2
+    fraction_1
+        weight of coords_1 in the mean of aligned coordinates, coords_2 has 1 - fraction_1
+        (e.g. the fraction of structures in the first node)
+
+    Returns
+    -------
+    consensus coordinates, summed weights of aligned positions
+    """
+    mean_coords = np.empty((aln_1.shape[0], coords_1.shape[1]))
+    mean_weights = np.zeros(aln_1.shape[0])
+    for i in range(aln_1.shape[0]):
+        x, y = aln_1[i], aln_2[i]
         if x == -1:
             mean_coords[i] = coords_2[y]
+            mean_weights[i] = weights_2[y]
         elif y == -1:
             mean_coords[i] = coords_1[x]
+            mean_weights[i] = weights_1[x]
         else:
-            mean_coords[i] = np.array(
-                [
-                    np.nanmean(np.array([coords_1[x, d], coords_2[y, d]]))
-                    for d in range(coords_1.shape[1])
-                ]
-            )
-    return mean_coords
+            for d in range(coords_1.shape[1]):
+                # ignores NaNs as np.nanmean
+                if np.isnan(coords_1[x, d]):
+                    mean_coords[i, d] = coords_2[y, d]
+                elif np.isnan(coords_2[y, d]):
+                    mean_coords[i, d] = coords_1[x, d]
+                else:
+                    mean_coords[i, d] = (
+                        fraction_1 * coords_1[x, d] + (1.0 - fraction_1) * coords_2[y, d]
+                    )
+            mean_weights[i] = weights_1[x] + weights_2[y]
+    return mean_coords, mean_weights
+
+
+def _remap_alignment(alignment_matrix, dtw_aln):
+    """
+    Alignment of the members of a node to a merged node, from the node's alignment to the merged node (dtw_aln)
+
+    Parameters
+    ----------
+    alignment_matrix
+        [members x node length] indices of aligning residues with gaps as -1s
+    dtw_aln
+        index of each column of the merged node in the node, -1 for gaps
+
+    Returns
+    -------
+    [members x merged node length] indices of aligning residues with gaps as -1s
+    """
+    # gaps (-1) take the last column, all gaps
+    with_gaps = np.hstack(
+        (alignment_matrix, np.full((alignment_matrix.shape[0], 1), -1, dtype=np.int32))
+    )
+    return with_gaps[:, dtw_aln]
+
+
+def _get_aligned_sequence(sequence: str, aln: np.ndarray) -> str:
+    """
+    Sequence with gaps (-1s in aln) as "-"
+    """
+    # gaps (-1) take the last letter
+    letters = np.frombuffer((sequence + "-").encode(), dtype=np.uint8)
+    return letters[aln].tobytes().decode()
 
 
 def get_mean_weights(
     weights_1: np.ndarray, weights_2: np.ndarray, aln_1: np.ndarray, aln_2: np.ndarray
 ) -> np.ndarray:
+    """
+    Summed weights of aligned positions
+    """
     mean_weights = np.zeros(aln_1.shape[0])
-    for i, (x, y) in enumerate(zip(aln_1, aln_2)):
-        if not x == -1:
-            mean_weights[i] += weights_1[x]
-        if not y == -1:
-            mean_weights[i] += weights_2[y]
+    mean_weights[aln_1 != -1] += weights_1.reshape(-1)[aln_1[aln_1 != -1]]
+    mean_weights[aln_2 != -1] += weights_2.reshape(-1)[aln_2[aln_2 != -1]]
     return mean_weights
 
 
 @nb.njit
+def _dtw_align_coordinates(
+    coords_1,
+    coords_2,
+    gamma,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    band_width: int,
+    lower: np.ndarray,
+    upper: np.ndarray,
+    low_memory: bool,
+    min_score: float,
+    parallel: bool,
+):
+    """
+    DTW alignment of two (weighted) coordinate sets on their caretta scores
+
+    Scores are computed inside the DTW recurrence, the score matrix is never stored.
+    With band_width > 0, only cells in a band around the seed (lower, upper) are scored and filled,
+    doubling the band until the warping path no longer touches its edges
+    With low_memory, the full DTW matrices are not stored either (see dtw.dtw_align_low_memory)
+    With min_score > 0, only pairs of coordinates close enough to score at least min_score are scored,
+    the rest count as 0 (see score_functions.make_sparse_score_matrix)
+    With parallel (and none of the above), the score matrix and the DTW matrix are filled with multiple threads
+    (see dtw.dtw_align_parallel_coordinates)
+    Scores and DTW matrices are stored in the precision of coords_1
+    """
+    n, m = coords_1.shape[0], coords_2.shape[0]
+    if min_score > 0:
+        sparse_scores = score_functions.make_sparse_score_matrix(
+            coords_1, coords_2, gamma, min_score
+        )
+        if band_width > 0:
+            return dtw.dtw_align_in_band(
+                sparse_scores,
+                sparse_scores,
+                score_functions.make_sparse_band_scores,
+                gamma,
+                n,
+                m,
+                gap_open_penalty,
+                gap_extend_penalty,
+                lower,
+                upper,
+                band_width,
+            )
+        if low_memory:
+            return dtw.dtw_align_low_memory_rows(
+                sparse_scores,
+                sparse_scores,
+                score_functions.make_sparse_score_row,
+                gamma,
+                n,
+                m,
+                gap_open_penalty,
+                gap_extend_penalty,
+                0,
+                coords_1.dtype,
+            )
+        return dtw.dtw_align_rows(
+            sparse_scores,
+            sparse_scores,
+            score_functions.make_sparse_score_row,
+            gamma,
+            n,
+            m,
+            gap_open_penalty,
+            gap_extend_penalty,
+            coords_1.dtype,
+        )
+    if band_width > 0:
+        return dtw.dtw_align_in_band(
+            coords_1,
+            coords_2,
+            score_functions.make_caretta_band_scores,
+            gamma,
+            n,
+            m,
+            gap_open_penalty,
+            gap_extend_penalty,
+            lower,
+            upper,
+            band_width,
+        )
+    if low_memory:
+        return dtw.dtw_align_low_memory_coordinates(
+            coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty
+        )
+    if parallel:
+        return dtw.dtw_align_parallel_coordinates(
+            coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty
+        )
+    return dtw.dtw_align_coordinates(
+        coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty
+    )
+
+
+@nb.njit(nogil=True)
+def _get_segment_means(coords, size):
+    """
+    Mean of each run of size consecutive coordinates (the last one may be shorter)
+    """
+    n = coords.shape[0]
+    means = np.zeros(((n + size - 1) // size, coords.shape[1]))
+    for s in range(means.shape[0]):
+        end = min(n, (s + 1) * size)
+        for i in range(s * size, end):
+            means[s] += coords[i]
+        means[s] /= end - s * size
+    return means
+
+
+@nb.njit(nogil=True)
+def _get_superposition_change(coords_1, coords_2, superposed_1, superposed_2):
+    """
+    RMSD by which coords_2 moves relative to coords_1 when the pair is replaced by superposed_1, superposed_2
+    (superposed_1 is a translation of coords_1)
+    """
+    shift = helper.nb_mean_axis_0(superposed_1.astype(np.float64) - coords_1)
+    return score_functions.get_rmsd(superposed_2 - shift, coords_2.astype(np.float64))
+
+
+@nb.njit(nogil=True)
 def get_pairwise_alignment(
     coords_1,
     coords_2,
@@ -91,19 +366,110 @@ def get_pairwise_alignment(
     weights_1: np.ndarray,
     weights_2: np.ndarray,
     n_iter=3,
+    band_width=0,
+    low_memory=False,
+    min_score=0.0,
+    parallel=False,
+    coarse=0,
+    tolerance=0.0,
+    corridor=0,
 ):
-    score_matrix = score_functions.make_score_matrix(
+    """
+    Aligns two superposed coordinate sets with DTW, refining the superposition on the aligned positions up to n_iter times
+    Refinement stops at the first iteration whose DTW score doesn't improve
+
+    band_width > 0 restricts DTW to a band around the diagonal (first alignment)
+    and around the previous warping path (refinement iterations)
+    low_memory => full DTW without storing the DTW matrices, same result
+    min_score > 0 => pairs scoring below min_score count as 0 and are never scored (sparse scoring)
+    parallel => full DTW using multiple threads, same result
+    coarse > 1 => first aligns the means of every coarse residues, then restricts DTW to a band
+    of at least coarse residues around that path projected back (first alignment)
+    and around the previous warping path (refinement iterations), for long proteins
+    float32 coordinates and weights => DTW scores and matrices in float32 (half the memory traffic)
+    tolerance > 0 => refinement also stops when the refined superposition moves coords_2 relative to coords_1
+    by less than this RMSD, without rerunning DTW
+    corridor > 0 (without band_width) => refinement iterations only fill a band of this many residues
+    around the previous warping path (widened automatically when the path reaches its edge)
+
+    Returns
+    -------
+    alignment_1, alignment_2, score, superposed_coords_1, superposed_coords_2
+    """
+    aln_1, aln_2, score, coords_1, coords_2, _ = _get_pairwise_alignment(
+        coords_1,
+        coords_2,
+        gamma,
+        gap_open_penalty,
+        gap_extend_penalty,
+        weights_1,
+        weights_2,
+        n_iter,
+        band_width,
+        low_memory,
+        min_score,
+        parallel,
+        coarse,
+        tolerance,
+        corridor,
+    )
+    return aln_1, aln_2, score, coords_1, coords_2
+
+
+@nb.njit(nogil=True)
+def _get_pairwise_alignment(
+    coords_1,
+    coords_2,
+    gamma,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    weights_1: np.ndarray,
+    weights_2: np.ndarray,
+    n_iter=3,
+    band_width=0,
+    low_memory=False,
+    min_score=0.0,
+    parallel=False,
+    coarse=0,
+    tolerance=0.0,
+    corridor=0,
+):
+    """
+    Same as get_pairwise_alignment, also returning the number of refinement iterations that reran DTW
+    """
+    n, m = coords_1.shape[0], coords_2.shape[0]
+    if coarse > 1 and min(n, m) > coarse:
+        coarse_aln_1, coarse_aln_2, _ = dtw.dtw_align_coordinates(
+            _get_segment_means(np.hstack((coords_1, weights_1)), coarse),
+            _get_segment_means(np.hstack((coords_2, weights_2)), coarse),
+            gamma,
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+        lower, upper = dtw.get_coarse_path_band(coarse_aln_1, coarse_aln_2, n, m, coarse)
+        band_width = max(band_width, coarse)
+    else:
+        lower, upper = dtw.get_diagonal_band(n, m)
+    dtw_aln_array_1, dtw_aln_array_2, dtw_score = _dtw_align_coordinates(
         np.hstack((coords_1, weights_1)),
         np.hstack((coords_2, weights_2)),
-        score_functions.get_caretta_score,
         gamma,
+        gap_open_penalty,
+        gap_extend_penalty,
+        band_width,
+        lower,
+        upper,
+        low_memory,
+        min_score,
+        parallel,
     )
-    dtw_aln_array_1, dtw_aln_array_2, dtw_score = dtw.dtw_align(
-        score_matrix, gap_open_penalty, gap_extend_penalty
-    )
+    refine_band_width = band_width if band_width > 0 else corridor
+    iterations = 0
     for i in range(n_iter):
         pos_1, pos_2 = helper.get_common_positions(dtw_aln_array_1, dtw_aln_array_2)
-        common_coords_1, common_coords_2 = coords_1[pos_1], coords_2[pos_2]
+        # superposition is done in float64, DTW stays in the precision of the input
+        common_coords_1 = coords_1[pos_1].astype(np.float64)
+        common_coords_2 = coords_2[pos_2].astype(np.float64)
         (
             c1,
             c2,
@@ -111,15 +477,30 @@ def get_pairwise_alignment(
         ) = superposition_functions.paired_svd_superpose_with_subset(
             coords_1, coords_2, common_coords_1, common_coords_2
         )
-        score_matrix = score_functions.make_score_matrix(
+        c1, c2 = c1.astype(coords_1.dtype), c2.astype(coords_2.dtype)
+        if (
+            tolerance > 0
+            and _get_superposition_change(coords_1, coords_2, c1, c2) < tolerance
+        ):
+            break
+        if refine_band_width > 0:
+            lower, upper = dtw.get_path_band(
+                dtw_aln_array_1, dtw_aln_array_2, coords_1.shape[0]
+            )
+        aln_1, aln_2, score = _dtw_align_coordinates(
             np.hstack((c1, weights_1)),
             np.hstack((c2, weights_2)),
-            score_functions.get_caretta_score,
             gamma,
+            gap_open_penalty,
+            gap_extend_penalty,
+            refine_band_width,
+            lower,
+            upper,
+            low_memory,
+            min_score,
+            parallel,
         )
-        aln_1, aln_2, score = dtw.dtw_align(
-            score_matrix, gap_open_penalty, gap_extend_penalty
-        )
+        iterations += 1
         if score > dtw_score:
             coords_1 = c1
             coords_2 = c2
@@ -128,7 +509,522 @@ def get_pairwise_alignment(
             dtw_aln_array_2 = aln_2
         else:
             break
-    return dtw_aln_array_1, dtw_aln_array_2, dtw_score, coords_1, coords_2
+    return dtw_aln_array_1, dtw_aln_array_2, dtw_score, coords_1, coords_2, iterations
+
+
+@nb.njit
+def get_pairwise_score(
+    coords_1,
+    coords_2,
+    gamma,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    normalized=False,
+) -> float:
+    """
+    DTW score of two superposed coordinate sets, without making the alignment
+
+    normalized
+        if True, divides by the length of the shorter coordinate set
+    """
+    score = dtw.dtw_score_coordinates(
+        coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty
+    )
+    if normalized:
+        return score / min(coords_1.shape[0], coords_2.shape[0])
+    else:
+        return score
+
+
+@nb.njit
+def _get_pairwise_alignment_moments(
+    coords_1,
+    coords_2,
+    moments_1,
+    moments_2,
+    gamma,
+    gamma_moment,
+    superposition_gap_open_penalty: float,
+    superposition_gap_extend_penalty: float,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    n_iter,
+    band_width,
+    low_memory,
+    min_score,
+    coarse=0,
+    float32=False,
+    tolerance=0.0,
+    corridor=0,
+):
+    """
+    Same as StructureMultiple.get_pairwise_alignment (unweighted, with moment_svd_superpose_function)
+    on moments already made with superposition_functions.get_moments,
+    also returning the number of refinement iterations that reran DTW
+
+    float32
+        if True, aligns the superposed coordinates in float32 (returned in float64)
+    """
+    _, coords_1, coords_2 = superposition_functions.moment_svd_superpose_moments(
+        coords_1,
+        coords_2,
+        moments_1,
+        moments_2,
+        gamma,
+        gamma_moment,
+        superposition_gap_open_penalty,
+        superposition_gap_extend_penalty,
+    )
+    if float32:
+        (
+            aln_1,
+            aln_2,
+            score,
+            coords_1_32,
+            coords_2_32,
+            iterations,
+        ) = _get_pairwise_alignment(
+            coords_1.astype(np.float32),
+            coords_2.astype(np.float32),
+            gamma,
+            gap_open_penalty,
+            gap_extend_penalty,
+            np.zeros((coords_1.shape[0], 1), dtype=np.float32),
+            np.zeros((coords_2.shape[0], 1), dtype=np.float32),
+            n_iter,
+            band_width,
+            low_memory,
+            min_score,
+            False,
+            coarse,
+            tolerance,
+            corridor,
+        )
+        return (
+            aln_1,
+            aln_2,
+            np.float64(score),
+            coords_1_32.astype(np.float64),
+            coords_2_32.astype(np.float64),
+            iterations,
+        )
+    return _get_pairwise_alignment(
+        coords_1,
+        coords_2,
+        gamma,
+        gap_open_penalty,
+        gap_extend_penalty,
+        np.zeros((coords_1.shape[0], 1)),
+        np.zeros((coords_2.shape[0], 1)),
+        n_iter,
+        band_width,
+        low_memory,
+        min_score,
+        False,
+        coarse,
+        tolerance,
+        corridor,
+    )
+
+
+@nb.njit(parallel=True)
+def get_pairwise_alignments_one_vs_many(
+    coords,
+    moments,
+    target_coords,
+    target_offsets,
+    target_moments,
+    target_moment_offsets,
+    gamma,
+    gamma_moment,
+    superposition_gap_open_penalty: float,
+    superposition_gap_extend_penalty: float,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    n_iter=3,
+    band_width=0,
+    low_memory=False,
+    min_score=0.0,
+    coarse=0,
+    float32=False,
+    tolerance=0.0,
+    corridor=0,
+):
+    """
+    Same as StructureMultiple.get_pairwise_alignment (unweighted, with moment_svd_superpose_function)
+    of coords against each of a set of targets, aligning targets in parallel
+
+    Parameters
+    ----------
+    coords
+        shape = (n, 3)
+    moments
+        moments of coords (see superposition_functions.get_moments)
+    target_coords
+        coordinates of all targets, concatenated
+        target t is target_coords[target_offsets[t] : target_offsets[t + 1]]
+    target_offsets
+    target_moments
+        moments of all targets, concatenated
+        moments of target t are target_moments[target_moment_offsets[t] : target_moment_offsets[t + 1]]
+    target_moment_offsets
+    gamma
+    gamma_moment
+    superposition_gap_open_penalty
+    superposition_gap_extend_penalty
+        gap penalties of the superposition (see superposition_functions.moment_svd_superpose_function)
+    gap_open_penalty
+    gap_extend_penalty
+    n_iter
+    band_width
+    low_memory
+    min_score
+    coarse
+        see get_pairwise_alignment
+    float32
+        if True, aligns in float32 (see _get_pairwise_alignment_moments)
+    tolerance
+    corridor
+        see get_pairwise_alignment
+
+    Returns
+    -------
+    scores
+        shape = (n_targets,)
+    alignments_1, alignments_2
+        alignments of all targets, concatenated
+        alignment of target t is alignments_x[alignment_offsets[t] : alignment_offsets[t + 1]]
+    alignment_offsets
+    superposed_coords
+        coords superposed to each target; shape = (n_targets, n, 3)
+    superposed_target_coords
+        same layout as target_coords
+    iterations
+        number of refinement iterations that reran DTW for each target; shape = (n_targets,)
+    """
+    n = coords.shape[0]
+    n_targets = target_offsets.shape[0] - 1
+    scores = np.zeros(n_targets)
+    # an alignment of target t is at most n + its length long
+    max_offsets = np.zeros(n_targets + 1, dtype=np.int64)
+    for t in range(n_targets):
+        max_offsets[t + 1] = max_offsets[t] + n + target_offsets[t + 1] - target_offsets[t]
+    buffer_1 = np.zeros(max_offsets[-1], dtype=np.int64)
+    buffer_2 = np.zeros(max_offsets[-1], dtype=np.int64)
+    alignment_lengths = np.zeros(n_targets, dtype=np.int64)
+    superposed_coords = np.zeros((n_targets, n, coords.shape[1]))
+    superposed_target_coords = np.zeros_like(target_coords)
+    iterations = np.zeros(n_targets, dtype=np.int64)
+    for t in nb.prange(n_targets):
+        start, end = target_offsets[t], target_offsets[t + 1]
+        (
+            aln_1,
+            aln_2,
+            score,
+            coords_1,
+            coords_2,
+            iterations[t],
+        ) = _get_pairwise_alignment_moments(
+            coords,
+            target_coords[start:end],
+            moments,
+            target_moments[target_moment_offsets[t] : target_moment_offsets[t + 1]],
+            gamma,
+            gamma_moment,
+            superposition_gap_open_penalty,
+            superposition_gap_extend_penalty,
+            gap_open_penalty,
+            gap_extend_penalty,
+            n_iter,
+            band_width,
+            low_memory,
+            min_score,
+            coarse,
+            float32,
+            tolerance,
+            corridor,
+        )
+        scores[t] = score
+        alignment_lengths[t] = aln_1.shape[0]
+        buffer_1[max_offsets[t] : max_offsets[t] + aln_1.shape[0]] = aln_1
+        buffer_2[max_offsets[t] : max_offsets[t] + aln_2.shape[0]] = aln_2
+        superposed_coords[t] = coords_1
+        superposed_target_coords[start:end] = coords_2
+    alignment_offsets = np.zeros(n_targets + 1, dtype=np.int64)
+    alignment_offsets[1:] = np.cumsum(alignment_lengths)
+    alignments_1 = np.zeros(alignment_offsets[-1], dtype=np.int64)
+    alignments_2 = np.zeros(alignment_offsets[-1], dtype=np.int64)
+    for t in range(n_targets):
+        alignments_1[alignment_offsets[t] : alignment_offsets[t + 1]] = buffer_1[
+            max_offsets[t] : max_offsets[t] + alignment_lengths[t]
+        ]
+        alignments_2[alignment_offsets[t] : alignment_offsets[t + 1]] = buffer_2[
+            max_offsets[t] : max_offsets[t] + alignment_lengths[t]
+        ]
+    return (
+        scores,
+        alignments_1,
+        alignments_2,
+        alignment_offsets,
+        superposed_coords,
+        superposed_target_coords,
+        iterations,
+    )
+
+
+@nb.njit(parallel=True)
+def get_pairwise_distances(
+    coords,
+    offsets,
+    moments,
+    moment_offsets,
+    pairs,
+    gamma,
+    gamma_moment,
+    superposition_gap_open_penalty: float,
+    superposition_gap_extend_penalty: float,
+    gap_open_penalty: float,
+    gap_extend_penalty: float,
+    n_iter=3,
+    band_width=0,
+    low_memory=False,
+    min_score=0.0,
+    score_only=False,
+    keep_alignments=False,
+    coarse=0,
+    float32=False,
+    tolerance=0.0,
+    corridor=0,
+):
+    """
+    Similarity scores of pairs of structures as in StructureMultiple.make_pairwise_dtw_matrix
+    (with moment_svd_superpose_function), pairs aligned in parallel, optionally keeping their alignments
+
+    Pairs are handed out to threads in the given order
+    (with numba.set_parallel_chunksize(1) each thread takes the next pair when it is done),
+    so giving the longest pairs first keeps threads busy
+
+    Parameters
+    ----------
+    coords
+        coordinates of all structures, concatenated
+        structure i is coords[offsets[i] : offsets[i + 1]]
+    offsets
+    moments
+        moments of all structures, concatenated (see superposition_functions.get_moments)
+        moments of structure i are moments[moment_offsets[i] : moment_offsets[i + 1]]
+    moment_offsets
+    pairs
+        indices of structures to compare; shape = (n_pairs, 2)
+    gamma
+    gamma_moment
+    superposition_gap_open_penalty
+    superposition_gap_extend_penalty
+        gap penalties of the superposition (see superposition_functions.moment_svd_superpose_function)
+    gap_open_penalty
+    gap_extend_penalty
+    n_iter
+    band_width
+    low_memory
+    min_score
+        see get_pairwise_alignment
+    score_only
+        if True, scores pairs with get_pairwise_score (normalized) after superposition
+        instead of refining the alignment and scoring its aligned positions
+    keep_alignments
+        if True (and not score_only), also returns the output of get_pairwise_alignment for each pair
+    coarse
+        see get_pairwise_alignment
+    float32
+        if True, runs DTW in float32 (see _get_pairwise_alignment_moments)
+    tolerance
+    corridor
+        see get_pairwise_alignment
+
+    Returns
+    -------
+    scores; shape = (n_pairs,)
+    dtw_scores
+        DTW score of each pair's alignment (empty unless keep_alignments)
+    alignments_1, alignments_2
+        alignments of all pairs, concatenated
+        alignment of pair p is alignments_x[alignment_offsets[p] : alignment_offsets[p + 1]]
+    alignment_offsets
+    superposed_coords
+        superposed coordinates of all pairs, concatenated
+        pair p (i, j) has superposed_coords[coord_offsets[p] : coord_offsets[p + 1]],
+        the first length of i rows for structure i, the rest for j
+    coord_offsets
+    iterations
+        number of refinement iterations that reran DTW for each pair (0 if score_only); shape = (n_pairs,)
+    """
+    n_pairs = pairs.shape[0]
+    keep_alignments = keep_alignments and not score_only
+    scores = np.zeros(n_pairs)
+    # an alignment of pair (i, j) is at most the length of i + the length of j long, as are its coordinates
+    coord_offsets = np.zeros(n_pairs + 1, dtype=np.int64)
+    if keep_alignments:
+        for p in range(n_pairs):
+            i, j = pairs[p, 0], pairs[p, 1]
+            coord_offsets[p + 1] = (
+                coord_offsets[p] + offsets[i + 1] - offsets[i] + offsets[j + 1] - offsets[j]
+            )
+    dtw_scores = np.zeros(n_pairs if keep_alignments else 0)
+    buffer_1 = np.zeros(coord_offsets[-1], dtype=np.int64)
+    buffer_2 = np.zeros(coord_offsets[-1], dtype=np.int64)
+    alignment_lengths = np.zeros(n_pairs, dtype=np.int64)
+    superposed_coords = np.zeros((coord_offsets[-1], coords.shape[1]))
+    iterations = np.zeros(n_pairs, dtype=np.int64)
+    for p in nb.prange(n_pairs):
+        i, j = pairs[p, 0], pairs[p, 1]
+        coords_1 = coords[offsets[i] : offsets[i + 1]]
+        coords_2 = coords[offsets[j] : offsets[j + 1]]
+        moments_1 = moments[moment_offsets[i] : moment_offsets[i + 1]]
+        moments_2 = moments[moment_offsets[j] : moment_offsets[j + 1]]
+        if score_only:
+            _, coords_1, coords_2 = superposition_functions.moment_svd_superpose_moments(
+                coords_1,
+                coords_2,
+                moments_1,
+                moments_2,
+                gamma,
+                gamma_moment,
+                superposition_gap_open_penalty,
+                superposition_gap_extend_penalty,
+            )
+            if float32:
+                scores[p] = get_pairwise_score(
+                    coords_1.astype(np.float32),
+                    coords_2.astype(np.float32),
+                    gamma,
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                    True,
+                )
+            else:
+                scores[p] = get_pairwise_score(
+                    coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty, True
+                )
+        else:
+            (
+                aln_1,
+                aln_2,
+                dtw_score,
+                coords_1,
+                coords_2,
+                iterations[p],
+            ) = _get_pairwise_alignment_moments(
+                coords_1,
+                coords_2,
+                moments_1,
+                moments_2,
+                gamma,
+                gamma_moment,
+                superposition_gap_open_penalty,
+                superposition_gap_extend_penalty,
+                gap_open_penalty,
+                gap_extend_penalty,
+                n_iter,
+                band_width,
+                low_memory,
+                min_score,
+                coarse,
+                float32,
+                tolerance,
+                corridor,
+            )
+            pos_1, pos_2 = helper.get_common_positions(aln_1, aln_2)
+            scores[p] = score_functions.get_total_score(
+                coords_1[pos_1],
+                coords_2[pos_2],
+                score_functions.get_caretta_score,
+                gamma,
+                True,
+            )
+            if keep_alignments:
+                start = coord_offsets[p]
+                dtw_scores[p] = dtw_score
+                alignment_lengths[p] = aln_1.shape[0]
+                buffer_1[start : start + aln_1.shape[0]] = aln_1
+                buffer_2[start : start + aln_2.shape[0]] = aln_2
+                superposed_coords[start : start + coords_1.shape[0]] = coords_1
+                superposed_coords[start + coords_1.shape[0] : coord_offsets[p + 1]] = coords_2
+    alignment_offsets = np.zeros(n_pairs + 1, dtype=np.int64)
+    alignment_offsets[1:] = np.cumsum(alignment_lengths)
+    alignments_1 = np.zeros(alignment_offsets[-1], dtype=np.int64)
+    alignments_2 = np.zeros(alignment_offsets[-1], dtype=np.int64)
+    for p in range(n_pairs):
+        alignments_1[alignment_offsets[p] : alignment_offsets[p + 1]] = buffer_1[
+            coord_offsets[p] : coord_offsets[p] + alignment_lengths[p]
+        ]
+        alignments_2[alignment_offsets[p] : alignment_offsets[p + 1]] = buffer_2[
+            coord_offsets[p] : coord_offsets[p] + alignment_lengths[p]
+        ]
+    return (
+        scores,
+        dtw_scores,
+        alignments_1,
+        alignments_2,
+        alignment_offsets,
+        superposed_coords,
+        coord_offsets,
+        iterations,
+    )
+
+
+def run_merges(
+    merges: typing.List[typing.Tuple[int, int, int]],
+    merge_function: typing.Callable,
+    num_threads: int = 1,
+    on_merge: typing.Union[None, typing.Callable] = None,
+):
+    """
+    Runs the merges of a guide tree, each as soon as both its nodes are available, up to num_threads at a time
+
+    Parameters
+    ----------
+    merges
+        (node_1, node_2, node_int) for each merge, in an order where nodes are made before they are merged
+        nodes not made by a merge (leaves) are available from the start
+    merge_function
+        called as merge_function(node_1, node_2, node_int)
+    num_threads
+        1 => runs merges one after the other in the given order
+    on_merge
+        called after each merge
+    """
+    if num_threads <= 1:
+        for merge in merges:
+            merge_function(*merge)
+            if on_merge is not None:
+                on_merge()
+        return
+    # starts numba's threading layer from this thread, starting it from a worker can hang the interpreter at exit
+    nb.get_num_threads()
+    made = {merge[2] for merge in merges}
+    waiting = {}
+    num_missing = []
+    for index, (node_1, node_2, _) in enumerate(merges):
+        missing = [node for node in (node_1, node_2) if node in made]
+        num_missing.append(len(missing))
+        for node in missing:
+            waiting.setdefault(node, []).append(index)
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        running = {
+            executor.submit(merge_function, *merges[index]): index
+            for index in range(len(merges))
+            if num_missing[index] == 0
+        }
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                for index in waiting.get(merges[running.pop(future)][2], []):
+                    num_missing[index] -= 1
+                    if num_missing[index] == 0:
+                        running[executor.submit(merge_function, *merges[index])] = index
+                if on_merge is not None:
+                    on_merge()
 
 
 @dataclass
@@ -150,9 +1046,60 @@ DEFAULT_SUPERPOSITION_PARAMETERS = {
     "split_size": 20,
     "scale": True,
     "gamma_moment": 0.6,
-    "n_iter": 3
+    "n_iter": 3,
+    # DTW in get_pairwise_alignment, 0 => full matrix
+    "band_width": 0,
+    # full DTW without storing the DTW matrices (for very long proteins)
+    "low_memory": False,
+    # scores below this are treated as 0 and never computed, 0 => all scores computed
+    "min_score": 0.0,
+    # full DTW with multiple threads (set with numba.set_num_threads)
+    "parallel": False,
+    # > 1 => DTW first on means of this many residues, then in a band around that path
+    "coarse": 0,
+    # DTW and score matrices in float32 (half the memory traffic, superposition stays in float64)
+    "float32": False,
+    # > 0 => refinement stops once the superposition moves by less than this RMSD
+    "tolerance": 0.0,
+    # > 0 => refinement DTW only in a band of this many residues around the previous path
+    "corridor": 0,
 }
 
+# full-mode pairwise alignments are kept for leaf-leaf merges in align up to about this many bytes
+PAIRWISE_ALIGNMENT_MEMORY = 2 * 1024 ** 3
+
+# guards StructureMultiple.refinement_iterations, a lock can't be a (pickled) dataclass field
+REFINEMENT_ITERATIONS_LOCK = threading.Lock()
+
+
+def check_min_score(min_score: float):
+    """
+    min_score must be in [0, 1): caretta scores are at most 1, and 0 turns sparse scoring off
+    """
+    if not 0.0 <= min_score < 1.0:
+        raise ValueError(
+            f"min_score must be at least 0 and below 1 (0 = score all pairs), got {min_score}"
+        )
+
+
+def check_distance_options(
+    full: bool,
+    sparse_full: int,
+    score_only: bool,
+    knn: int,
+    distance_file: typing.Union[None, str, Path],
+):
+    """
+    distance_file only applies to shape distances (without full, sparse_full and knn),
+    score_only only to pairwise alignment distances (full or sparse_full)
+    """
+    if distance_file is not None and (full or sparse_full > 0 or knn > 0):
+        raise ValueError(
+            "distance_file is only used for shape distances, not with full, sparse_full or knn"
+        )
+    if score_only and not (full or sparse_full > 0):
+        raise ValueError("score_only is only used with full or sparse_full")
+
 
 @dataclass
 class StructureMultiple:
@@ -172,6 +1119,9 @@ class StructureMultiple:
         a function that takes two paired coordinate sets (same shape) and returns a score
     consensus_weight
         weights the effect of well-aligned columns on the progressive alignment
+    weighted_consensus
+        if True, intermediate structures weight each aligned node by its number of structures
+        instead of taking the plain mean (with the default mean_function)
     final_structures
         makes the progressive alignment tree of structures, last one is the consensus structure of the multiple alignment
     tree
@@ -179,6 +1129,15 @@ class StructureMultiple:
     branch_lengths
     alignment
         indices of aligning residues from each structure, gaps are -1s
+    alignment_matrix
+        the same as an int32 [num_structures x alignment length] matrix, rows in the order of structures
+    pairwise_alignments
+        {_get_pairwise_alignment_key(index_1, index_2, gap_open_penalty, gap_extend_penalty, n_iter): output of get_pairwise_alignment}
+        kept by make_pairwise_dtw_matrix for align to reuse when two structures are merged,
+        cleared by each make_pairwise_dtw_matrix call and by align
+    refinement_iterations
+        int64 counts of the pairwise alignments made so far, indexed by the number of refinement iterations
+        that reran DTW (see get_refinement_statistics)
     """
 
     structures: typing.List[Structure]
@@ -197,21 +1156,41 @@ class StructureMultiple:
         [np.ndarray, np.ndarray, np.ndarray, np.ndarray], np.ndarray
     ] = get_mean_coords
     consensus_weight: float = 1.0
+    weighted_consensus: bool = False
     final_structures: typing.Union[None, typing.List[Structure]] = None
     final_consensus_weights: typing.Union[None, typing.List[np.ndarray]] = None
     tree: typing.Union[None, np.ndarray] = None
     branch_lengths: typing.Union[None, np.ndarray] = None
     alignment: typing.Union[dict, None] = None
+    alignment_matrix: typing.Union[np.ndarray, None] = None
+    pairwise_alignments: typing.Union[dict, None] = None
+    refinement_iterations: typing.Union[np.ndarray, None] = None
     output_folder: Path = Path("./caretta_results")
     features: typing.Union[dict, None] = None
 
+    def __post_init__(self):
+        check_min_score(self.superposition_parameters.get("min_score", 0.0))
+
     @staticmethod
     def align_from_pdb_files(
         input_pdb: typing.Union[typing.List[str], Path, str],
         gap_open_penalty: float = 1.0,
         gap_extend_penalty: float = 0.01,
         consensus_weight: float = 1.0,
+        weighted_consensus: bool = False,
         full: bool = False,
+        sparse_full: int = 0,
+        score_only: bool = False,
+        band_width: int = 0,
+        low_memory: bool = False,
+        min_score: float = 0.0,
+        parallel: bool = False,
+        coarse: int = 0,
+        float32: bool = False,
+        tolerance: float = 0.0,
+        corridor: int = 0,
+        knn: int = 0,
+        distance_file: typing.Union[None, str, Path] = None,
         output_folder: typing.Union[str, Path] = Path("../caretta_results"),
         num_threads: int = 20,
         write_fasta: bool = False,
@@ -240,12 +1219,58 @@ class StructureMultiple:
             default 0.01
         consensus_weight
             default 1
+        weighted_consensus
+            True => intermediate structures weight each aligned node by its number of structures,
+            so large groups are not averaged 1:1 with single structures
         full
             True =>  Uses all-vs-all pairwise Caretta alignment to make the distance matrix (much slower)
+        sparse_full
+            > 0 => without full, uses pairwise Caretta alignment only between each structure
+            and this many nearest neighbours of its shape embedding, other distances are calibrated shape distances
+            default 0 (shape distances only)
+        score_only
+            True => with full or sparse_full, scores each pair by its DTW score after superposition,
+            skipping alignment refinement and traceback (faster)
+            ValueError without full or sparse_full
+        band_width
+            > 0 => restricts pairwise DTW to a band of this many residues around the diagonal / previous alignment,
+            widened automatically when the alignment reaches its edge (faster for long proteins)
+            default 0 (full DTW)
+        low_memory
+            True => full DTW without storing the DTW matrices, same alignment in a fraction of the memory (slower)
+        min_score
+            0 <= min_score < 1
+            > 0 => residue pairs of superposed proteins scoring below this are treated as 0 and never scored,
+            only nearby pairs are found with a cell list (e.g. 1e-6, best combined with band_width)
+            default 0 (all pairs scored)
+        parallel
+            True => pairwise DTW uses num_threads threads (same alignment, for very long proteins)
+        coarse
+            > 1 => pairwise DTW first aligns the means of every this many residues,
+            then refines at full resolution only in a band around that path (faster for long proteins)
+            default 0 (off)
+        float32
+            True => pairwise score and DTW matrices in float32 instead of float64
+            (half the memory traffic, superposition and consensus structures stay in float64)
+        tolerance
+            > 0 => pairwise refinement stops once the refined superposition moves a protein by less than this RMSD
+            default 0 (refines until the DTW score stops improving, at most n_iter times)
+        corridor
+            > 0 => refinement iterations only rerun DTW in a band of this many residues around the previous alignment
+            default 0 (same DTW as the first alignment)
+        knn
+            > 0 => without full, makes the guide tree from this many nearest neighbours of each structure's shape embedding
+            instead of neighbor joining on all pairwise distances (for thousands of structures)
+            default 0 (neighbor joining)
+        distance_file
+            if given (without full or knn), the shape distance matrix is written to this file as a float32 memory map
+            and reduced in place during neighbor joining, instead of kept in memory (for tens of thousands of structures)
+            ValueError with full, sparse_full or knn
         output_folder
             default "caretta_results"
         num_threads
-            Number of threads to use for feature extraction
+            Number of threads to use for feature extraction, all vs. all pairwise alignment (full),
+            progressive alignment and pairwise DTW (parallel)
         write_fasta
             True => writes alignment as fasta file (default True)
             writes to output_folder / result.fasta
@@ -267,23 +1292,62 @@ class StructureMultiple:
         -------
         StructureMultiple class
         """
+        check_min_score(min_score)
+        check_distance_options(full, sparse_full, score_only, knn, distance_file)
+        nb.set_num_threads(min(num_threads, nb.config.NUMBA_NUM_THREADS))
         msa_class = StructureMultiple.from_pdb_files(
             input_pdb,
-            superposition_parameters=DEFAULT_SUPERPOSITION_PARAMETERS,
+            superposition_parameters={
+                **DEFAULT_SUPERPOSITION_PARAMETERS,
+                "band_width": band_width,
+                "low_memory": low_memory,
+                "min_score": min_score,
+                "parallel": parallel,
+                "coarse": coarse,
+                "float32": float32,
+                "tolerance": tolerance,
+                "corridor": corridor,
+            },
             superposition_function=superposition_functions.moment_svd_superpose_function,
             consensus_weight=consensus_weight,
             output_folder=output_folder,
             verbose=verbose,
         )
+        msa_class.weighted_consensus = weighted_consensus
         if len(msa_class.structures) > 2:
             if full:
                 pw_matrix = msa_class.make_pairwise_dtw_matrix(
-                    gap_open_penalty, gap_extend_penalty, verbose=verbose
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                    score_only=score_only,
+                    verbose=verbose,
                 )
+                guide_tree = None
+            elif sparse_full > 0:
+                pw_matrix = msa_class.make_pairwise_sparse_dtw_matrix(
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                    k=sparse_full,
+                    score_only=score_only,
+                    verbose=verbose,
+                )
+                guide_tree = None
+            elif knn > 0:
+                pw_matrix = None
+                guide_tree = msa_class.make_knn_guide_tree(k=knn, verbose=verbose)
             else:
-                pw_matrix = msa_class.make_pairwise_shape_matrix(verbose=verbose)
+                pw_matrix = msa_class.make_pairwise_shape_matrix(
+                    verbose=verbose, distance_file=distance_file
+                )
+                guide_tree = None
             msa_class.align(
-                pw_matrix, gap_open_penalty, gap_extend_penalty, verbose=verbose
+                pw_matrix,
+                gap_open_penalty,
+                gap_extend_penalty,
+                # parallel DTW kernels can't be run from several threads at once
+                num_threads=1 if parallel else num_threads,
+                verbose=verbose,
+                guide_tree=guide_tree,
             )
         else:
             msa_class.align(
@@ -291,6 +1355,12 @@ class StructureMultiple:
                 gap_extend_penalty=gap_extend_penalty,
                 verbose=verbose,
             )
+        if verbose:
+            statistics = msa_class.get_refinement_statistics()
+            typer.echo(
+                "Refinement iterations per pairwise alignment: "
+                + ", ".join(f"{i}: {c}" for i, c in statistics.items())
+            )
 
         msa_class.write_files(
             write_fasta=write_fasta,
@@ -454,26 +1524,231 @@ class StructureMultiple:
         else:
             weights_1 = np.zeros((coords_1.shape[0], 1))
             weights_2 = np.zeros((coords_2.shape[0], 1))
-        return get_pairwise_alignment(
+        # DTW in the chosen precision, superposed coordinates always returned in float64
+        dtype = (
+            np.float32
+            if self.superposition_parameters.get("float32", False)
+            else np.float64
+        )
+        (
+            dtw_aln_1,
+            dtw_aln_2,
+            score,
             coords_1,
             coords_2,
+            iterations,
+        ) = _get_pairwise_alignment(
+            coords_1.astype(dtype, copy=False),
+            coords_2.astype(dtype, copy=False),
             self.superposition_parameters["gamma"],
             gap_open_penalty,
             gap_extend_penalty,
-            weights_1,
-            weights_2,
+            weights_1.astype(dtype, copy=False),
+            weights_2.astype(dtype, copy=False),
             n_iter,
+            self.superposition_parameters.get("band_width", 0),
+            self.superposition_parameters.get("low_memory", False),
+            self.superposition_parameters.get("min_score", 0.0),
+            self.superposition_parameters.get("parallel", False),
+            self.superposition_parameters.get("coarse", 0),
+            self.superposition_parameters.get("tolerance", 0.0),
+            self.superposition_parameters.get("corridor", 0),
+        )
+        self._add_refinement_iterations([iterations], n_iter)
+        return (
+            dtw_aln_1,
+            dtw_aln_2,
+            float(score),
+            coords_1.astype(np.float64, copy=False),
+            coords_2.astype(np.float64, copy=False),
         )
 
-    def make_pairwise_shape_matrix(
+    def get_pairwise_alignments(
+        self,
+        index: int,
+        target_indices: typing.List[int],
+        gap_open_penalty: float,
+        gap_extend_penalty: float,
+        n_iter=3,
+        moments: typing.Union[None, dict, typing.List[np.ndarray]] = None,
+    ):
+        """
+        Aligns structure index to each structure in target_indices in a single call (see get_pairwise_alignments_one_vs_many)
+        Same as get_pairwise_alignment (unweighted) for each pair, only for moment_svd_superpose_function
+
+        Parameters
+        ----------
+        index
+        target_indices
+        gap_open_penalty
+        gap_extend_penalty
+        n_iter
+        moments
+            moments of each structure by index (see superposition_functions.get_moments), made if None
+
+        Returns
+        -------
+        list of (alignment_1, alignment_2, score, superposed_coords_1, superposed_coords_2), one per target
+        """
+        assert (
+            self.superposition_function
+            is superposition_functions.moment_svd_superpose_function
+        )
+        if moments is None:
+            moments = {
+                i: superposition_functions.get_moments(
+                    self.structures[i].coordinates, self.superposition_parameters
+                )
+                for i in [index, *target_indices]
+            }
+        target_offsets = np.zeros(len(target_indices) + 1, dtype=np.int64)
+        target_offsets[1:] = np.cumsum(
+            [self.structures[i].length for i in target_indices]
+        )
+        target_moment_offsets = np.zeros(len(target_indices) + 1, dtype=np.int64)
+        target_moment_offsets[1:] = np.cumsum(
+            [moments[i].shape[0] for i in target_indices]
+        )
+        (
+            scores,
+            alignments_1,
+            alignments_2,
+            alignment_offsets,
+            superposed_coords,
+            superposed_target_coords,
+            iterations,
+        ) = get_pairwise_alignments_one_vs_many(
+            self.structures[index].coordinates,
+            moments[index],
+            np.concatenate([self.structures[i].coordinates for i in target_indices]),
+            target_offsets,
+            np.concatenate([moments[i] for i in target_indices]),
+            target_moment_offsets,
+            self.superposition_parameters["gamma"],
+            self.superposition_parameters["gamma_moment"],
+            self.superposition_parameters["gap_open_penalty"],
+            self.superposition_parameters["gap_extend_penalty"],
+            gap_open_penalty,
+            gap_extend_penalty,
+            n_iter,
+            self.superposition_parameters.get("band_width", 0),
+            self.superposition_parameters.get("low_memory", False),
+            self.superposition_parameters.get("min_score", 0.0),
+            self.superposition_parameters.get("coarse", 0),
+            self.superposition_parameters.get("float32", False),
+            self.superposition_parameters.get("tolerance", 0.0),
+            self.superposition_parameters.get("corridor", 0),
+        )
+        self._add_refinement_iterations(iterations, n_iter)
+        return [
+            (
+                alignments_1[alignment_offsets[t] : alignment_offsets[t + 1]],
+                alignments_2[alignment_offsets[t] : alignment_offsets[t + 1]],
+                scores[t],
+                superposed_coords[t],
+                superposed_target_coords[target_offsets[t] : target_offsets[t + 1]],
+            )
+            for t in range(len(target_indices))
+        ]
+
+    def _get_pairwise_alignment_key(
+        self,
+        index_1: int,
+        index_2: int,
+        gap_open_penalty: float,
+        gap_extend_penalty: float,
+        n_iter: int,
+    ) -> tuple:
+        """
+        Key of a pairwise alignment in pairwise_alignments.
+        Besides the pair and the DTW gap penalties, it has the superposition function and all superposition parameters
+        (gamma, superposition gap penalties, moment settings, ...), so that an alignment made with other settings isn't reused
+        """
+        return (
+            index_1,
+            index_2,
+            gap_open_penalty,
+            gap_extend_penalty,
+            n_iter,
+            self.superposition_function,
+            tuple(
+                sorted(
+                    (name, repr(value))
+                    for name, value in self.superposition_parameters.items()
+                )
+            ),
+        )
+
+    def _add_refinement_iterations(self, iterations, n_iter: int):
+        counts = np.bincount(np.asarray(iterations, dtype=np.int64), minlength=n_iter + 1)
+        # merges add their counts from several threads
+        with REFINEMENT_ITERATIONS_LOCK:
+            if self.refinement_iterations is None:
+                self.refinement_iterations = np.zeros(counts.shape[0], dtype=np.int64)
+            elif self.refinement_iterations.shape[0] < counts.shape[0]:
+                self.refinement_iterations = np.concatenate(
+                    (
+                        self.refinement_iterations,
+                        np.zeros(
+                            counts.shape[0] - self.refinement_iterations.shape[0],
+                            dtype=np.int64,
+                        ),
+                    )
+                )
+            self.refinement_iterations[: counts.shape[0]] += counts
+
+    def get_refinement_statistics(self) -> typing.Dict[int, int]:
+        """
+        How many refinement iterations reran DTW in the pairwise alignments made so far,
+        to tune n_iter, tolerance and corridor
+
+        Returns
+        -------
+        {number of iterations: number of pairwise alignments}
+        """
+        if self.refinement_iterations is None:
+            return {}
+        return {i: int(c) for i, c in enumerate(self.refinement_iterations) if c > 0}
+
+    def get_pairwise_score(
+        self, coords_1, coords_2, gap_open_penalty: float, gap_extend_penalty: float,
+    ) -> float:
+        """
+        Superposes coords_1 and coords_2 and returns their DTW score per residue of the shorter one,
+        without making the alignment or refining the superposition
+
+        Parameters
+        ----------
+        coords_1
+        coords_2
+        gap_open_penalty
+        gap_extend_penalty
+
+        Returns
+        -------
+        score
+        """
+        _, coords_1, coords_2 = self.superposition_function(
+            coords_1, coords_2, self.superposition_parameters
+        )
+        if self.superposition_parameters.get("float32", False):
+            coords_1, coords_2 = coords_1.astype(np.float32), coords_2.astype(np.float32)
+        return get_pairwise_score(
+            coords_1,
+            coords_2,
+            self.superposition_parameters["gamma"],
+            gap_open_penalty,
+            gap_extend_penalty,
+            True,
+        )
+
+    def make_shape_embedding(
         self,
         resolution: typing.Union[float, np.ndarray] = 2.0,
         parameters: dict = None,
-        metric="braycurtis",
-        verbose: bool = False,
     ):
         """
-        Makes an all vs. all matrix of distance scores between all the structures.
+        Makes a geometricus shape-mer embedding of each structure.
 
         Parameters
         ----------
@@ -484,26 +1759,22 @@ class StructureMultiple:
             num_split_types
             split_type_i
             split_size_i
-        metric
-            distance metric (accepts any metric supported by scipy.spatial.distance
-        verbose
         Returns
         -------
-        [n x n] distance matrix
+        [n x num_shapemers] embedding
         """
-        if verbose:
-            typer.echo("Calculating pairwise distances...")
         if parameters is None:
             parameters = dict(num_split_types=1, split_type_0="KMER", split_size_0=20)
         embedders = []
         for i in range(parameters["num_split_types"]):
             invariants = (
-                MomentInvariants.from_coordinates(
-                    s.name,
-                    s.coordinates,
-                    None,
-                    split_size=parameters[f"split_size_{i}"],
-                    split_type=SplitType[parameters[f"split_type_{i}"]],
+                replace(
+                    superposition_functions.get_moment_invariants(
+                        s.coordinates,
+                        split_type=parameters[f"split_type_{i}"],
+                        split_size=parameters[f"split_size_{i}"],
+                    ),
+                    name=s.name,
                 )
                 for s in self.structures
             )
@@ -514,23 +1785,116 @@ class StructureMultiple:
                     protein_keys=[s.name for s in self.structures],
                 )
             )
-        distance_matrix = squareform(
-            pdist(
-                np.hstack([embedder.embedding for embedder in embedders]),
-                metric=metric,
+        return np.hstack([embedder.embedding for embedder in embedders])
+
+    def make_pairwise_shape_matrix(
+        self,
+        resolution: typing.Union[float, np.ndarray] = 2.0,
+        parameters: dict = None,
+        metric="braycurtis",
+        verbose: bool = False,
+        block_size: int = 1024,
+        distance_file: typing.Union[None, str, Path] = None,
+    ):
+        """
+        Makes an all vs. all matrix of distance scores between all the structures.
+        Distances are computed in blocks of rows, without a condensed copy of the matrix.
+
+        Parameters
+        ----------
+        resolution
+        parameters
+            to use for making invariants (see make_shape_embedding)
+        metric
+            distance metric (accepts any metric supported by scipy.spatial.distance
+        verbose
+        block_size
+            number of rows computed at a time
+        distance_file
+            if given, the matrix is written to this file as a float32 np.memmap instead of kept in memory
+            (neighbor joining in align then reduces it in place)
+        Returns
+        -------
+        [n x n] distance matrix
+        """
+        if verbose:
+            typer.echo("Calculating pairwise distances...")
+        embedding = self.make_shape_embedding(resolution, parameters)
+        num_structures = embedding.shape[0]
+        if distance_file is None:
+            distance_matrix = np.zeros((num_structures, num_structures))
+        else:
+            distance_matrix = np.memmap(
+                distance_file,
+                dtype=np.float32,
+                mode="w+",
+                shape=(num_structures, num_structures),
             )
-        )
+        for start in range(0, num_structures, block_size):
+            end = min(start + block_size, num_structures)
+            # upper triangle of the block rows, mirrored to the block columns
+            block = cdist(embedding[start:end], embedding[start:], metric=metric)
+            block[:, : end - start][np.tril_indices(end - start)] = 0.0
+            block[:, : end - start] += block[:, : end - start].T
+            distance_matrix[start:end, start:] = block
+            distance_matrix[start:, start:end] = block.T
+        if distance_file is not None:
+            distance_matrix.flush()
         return distance_matrix
 
+    def make_knn_guide_tree(
+        self,
+        k: int = 10,
+        resolution: typing.Union[float, np.ndarray] = 2.0,
+        parameters: dict = None,
+        metric="braycurtis",
+        linkage="average",
+        verbose: bool = False,
+    ):
+        """
+        Makes a guide tree from the k nearest neighbours of each structure's shape embedding,
+        without an all vs. all distance matrix (memory scales with n * k instead of n * n).
+
+        Parameters
+        ----------
+        k
+            number of nearest neighbours of each structure
+        resolution
+        parameters
+            to use for making invariants (see make_shape_embedding)
+        metric
+            one of guide_tree.METRICS
+        linkage
+            "average" or "single" (minimum spanning tree)
+        verbose
+        Returns
+        -------
+        tree (node_1, node_2) pairs, branch_lengths corresponding to each tree pair
+        (same format as neighbor joining, see align)
+        """
+        if verbose:
+            typer.echo("Constructing nearest neighbour guide tree...")
+        return gt.knn_linkage(
+            self.make_shape_embedding(resolution, parameters),
+            k=k,
+            metric=metric,
+            linkage=linkage,
+        )
+
     def make_pairwise_dtw_matrix(
         self,
         gap_open_penalty: float,
         gap_extend_penalty: float,
         invert=True,
+        score_only=False,
+        keep_alignments=True,
         verbose: bool = False,
+        pairs: typing.Union[None, np.ndarray] = None,
     ):
         """
         Makes an all vs. all matrix of distance (or similarity) scores between all the structures using pairwise alignment.
+        With moment_svd_superpose_function, pairs are aligned in parallel, longest first
+        (see get_pairwise_distances, number of threads set with numba.set_num_threads)
 
         Parameters
         ----------
@@ -539,7 +1903,17 @@ class StructureMultiple:
         invert
             if True returns distance matrix
             if False returns similarity matrix
+        score_only
+            if True uses the DTW score of each superposed pair (see get_pairwise_score)
+            instead of refining the alignment and scoring its aligned positions (faster)
+        keep_alignments
+            if True (and not score_only) keeps each pair's alignment in pairwise_alignments,
+            so that align doesn't redo it when the pair is merged
+            (skipped if they would take more than PAIRWISE_ALIGNMENT_MEMORY bytes)
         verbose
+        pairs
+            (index_1, index_2) pairs with index_1 < index_2 to align, the rest of the matrix is 0
+            default all pairs
         Returns
         -------
         [n x n] matrix
@@ -547,25 +1921,116 @@ class StructureMultiple:
         if verbose:
             typer.echo("Calculating pairwise distances...")
         pairwise_matrix = np.zeros((len(self.structures), len(self.structures)))
-        for i in range(pairwise_matrix.shape[0] - 1):
-            for j in range(i + 1, pairwise_matrix.shape[1]):
-                coords_1, coords_2 = (
-                    self.structures[i].coordinates,
-                    self.structures[j].coordinates,
+        lengths = np.array([s.length for s in self.structures], dtype=np.int64)
+        if pairs is None:
+            pairs = np.array(np.triu_indices(len(self.structures), 1)).T
+        # longest pairs first, so that threads finish at about the same time
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        pairs = pairs[
+            np.argsort(-lengths[pairs[:, 0]] * lengths[pairs[:, 1]], kind="stable")
+        ]
+        # alignments (2 x int64) and superposed coordinates (3 x float64) of each residue of each pair
+        keep_alignments = (
+            keep_alignments
+            and not score_only
+            and int((lengths[pairs[:, 0]] + lengths[pairs[:, 1]]).sum()) * 40
+            <= PAIRWISE_ALIGNMENT_MEMORY
+        )
+        self.pairwise_alignments = {} if keep_alignments else None
+        if (
+            self.superposition_function
+            is superposition_functions.moment_svd_superpose_function
+        ):
+            moments = [
+                superposition_functions.get_moments(
+                    structure.coordinates, self.superposition_parameters
                 )
+                for structure in self.structures
+            ]
+            offsets = np.zeros(len(self.structures) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([s.length for s in self.structures])
+            moment_offsets = np.zeros(len(self.structures) + 1, dtype=np.int64)
+            moment_offsets[1:] = np.cumsum([m.shape[0] for m in moments])
+            chunk_size = nb.set_parallel_chunksize(1)
+            try:
                 (
-                    dtw_aln_1,
-                    dtw_aln_2,
-                    score,
-                    coords_1,
-                    coords_2,
-                ) = self.get_pairwise_alignment(
+                    scores,
+                    dtw_scores,
+                    alignments_1,
+                    alignments_2,
+                    alignment_offsets,
+                    superposed_coords,
+                    coord_offsets,
+                    iterations,
+                ) = get_pairwise_distances(
+                    np.concatenate([s.coordinates for s in self.structures]),
+                    offsets,
+                    np.concatenate(moments),
+                    moment_offsets,
+                    pairs,
+                    self.superposition_parameters["gamma"],
+                    self.superposition_parameters["gamma_moment"],
+                    self.superposition_parameters["gap_open_penalty"],
+                    self.superposition_parameters["gap_extend_penalty"],
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                    3,
+                    self.superposition_parameters.get("band_width", 0),
+                    self.superposition_parameters.get("low_memory", False),
+                    self.superposition_parameters.get("min_score", 0.0),
+                    score_only,
+                    keep_alignments,
+                    self.superposition_parameters.get("coarse", 0),
+                    self.superposition_parameters.get("float32", False),
+                    self.superposition_parameters.get("tolerance", 0.0),
+                    self.superposition_parameters.get("corridor", 0),
+                )
+            finally:
+                nb.set_parallel_chunksize(chunk_size)
+            if not score_only:
+                self._add_refinement_iterations(iterations, 3)
+            if keep_alignments:
+                for p, (i, j) in enumerate(pairs):
+                    start, middle = coord_offsets[p], coord_offsets[p] + lengths[i]
+                    self.pairwise_alignments[
+                        self._get_pairwise_alignment_key(
+                            int(i), int(j), gap_open_penalty, gap_extend_penalty, 3
+                        )
+                    ] = (
+                        alignments_1[alignment_offsets[p] : alignment_offsets[p + 1]],
+                        alignments_2[alignment_offsets[p] : alignment_offsets[p + 1]],
+                        dtw_scores[p],
+                        superposed_coords[start:middle],
+                        superposed_coords[middle : coord_offsets[p + 1]],
+                    )
+            pairwise_matrix[pairs[:, 0], pairs[:, 1]] = scores
+            if invert:
+                pairwise_matrix *= -1
+            return pairwise_matrix + pairwise_matrix.T
+        for i, j in pairs.tolist():
+            coords_1, coords_2 = (
+                self.structures[i].coordinates,
+                self.structures[j].coordinates,
+            )
+            if score_only:
+                pairwise_matrix[i, j] = self.get_pairwise_score(
+                    coords_1, coords_2, gap_open_penalty, gap_extend_penalty
+                )
+            else:
+                pairwise_alignment = self.get_pairwise_alignment(
                     coords_1,
                     coords_2,
                     gap_open_penalty=gap_open_penalty,
                     gap_extend_penalty=gap_extend_penalty,
                     weight=False,
                 )
+                if keep_alignments:
+                    self.pairwise_alignments[
+                        self._get_pairwise_alignment_key(
+                            i, j, gap_open_penalty, gap_extend_penalty, 3
+                        )
+                    ] = pairwise_alignment
+                dtw_aln_1, dtw_aln_2, _, coords_1, coords_2 = pairwise_alignment
                 common_coords_1, common_coords_2 = get_common_coordinates(
                     coords_1, coords_2, dtw_aln_1, dtw_aln_2
                 )
@@ -576,32 +2041,120 @@ class StructureMultiple:
                     self.superposition_parameters["gamma"],
                     True,
                 )
-                if invert:
-                    pairwise_matrix[i, j] *= -1
+            if invert:
+                pairwise_matrix[i, j] *= -1
         pairwise_matrix += pairwise_matrix.T
         return pairwise_matrix
 
+    def make_pairwise_sparse_dtw_matrix(
+        self,
+        gap_open_penalty: float,
+        gap_extend_penalty: float,
+        k: int = 10,
+        resolution: typing.Union[float, np.ndarray] = 2.0,
+        parameters: dict = None,
+        metric="braycurtis",
+        score_only=False,
+        keep_alignments=True,
+        verbose: bool = False,
+    ):
+        """
+        Makes an all vs. all distance matrix aligning each structure only to the k nearest neighbours of its shape embedding
+        (as make_pairwise_dtw_matrix, about n * k alignments instead of n * n / 2).
+        The other distances are shape distances calibrated to the aligned ones by a linear fit.
+
+        Parameters
+        ----------
+        gap_open_penalty
+        gap_extend_penalty
+        k
+            number of nearest neighbours of each structure to align it to
+        resolution
+        parameters
+            to use for making invariants (see make_shape_embedding)
+        metric
+            one of guide_tree.METRICS
+        score_only
+        keep_alignments
+            see make_pairwise_dtw_matrix
+        verbose
+        Returns
+        -------
+        [n x n] distance matrix
+        """
+        embedding = self.make_shape_embedding(resolution, parameters)
+        neighbours, _ = gt.get_nearest_neighbours(embedding, k, metric)
+        pairs = np.array(
+            sorted(
+                {
+                    (min(i, j), max(i, j))
+                    for i in range(neighbours.shape[0])
+                    for j in neighbours[i].tolist()
+                    if j != -1
+                }
+            ),
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        if verbose:
+            typer.echo(f"Aligning {pairs.shape[0]} nearest neighbour pairs...")
+        dtw_matrix = self.make_pairwise_dtw_matrix(
+            gap_open_penalty,
+            gap_extend_penalty,
+            invert=True,
+            score_only=score_only,
+            keep_alignments=keep_alignments,
+            verbose=verbose,
+            pairs=pairs,
+        )
+        distance_matrix = cdist(embedding, embedding, metric=metric)
+        shape_distances = distance_matrix[pairs[:, 0], pairs[:, 1]]
+        dtw_distances = dtw_matrix[pairs[:, 0], pairs[:, 1]]
+        if np.ptp(shape_distances) > 0:
+            slope, intercept = np.polyfit(shape_distances, dtw_distances, 1)
+        else:
+            slope, intercept = 0.0, 0.0
+        if slope > 0:
+            distance_matrix *= slope
+            distance_matrix += intercept
+        else:
+            # shape distances don't predict aligned ones, pairs that weren't aligned are the furthest apart
+            distance_matrix[:] = dtw_distances.max()
+        distance_matrix[pairs[:, 0], pairs[:, 1]] = dtw_distances
+        distance_matrix[pairs[:, 1], pairs[:, 0]] = dtw_distances
+        np.fill_diagonal(distance_matrix, 0.0)
+        return distance_matrix
+
     def align(
         self,
         pw_matrix,
         gap_open_penalty,
         gap_extend_penalty,
         return_sequence: bool = True,
+        num_threads: int = 1,
         verbose: bool = False,
+        guide_tree: typing.Union[
+            None, typing.Tuple[np.ndarray, np.ndarray]
+        ] = None,
     ) -> dict:
         """
         Makes a multiple structure alignment
+        Merges of the guide tree whose nodes are both available run concurrently on num_threads threads
 
         Parameters
         ----------
         pw_matrix
             pairwise similarity matrix to base the neighbor joining tree on
+            (None if guide_tree is given, a np.memmap is reduced in place instead of copied)
         gap_open_penalty
         gap_extend_penalty
         return_sequence
             if True returns sequence alignment
             else indices of aligning residues with gaps as -1s
+        num_threads
+            number of merges to run at a time
         verbose
+        guide_tree
+            (tree, branch_lengths) to use instead of a neighbor joining tree (e.g. from make_knn_guide_tree)
         Returns
         -------
         alignment = {name: indices of aligning residues with gaps as -1s}
@@ -624,18 +2177,35 @@ class StructureMultiple:
                 self.structures[0].name: dtw_1,
                 self.structures[1].name: dtw_2,
             }
+            self.alignment_matrix = np.array([dtw_1, dtw_2], dtype=np.int32)
             if return_sequence:
                 return self.make_sequence_alignment()
             else:
                 return self.alignment
-        assert pw_matrix is not None
-        assert pw_matrix.shape[0] == len(self.structures)
-        if verbose:
-            typer.echo("Constructing neighbor joining tree...")
-        tree, branch_lengths = nj.neighbor_joining(pw_matrix)
+        if guide_tree is not None:
+            tree, branch_lengths = guide_tree
+            assert tree.shape[0] == 2 * len(self.structures) - 3
+        else:
+            assert pw_matrix is not None
+            assert pw_matrix.shape[0] == len(self.structures)
+            if verbose:
+                typer.echo("Constructing neighbor joining tree...")
+            tree, branch_lengths = nj.neighbor_joining(
+                pw_matrix, overwrite=isinstance(pw_matrix, np.memmap)
+            )
         self.tree = tree
         self.branch_lengths = branch_lengths
-        self.final_structures = [s for s in self.structures]
+        # (node_1, node_2, node_int) for each merge, the last one makes the final node
+        merges = [
+            (int(self.tree[x, 0]), int(self.tree[x + 1, 0]), int(self.tree[x, 1]))
+            for x in range(0, self.tree.shape[0] - 1, 2)
+        ]
+        for x in range(0, self.tree.shape[0] - 1, 2):
+            assert self.tree[x + 1, 1] == self.tree[x, 1]
+        final_node = len(self.structures) + len(merges)
+        merges.append((int(self.tree[-1, 0]), int(self.tree[-1, 1]), final_node))
+        # indexed by node, filled in as merges finish
+        self.final_structures = [s for s in self.structures] + [None] * len(merges)
         self.final_consensus_weights = [
             np.full(
                 (self.structures[i].coordinates.shape[0], 1),
@@ -643,104 +2213,112 @@ class StructureMultiple:
                 dtype=np.float64,
             )
             for i in range(len(self.structures))
-        ]
-        msa_alignments = {
-            s.name: {s.name: np.arange(s.length)} for s in self.final_structures
-        }
+        ] + [None] * len(merges)
+        # structures in each node and their alignment to the node, as a [members x node length] matrix
+        node_members = [np.array([i]) for i in range(len(self.structures))] + [
+            None
+        ] * len(merges)
+        node_alignments = [
+            np.arange(s.length, dtype=np.int32).reshape(1, -1) for s in self.structures
+        ] + [None] * len(merges)
 
         def make_intermediate_node(n1, n2, n_int):
-            name_1, name_2 = (
-                self.final_structures[n1].name,
-                self.final_structures[n2].name,
-            )
-            name_int = f"int-{n_int}"
+            num_1, num_2 = node_members[n1].shape[0], node_members[n2].shape[0]
+            name_int = "int-final" if n_int == final_node else f"int-{n_int}"
             n1_coords = self.final_structures[n1].coordinates
             n1_weights = self.final_consensus_weights[n1]
-            n1_weights *= len(msa_alignments[name_2])
-            n1_weights /= 2 * (
-                len(msa_alignments[name_2]) + len(msa_alignments[name_1])
-            )
+            n1_weights *= num_2
+            n1_weights /= 2 * (num_2 + num_1)
             n2_coords = self.final_structures[n2].coordinates
             n2_weights = self.final_consensus_weights[n2]
-            n2_weights *= len(msa_alignments[name_1])
-            n2_weights /= 2 * (
-                len(msa_alignments[name_2]) + len(msa_alignments[name_1])
-            )
-            (
-                dtw_aln_1,
-                dtw_aln_2,
-                score,
-                n1_coords,
-                n2_coords,
-            ) = self.get_pairwise_alignment(
-                n1_coords,
-                n2_coords,
-                gap_open_penalty=gap_open_penalty,
-                gap_extend_penalty=gap_extend_penalty,
-                weight=True,
-                weights_1=n1_weights,
-                weights_2=n2_weights,
-                n_iter=self.superposition_parameters["n_iter"],
-            )
-            n1_weights *= (
-                2
-                * (len(msa_alignments[name_2]) + len(msa_alignments[name_1]))
-                / len(msa_alignments[name_2])
-            )
-            n2_weights *= (
-                2
-                * (len(msa_alignments[name_2]) + len(msa_alignments[name_1]))
-                / len(msa_alignments[name_1])
+            n2_weights *= num_1
+            n2_weights /= 2 * (num_2 + num_1)
+            pairwise_alignment = None
+            if (
+                self.pairwise_alignments is not None
+                and n1 < len(self.structures)
+                and n2 < len(self.structures)
+            ):
+                # two structures with equal weights align as in make_pairwise_dtw_matrix
+                key_1, key_2 = (
+                    self._get_pairwise_alignment_key(
+                        x,
+                        y,
+                        gap_open_penalty,
+                        gap_extend_penalty,
+                        self.superposition_parameters["n_iter"],
+                    )
+                    for x, y in ((n1, n2), (n2, n1))
+                )
+                if key_1 in self.pairwise_alignments:
+                    pairwise_alignment = self.pairwise_alignments[key_1]
+                elif key_2 in self.pairwise_alignments:
+                    aln_2, aln_1, score, coords_2, coords_1 = self.pairwise_alignments[
+                        key_2
+                    ]
+                    pairwise_alignment = aln_1, aln_2, score, coords_1, coords_2
+            if pairwise_alignment is None:
+                pairwise_alignment = self.get_pairwise_alignment(
+                    n1_coords,
+                    n2_coords,
+                    gap_open_penalty=gap_open_penalty,
+                    gap_extend_penalty=gap_extend_penalty,
+                    weight=True,
+                    weights_1=n1_weights,
+                    weights_2=n2_weights,
+                    n_iter=self.superposition_parameters["n_iter"],
+                )
+            dtw_aln_1, dtw_aln_2, score, n1_coords, n2_coords = pairwise_alignment
+            n1_weights *= 2 * (num_2 + num_1) / num_2
+            n2_weights *= 2 * (num_2 + num_1) / num_1
+            node_members[n_int] = np.concatenate((node_members[n1], node_members[n2]))
+            node_alignments[n_int] = np.vstack(
+                (
+                    _remap_alignment(node_alignments[n1], dtw_aln_1),
+                    _remap_alignment(node_alignments[n2], dtw_aln_2),
+                )
             )
-            msa_alignments[name_1] = {
-                name: np.array([sequence[i] if i != -1 else -1 for i in dtw_aln_1])
-                for name, sequence in msa_alignments[name_1].items()
-            }
-            msa_alignments[name_2] = {
-                name: np.array([sequence[i] if i != -1 else -1 for i in dtw_aln_2])
-                for name, sequence in msa_alignments[name_2].items()
-            }
-            msa_alignments[name_int] = {
-                **msa_alignments[name_1],
-                **msa_alignments[name_2],
-            }
 
-            mean_coords = self.mean_function(dtw_aln_1, n1_coords, dtw_aln_2, n2_coords)
-            mean_weights = get_mean_weights(
-                n1_weights, n2_weights, dtw_aln_1, dtw_aln_2
-            )
-            self.final_structures.append(
-                Structure(name_int, mean_coords.shape[0], mean_coords)
+            if self.mean_function is get_mean_coords:
+                mean_coords, mean_weights = get_mean_coords_weights(
+                    dtw_aln_1,
+                    n1_coords,
+                    n1_weights.reshape(-1),
+                    dtw_aln_2,
+                    n2_coords,
+                    n2_weights.reshape(-1),
+                    num_1 / (num_1 + num_2) if self.weighted_consensus else 0.5,
+                )
+            else:
+                mean_coords = self.mean_function(
+                    dtw_aln_1, n1_coords, dtw_aln_2, n2_coords
+                )
+                mean_weights = get_mean_weights(
+                    n1_weights, n2_weights, dtw_aln_1, dtw_aln_2
+                )
+            self.final_structures[n_int] = Structure(
+                name_int, mean_coords.shape[0], mean_coords
             )
-            self.final_consensus_weights.append(mean_weights)
+            self.final_consensus_weights[n_int] = mean_weights
 
         if verbose:
-            with typer.progressbar(
-                range(0, self.tree.shape[0] - 1, 2), label="Aligning"
-            ) as progress:
-                for x in progress:
-                    node_1, node_2, node_int = (
-                        self.tree[x, 0],
-                        self.tree[x + 1, 0],
-                        self.tree[x, 1],
-                    )
-                    assert self.tree[x + 1, 1] == node_int
-                    make_intermediate_node(node_1, node_2, node_int)
-        else:
-            for x in range(0, self.tree.shape[0] - 1, 2):
-                node_1, node_2, node_int = (
-                    self.tree[x, 0],
-                    self.tree[x + 1, 0],
-                    self.tree[x, 1],
+            with typer.progressbar(length=len(merges), label="Aligning") as progress:
+                run_merges(
+                    merges,
+                    make_intermediate_node,
+                    num_threads,
+                    on_merge=lambda: progress.update(1),
                 )
-                assert self.tree[x + 1, 1] == node_int
-                make_intermediate_node(node_1, node_2, node_int)
+        else:
+            run_merges(merges, make_intermediate_node, num_threads)
 
-        node_1, node_2 = self.tree[-1, 0], self.tree[-1, 1]
-        make_intermediate_node(node_1, node_2, "final")
+        # only needed for the merges, and large
+        self.pairwise_alignments = None
+        members = node_members[final_node]
+        self.alignment_matrix = node_alignments[final_node][np.argsort(members)]
+        # in guide tree order
         alignment = {
-            **msa_alignments[self.final_structures[node_1].name],
-            **msa_alignments[self.final_structures[node_2].name],
+            self.structures[i].name: self.alignment_matrix[i] for i in members
         }
         self.alignment = alignment
         if return_sequence:
@@ -748,15 +2326,27 @@ class StructureMultiple:
         else:
             return alignment
 
+    def get_alignment_matrix(self, alignments: dict = None) -> np.ndarray:
+        """
+        Alignment as an int32 [num_structures x alignment length] matrix, rows in the order of structures
+
+        Parameters
+        ----------
+        alignments
+            if None uses self.alignment_matrix (or self.alignment)
+        """
+        if alignments is None:
+            if self.alignment_matrix is not None:
+                return self.alignment_matrix
+            alignments = self.alignment
+        return np.array([alignments[s.name] for s in self.structures], dtype=np.int32)
+
     def make_sequence_alignment(self, alignment=None):
-        sequence_alignment = {}
-        if alignment is None:
-            alignment = self.alignment
-        for s in self.structures:
-            sequence_alignment[s.name] = "".join(
-                self.sequences[s.name][i] if i != -1 else "-" for i in alignment[s.name]
-            )
-        return sequence_alignment
+        alignment_matrix = self.get_alignment_matrix(alignment)
+        return {
+            s.name: _get_aligned_sequence(self.sequences[s.name], alignment_matrix[i])
+            for i, s in enumerate(self.structures)
+        }
 
     def write_files(
         self,
@@ -817,9 +2407,7 @@ class StructureMultiple:
             alignments = self.alignment
         with open(filename, "w") as f:
             for key in alignments:
-                sequence = "".join(
-                    self.sequences[key][n] if n != -1 else "-" for n in alignments[key]
-                )
+                sequence = _get_aligned_sequence(self.sequences[key], alignments[key])
                 f.write(f">{key}\n{sequence}\n")
 
     def write_superposed_pdbs(self, output_pdb_folder, alignments: dict = None):
@@ -832,8 +2420,7 @@ class StructureMultiple:
         alignments
         output_pdb_folder
         """
-        if alignments is None:
-            alignments = self.alignment
+        alignment_matrix = self.get_alignment_matrix(alignments)
         output_pdb_folder = Path(output_pdb_folder)
         if not output_pdb_folder.exists():
             output_pdb_folder.mkdir()
@@ -841,18 +2428,11 @@ class StructureMultiple:
         reference_pdb = pd.parsePDB(
             str(self.output_folder / f"cleaned_pdb/{self.structures[0].name}.pdb")
         )
-        core_indices = np.array(
-            [
-                i
-                for i in range(len(alignments[reference_name]))
-                if -1 not in [alignments[n][i] for n in alignments]
-            ]
-        )
-        aln_ref = alignments[reference_name]
+        core_indices = np.where(np.all(alignment_matrix != -1, axis=0))[0]
         ref_coords_core = (
             reference_pdb[helper.get_alpha_indices(reference_pdb)]
             .getCoords()
-            .astype(np.float64)[np.array([aln_ref[c] for c in core_indices])]
+            .astype(np.float64)[alignment_matrix[0, core_indices]]
         )
         ref_centroid = helper.nb_mean_axis_0(ref_coords_core)
         ref_coords_core -= ref_centroid
@@ -864,11 +2444,10 @@ class StructureMultiple:
             pdb = pd.parsePDB(
                 str(self.output_folder / f"cleaned_pdb/{self.structures[i].name}.pdb")
             )
-            aln_name = alignments[name]
             common_coords_2 = (
                 pdb[helper.get_alpha_indices(pdb)]
                 .getCoords()
-                .astype(np.float64)[np.array([aln_name[c] for c in core_indices])]
+                .astype(np.float64)[alignment_matrix[i, core_indices]]
             )
             (
                 rotation_matrix,
@@ -885,9 +2464,24 @@ class StructureMultiple:
     ) -> typing.Dict[str, np.ndarray]:
         """
         Get dict of aligned features
+
+        Parameters
+        ----------
+        dssp_dir
+        num_threads
+        alignment
+            sequence alignment, if None uses self.alignment_matrix
+        only_dssp
         """
         if alignment is None:
-            alignment = self.make_sequence_alignment()
+            is_aligned = self.get_alignment_matrix() != -1
+        else:
+            is_aligned = np.array(
+                [
+                    np.frombuffer(alignment[s.name].encode(), dtype=np.uint8) != ord("-")
+                    for s in self.structures
+                ]
+            )
 
         pdb_files = [
             self.output_folder / "cleaned_pdb" / f"{s.name}.pdb"
@@ -902,7 +2496,7 @@ class StructureMultiple:
         )
         feature_names = list(features[0].keys())
         aligned_features = {}
-        alignment_length = len(alignment[self.structures[0].name])
+        alignment_length = is_aligned.shape[1]
         for feature_name in feature_names:
             if feature_name == "secondary":
                 continue
@@ -914,12 +2508,7 @@ class StructureMultiple:
                 farray = features[p][feature_name]
                 if "gnm" in feature_name or "anm" in feature_name:
                     farray = farray / np.nansum(farray ** 2) ** 0.5
-                indices = [
-                    i
-                    for i in range(alignment_length)
-                    if alignment[self.structures[p].name][i] != "-"
-                ]
-                aligned_features[feature_name][p, indices] = farray
+                aligned_features[feature_name][p, is_aligned[p]] = farray
         return aligned_features
 
     def superpose(self, alignments: dict = None):
@@ -962,7 +2551,7 @@ class StructureMultiple:
         self, alignments: dict = None, superpose_first: bool = True
     ):
         """
-        Find RMSDs and coverages of the alignment of each pair of sequences
+        Find RMSDs, coverages and TM-scores of the alignment of each pair of sequences (pairs computed in parallel)
 
         Parameters
         ----------
@@ -973,50 +2562,25 @@ class StructureMultiple:
 
         Returns
         -------
-        RMSD matrix, coverage matrix
+        RMSD matrix, coverage matrix, TM-score matrix
         """
         if alignments is None:
             alignments = self.alignment
-        num = len(self.structures)
-        pairwise_rmsd_matrix = np.zeros((num, num))
-        pairwise_rmsd_matrix[:] = np.nan
-        pairwise_coverage = np.zeros((num, num))
-        pairwise_coverage[:] = np.nan
-        pairwise_tm = np.zeros((num, num))
-        pairwise_tm[:] = np.nan
         if superpose_first:
             self.superpose(alignments)
-        for i in range(num - 1):
-            for j in range(i + 1, num):
-                name_1, name_2 = self.structures[i].name, self.structures[j].name
-                aln_1 = alignments[name_1]
-                aln_2 = alignments[name_2]
-                common_coords_1, common_coords_2 = get_common_coordinates(
-                    self.structures[i].coordinates,
-                    self.structures[j].coordinates,
-                    aln_1,
-                    aln_2,
-                )
-                assert common_coords_1.shape[0] > 0
-                if not superpose_first:
-                    rot, tran = superposition_functions.paired_svd_superpose(
-                        common_coords_1, common_coords_2
-                    )
-                    common_coords_2 = superposition_functions.apply_rotran(
-                        common_coords_2, rot, tran
-                    )
-                pairwise_rmsd_matrix[i, j] = pairwise_rmsd_matrix[
-                    j, i
-                ] = score_functions.get_rmsd(common_coords_1, common_coords_2)
-                pairwise_coverage[i, j] = pairwise_coverage[
-                    j, i
-                ] = common_coords_1.shape[0] / len(aln_1)
-                pairwise_tm[i, j] = pairwise_tm[j, i] = tm_score(
-                    common_coords_1,
-                    common_coords_2,
-                    self.structures[i].length,
-                    self.structures[j].length,
-                )
+        offsets = np.zeros(len(self.structures) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([s.length for s in self.structures])
+        (
+            pairwise_rmsd_matrix,
+            pairwise_coverage,
+            pairwise_tm,
+        ) = get_rmsd_coverage_tm_matrices(
+            np.concatenate([s.coordinates for s in self.structures]).astype(np.float64),
+            offsets,
+            np.array([alignments[s.name] for s in self.structures], dtype=np.int64),
+            not superpose_first,
+        )
+        assert np.all(pairwise_coverage[np.triu_indices(len(self.structures), 1)] > 0)
         return pairwise_rmsd_matrix, pairwise_coverage, pairwise_tm
 
 
@@ -1036,7 +2600,19 @@ def trigger_numba_compilation():
     weights_1 = np.zeros((coords_1.shape[0], 1))
     weights_2 = np.zeros((coords_2.shape[0], 1))
     get_pairwise_alignment(
-        coords_1, coords_2, parameters["gamma"], 0, 0, weights_1, weights_2
+        coords_1,
+        coords_2,
+        parameters["gamma"],
+        0,
+        0,
+        weights_1,
+        weights_2,
+        3,
+        0,
+        False,
+        0.0,
+        False,
+        0,
     )
     superposition_functions.signal_svd_superpose_function(
         coords_1, coords_2, parameters
@@ -1046,4 +2622,14 @@ def trigger_numba_compilation():
     aln_1 = np.array([0, -1, 1])
     aln_2 = np.array([0, 1, -1])
     get_common_coordinates(coords_1, coords_2, aln_1, aln_2)
+    get_pairwise_score(coords_1, coords_2, parameters["gamma"], 0, 0, True)
     get_mean_coords(aln_1, coords_1, aln_2, coords_2)
+    get_mean_coords_weights(
+        aln_1,
+        coords_1,
+        np.ones(coords_1.shape[0]),
+        aln_2,
+        coords_2,
+        np.ones(coords_2.shape[0]),
+        0.5,
+    )
@@ -11,11 +11,18 @@ import numpy as np
 #     3. Calculate the distance from each of the taxa in the pair to this new node (branch lengths).
 #     4. Calculate the distance from each of the taxa outside of this pair to the new node.
 #     5. Start the algorithm again, replacing the pair of joined neighbors with the new node and using the distances calculated in the previous step.
+#
+# The distance matrix is reduced in place: the new node takes the row of one joined node
+# and the last row is moved into the row of the other one.
+# Row sums of the distance matrix are updated with each join instead of being recomputed for each Q value.
+# Ties are broken as if nodes were ordered newest intermediate node first, then leaves in order.
 
 
 @nb.njit
 # @numba_cc.export('neighbor_joining', '(f64[:])')
-def neighbor_joining(distance_matrix: np.ndarray) -> (np.ndarray, np.ndarray):
+def neighbor_joining(
+    distance_matrix: np.ndarray, prune: bool = False, overwrite: bool = False
+) -> (np.ndarray, np.ndarray):
     """
     Runs the neighbor joining algorithm on a distance matrix
     Returns guide tree as adjacency list + branch lengths
@@ -23,6 +30,12 @@ def neighbor_joining(distance_matrix: np.ndarray) -> (np.ndarray, np.ndarray):
     Parameters
     ----------
     distance_matrix
+    prune
+        if True, keeps each node's neighbours sorted by distance and stops searching a node's neighbours
+        once their Q values can no longer be lower than the best one found (as in RapidNJ)
+        needs another half of the memory of the distance matrix, same tree
+    overwrite
+        if True, reduces distance_matrix in place instead of a copy (e.g. for a np.memmap)
 
     Returns
     -------
@@ -31,126 +44,388 @@ def neighbor_joining(distance_matrix: np.ndarray) -> (np.ndarray, np.ndarray):
     (node indices above length of the distance_matrix correspond to intermediate nodes)
     """
     length = n = distance_matrix.shape[0]
-    tree = np.zeros((length ** 2, 2), dtype=np.uint64)
-    branch_lengths = np.zeros((length ** 2, 1), dtype=np.float64)
+    tree = np.zeros((2 * length - 3, 2), dtype=np.uint64)
+    branch_lengths = np.zeros((2 * length - 3, 1), dtype=np.float64)
     index = 0
-    true_indices = np.array(list(range(length)))
+    if not overwrite:
+        distance_matrix = distance_matrix.copy()
+    # node at each row of the distance matrix, its tie-breaking rank and its row sum
+    nodes = np.arange(length)
+    ranks = np.zeros(length, dtype=np.int64)
+    row_sums = np.zeros(length, dtype=np.float64)
+    for i in range(length):
+        ranks[i] = _get_rank(i, length)
+    _set_row_sums(distance_matrix, ranks, n, row_sums)
+    if prune:
+        # row of each node in the distance matrix, -1 once joined
+        node_rows = np.full(2 * length - 2, -1, dtype=np.int64)
+        node_rows[:length] = np.arange(length)
+        sorted_nodes = np.zeros((length, length), dtype=np.int32)
+        sorted_starts = np.zeros(length, dtype=np.int64)
+        sorted_lengths = np.zeros(length, dtype=np.int64)
+        for i in range(length):
+            _sort_neighbours(
+                distance_matrix, nodes, i, n, sorted_nodes, sorted_starts, sorted_lengths
+            )
     num_intermediate_nodes = 0
+    new_distances = np.zeros(length, dtype=np.float64)
     while n > 3:
-        # indices of nodes to be joined (according to the current distance_matrix, not the initial one!)
-        min_ij = _find_join_nodes(distance_matrix)
+        # rows of nodes to be joined (step 1 & 2)
+        if n == 4:
+            # both ways of splitting the last 4 nodes have the same Q value
+            i, j = _find_join_rows_exact(distance_matrix, ranks, n)
+        elif prune:
+            i, j = _find_join_rows_pruned(
+                distance_matrix,
+                row_sums,
+                ranks,
+                n,
+                sorted_nodes,
+                sorted_starts,
+                sorted_lengths,
+                node_rows,
+            )
+        else:
+            i, j = _find_join_rows(distance_matrix, row_sums, ranks, n)
+        # which node comes first and branch lengths use exact row sums, as in the original algorithm
+        row_sum_i = _get_row_sum(distance_matrix, ranks, n, i)
+        row_sum_j = _get_row_sum(distance_matrix, ranks, n, j)
+        if (n - 2) * distance_matrix[j, i] - row_sum_j - row_sum_i < (
+            n - 2
+        ) * distance_matrix[i, j] - row_sum_i - row_sum_j:
+            i, j, row_sum_i, row_sum_j = j, i, row_sum_j, row_sum_i
         # branch lengths of each node being joined to the new node created after they are joined
-        delta_ij_u = _find_branch_length(distance_matrix, min_ij[0], min_ij[1])
+        delta_ij_u = _find_branch_length(distance_matrix, n, i, j, row_sum_i, row_sum_j)
 
         # make an intermediate node
         intermediate_node = num_intermediate_nodes + length
         num_intermediate_nodes += 1
 
         # add to tree
-        tree[index] = np.array((true_indices[min_ij[0]], intermediate_node))
+        tree[index, 0], tree[index, 1] = nodes[i], intermediate_node
         branch_lengths[index] = delta_ij_u[0]
         index += 1
-        tree[index] = np.array((true_indices[min_ij[1]], intermediate_node))
+        tree[index, 0], tree[index, 1] = nodes[j], intermediate_node
         branch_lengths[index] = delta_ij_u[1]
         index += 1
 
-        # Distances of remaining indices to newly created node (step 4)
-        indices = np.array([i for i in range(n) if i != min_ij[0] and i != min_ij[1]])
-        new_distance_matrix = np.zeros((n - 1, n - 1))
-        new_distance_matrix[1:, 1:] = distance_matrix[indices, :][:, indices]
-        for i in range(len(indices)):
-            new_distance_matrix[0, i + 1] = new_distance_matrix[i + 1, 0] = 0.5 * (
-                distance_matrix[min_ij[0], indices[i]]
-                + distance_matrix[min_ij[1], indices[i]]
-                - distance_matrix[min_ij[0], min_ij[1]]
+        # Distances of remaining nodes to newly created node (step 4)
+        for k in range(n):
+            if k != i and k != j:
+                new_distances[k] = 0.5 * (
+                    distance_matrix[i, k] + distance_matrix[j, k] - distance_matrix[i, j]
+                )
+                row_sums[k] += (
+                    new_distances[k] - distance_matrix[i, k] - distance_matrix[j, k]
+                )
+        new_row, old_row = min(i, j), max(i, j)
+        if prune:
+            node_rows[nodes[i]] = node_rows[nodes[j]] = -1
+        # new node takes the row of one joined node
+        row_sums[new_row] = 0.0
+        for k in range(n):
+            if k != i and k != j:
+                distance_matrix[new_row, k] = distance_matrix[k, new_row] = new_distances[k]
+                row_sums[new_row] += new_distances[k]
+        distance_matrix[new_row, new_row] = 0.0
+        nodes[new_row] = intermediate_node
+        ranks[new_row] = _get_rank(intermediate_node, length)
+        # last row takes the row of the other one
+        n -= 1
+        if old_row != n:
+            for k in range(n):
+                distance_matrix[old_row, k] = distance_matrix[k, old_row] = distance_matrix[n, k]
+            distance_matrix[old_row, old_row] = 0.0
+            nodes[old_row], ranks[old_row], row_sums[old_row] = (
+                nodes[n],
+                ranks[n],
+                row_sums[n],
+            )
+            if prune:
+                sorted_lengths[old_row] = sorted_lengths[n] - sorted_starts[n]
+                sorted_nodes[old_row, : sorted_lengths[old_row]] = sorted_nodes[
+                    n, sorted_starts[n] : sorted_lengths[n]
+                ]
+                sorted_starts[old_row] = 0
+                node_rows[nodes[old_row]] = old_row
+        if prune:
+            node_rows[intermediate_node] = new_row
+            _sort_neighbours(
+                distance_matrix,
+                nodes,
+                new_row,
+                n,
+                sorted_nodes,
+                sorted_starts,
+                sorted_lengths,
             )
 
-        # Repeat (step 5)
-        distance_matrix = new_distance_matrix
-        n = distance_matrix.shape[0]
-        true_indices = np.array(
-            [intermediate_node] + [true_indices[i] for i in indices]
-        )
-
-    # Last 3 nodes
-    delta_ij_u = _find_branch_length(distance_matrix, 1, 2)
+    # Last 3 nodes, in the order of the original algorithm
+    order = np.argsort(ranks[:3])
+    last_nodes = nodes[order]
+    last_distance_matrix = np.zeros((3, 3))
+    for x in range(3):
+        for y in range(3):
+            last_distance_matrix[x, y] = distance_matrix[order[x], order[y]]
+    delta_ij_u = _find_branch_length(
+        last_distance_matrix,
+        3,
+        1,
+        2,
+        np.sum(last_distance_matrix[1, :]),
+        np.sum(last_distance_matrix[2, :]),
+    )
     intermediate_node = num_intermediate_nodes + length
     num_intermediate_nodes += 1
 
-    tree[index] = np.array((true_indices[1], intermediate_node))
+    tree[index, 0], tree[index, 1] = last_nodes[1], intermediate_node
     branch_lengths[index] = delta_ij_u[0]
     index += 1
 
-    tree[index] = np.array((true_indices[2], intermediate_node))
+    tree[index, 0], tree[index, 1] = last_nodes[2], intermediate_node
     branch_lengths[index] = delta_ij_u[1]
     index += 1
 
-    tree[index] = np.array((true_indices[0], intermediate_node))
+    tree[index, 0], tree[index, 1] = last_nodes[0], intermediate_node
     branch_lengths[index] = 0.5 * (
-        distance_matrix[1, 0] + distance_matrix[2, 0] - distance_matrix[1, 2]
+        last_distance_matrix[1, 0]
+        + last_distance_matrix[2, 0]
+        - last_distance_matrix[1, 2]
     )
     index += 1
 
     return tree[:index], branch_lengths[:index]
 
 
+@nb.njit
+def _get_rank(node, length):
+    """
+    Position of a node in the ordering used to break ties:
+    newest intermediate node first, then leaves in order
+    """
+    if node >= length:
+        return 2 * length - node
+    return 2 * length + node
+
+
+@nb.njit
+def _get_row_sum(distance_matrix, ranks, n, i):
+    """
+    Sum of the first n columns of row i, adding columns in order of rank
+    """
+    row_sum = 0.0
+    for k in np.argsort(ranks[:n]):
+        row_sum += distance_matrix[i, k]
+    return row_sum
+
+
+@nb.njit
+def _set_row_sums(distance_matrix, ranks, n, row_sums):
+    """
+    Exact sums of the first n columns of each of the first n rows (see _get_row_sum)
+    """
+    for i in range(n):
+        row_sums[i] = _get_row_sum(distance_matrix, ranks, n, i)
+
+
+@nb.njit
+def _is_better(q, rank_1, rank_2, best_q, best_rank_1, best_rank_2):
+    """
+    Lower Q value first, ties go to the pair with the lowest ranks
+    """
+    if q != best_q:
+        return q < best_q
+    if rank_1 != best_rank_1:
+        return rank_1 < best_rank_1
+    return rank_2 < best_rank_2
+
+
+@nb.njit
+def _reduce_join_rows(ranks, best_q, best_j, n):
+    """
+    Best pair of rows among the best pair of each row, as (lower ranked row, higher ranked row)
+    """
+    min_i, min_j = 0, 1
+    min_q = np.inf
+    min_rank_1 = min_rank_2 = np.iinfo(np.int64).max
+    for i in range(n):
+        j = best_j[i]
+        if j == -1:
+            continue
+        rank_1, rank_2 = min(ranks[i], ranks[j]), max(ranks[i], ranks[j])
+        if _is_better(best_q[i], rank_1, rank_2, min_q, min_rank_1, min_rank_2):
+            min_q, min_rank_1, min_rank_2 = best_q[i], rank_1, rank_2
+            min_i, min_j = (i, j) if ranks[i] < ranks[j] else (j, i)
+    return min_i, min_j
+
+
 # Q matrix calculation + minimum i, j (step 1 & 2)
 @nb.njit
-# @numba_cc.export('_find_join_nodes', '(f64[:])')
-def _find_join_nodes(distance_matrix):
+def _find_join_rows_exact(distance_matrix, ranks, n):
+    """
+    Finds which nodes to join next exactly as the original algorithm:
+    Q values from exact row sums, first lowest one going through rows and columns in order of rank
+
+    Returns
+    -------
+    rows (i, j) of nodes to join
+    """
+    order = np.argsort(ranks[:n])
+    row_sums = np.zeros(n)
+    _set_row_sums(distance_matrix, ranks, n, row_sums)
+    min_i, min_j = order[0], order[1]
+    min_q = np.inf
+    for i in order:
+        for j in order:
+            if i != j:
+                q = (n - 2) * distance_matrix[i, j] - row_sums[i] - row_sums[j]
+                if q < min_q:
+                    min_i, min_j = i, j
+                    min_q = q
+    return min_i, min_j
+
+
+@nb.njit(parallel=True)
+def _find_join_rows(distance_matrix, row_sums, ranks, n):
     """
-    Finds which nodes to join next
+    Finds which nodes to join next, searching rows in parallel
 
     Parameters
     ----------
     distance_matrix
+    row_sums
+        sums of the first n columns of each row of distance_matrix
+    ranks
+        tie-breaking rank of each row
+    n
+        number of rows in use
 
     Returns
     -------
-    indices (i, j) of nodes to join
+    rows (i, j) of nodes to join
     """
-    n = distance_matrix.shape[0]
-    q_matrix = np.zeros((n, n))
-    q_matrix[:] = np.inf
-    min_ij = np.array([0, 0], dtype=np.uint64)
-    min_q = np.inf
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                q_matrix[i, j] = (
-                    (n - 2) * distance_matrix[i, j]
-                    - np.sum(distance_matrix[i, :])
-                    - np.sum(distance_matrix[j, :])
-                )
-                # q_matrix[i, j] = distance_matrix[i, j]
-                if q_matrix[i, j] < min_q:
-                    min_ij[0], min_ij[1] = i, j
-                    min_q = q_matrix[i, j]
-    return min_ij
+    best_q = np.full(n, np.inf)
+    best_j = np.full(n, -1, dtype=np.int64)
+    for i in nb.prange(n):
+        best_rank_1 = best_rank_2 = np.iinfo(np.int64).max
+        for j in range(i + 1, n):
+            q = (n - 2) * distance_matrix[i, j] - row_sums[i] - row_sums[j]
+            if q <= best_q[i]:
+                rank_1, rank_2 = min(ranks[i], ranks[j]), max(ranks[i], ranks[j])
+                if _is_better(q, rank_1, rank_2, best_q[i], best_rank_1, best_rank_2):
+                    best_q[i], best_j[i] = q, j
+                    best_rank_1, best_rank_2 = rank_1, rank_2
+    return _reduce_join_rows(ranks, best_q, best_j, n)
+
+
+@nb.njit(parallel=True)
+def _find_join_rows_pruned(
+    distance_matrix,
+    row_sums,
+    ranks,
+    n,
+    sorted_nodes,
+    sorted_starts,
+    sorted_lengths,
+    node_rows,
+):
+    """
+    Same as _find_join_rows, going through each row's neighbours by increasing distance
+    and stopping once (n - 2) * distance - row sum - largest row sum is above the best Q value found so far
+    (the lowest Q value of each row's nearest neighbour, or the row's own best)
+
+    Parameters
+    ----------
+    distance_matrix
+    row_sums
+    ranks
+    n
+    sorted_nodes
+        neighbours of each row sorted by distance (see _sort_neighbours), may include joined nodes
+    sorted_starts
+        first neighbour of each row which may not be joined yet, moved forward here
+    sorted_lengths
+        number of neighbours of each row
+    node_rows
+        row of each node, -1 if joined
+
+    Returns
+    -------
+    rows (i, j) of nodes to join
+    """
+    max_row_sum = np.max(row_sums[:n])
+    nearest_q = np.full(n, np.inf)
+    for i in nb.prange(n):
+        while (
+            sorted_starts[i] < sorted_lengths[i]
+            and node_rows[sorted_nodes[i, sorted_starts[i]]] == -1
+        ):
+            sorted_starts[i] += 1
+        if sorted_starts[i] < sorted_lengths[i]:
+            j = node_rows[sorted_nodes[i, sorted_starts[i]]]
+            nearest_q[i] = (n - 2) * distance_matrix[i, j] - row_sums[i] - row_sums[j]
+    max_q = np.min(nearest_q)
+    best_q = np.full(n, np.inf)
+    best_j = np.full(n, -1, dtype=np.int64)
+    for i in nb.prange(n):
+        best_rank_1 = best_rank_2 = np.iinfo(np.int64).max
+        for x in range(sorted_starts[i], sorted_lengths[i]):
+            j = node_rows[sorted_nodes[i, x]]
+            if j == -1:
+                continue
+            # lower bound of the Q values of this and all following neighbours
+            if (n - 2) * distance_matrix[i, j] - row_sums[i] - max_row_sum > min(
+                max_q, best_q[i]
+            ):
+                break
+            q = (n - 2) * distance_matrix[i, j] - row_sums[i] - row_sums[j]
+            rank_1, rank_2 = min(ranks[i], ranks[j]), max(ranks[i], ranks[j])
+            if _is_better(q, rank_1, rank_2, best_q[i], best_rank_1, best_rank_2):
+                best_q[i], best_j[i] = q, j
+                best_rank_1, best_rank_2 = rank_1, rank_2
+    return _reduce_join_rows(ranks, best_q, best_j, n)
+
+
+@nb.njit
+def _sort_neighbours(
+    distance_matrix, nodes, i, n, sorted_nodes, sorted_starts, sorted_lengths
+):
+    """
+    Stores the other nodes of the first n rows, sorted by distance to row i, in sorted_nodes[i]
+    """
+    others = np.array([k for k in range(n) if k != i], dtype=np.int64)
+    order = np.argsort(distance_matrix[i, others])
+    for x in range(others.shape[0]):
+        sorted_nodes[i, x] = nodes[others[order[x]]]
+    sorted_starts[i] = 0
+    sorted_lengths[i] = others.shape[0]
 
 
 # Branch length calculation (step 3)
 @nb.njit
 # @numba_cc.export('_find_branch_length', '(f64[:], i64, i64)')
-def _find_branch_length(distance_matrix, i, j):
+def _find_branch_length(distance_matrix, n, i, j, row_sum_i, row_sum_j):
     """
     Finds branch lengths of old nodes to newly created node
 
     Parameters
     ----------
     distance_matrix
+    n
+        number of rows in use
     i
         first node to join
     j
         second node to join
+    row_sum_i
+        sum of the first n columns of row i
+    row_sum_j
+        sum of the first n columns of row j
 
     Returns
     -------
     (branch length of i to new node, branch length of j to new node)
     """
-    n = distance_matrix.shape[0]
-    delta_i_u = 0.5 * distance_matrix[i, j] + (0.5 / (n - 2)) * (
-        np.sum(distance_matrix[i, :]) - np.sum(distance_matrix[j, :])
-    )
+    delta_i_u = 0.5 * distance_matrix[i, j] + (0.5 / (n - 2)) * (row_sum_i - row_sum_j)
     delta_j_u = distance_matrix[i, j] - delta_i_u
     return np.array([delta_i_u, delta_j_u])
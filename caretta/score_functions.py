@@ -58,6 +58,310 @@ def make_score_matrix(
     return score_matrix
 
 
+@nb.njit(nogil=True)
+def make_caretta_score_matrix(
+    coords_1: np.ndarray, coords_2: np.ndarray, gamma, normalized=False
+) -> np.ndarray:
+    """
+    Same as make_score_matrix(coords_1, coords_2, get_caretta_score, gamma, normalized) up to rounding,
+    with all squared distances computed as |a|^2 + |b|^2 - 2ab from one matrix product
+
+    Parameters
+    ----------
+    coords_1
+        shape = (n, d)
+    coords_2
+        shape = (m, d)
+    gamma
+    normalized
+    Returns
+    -------
+    matrix; shape = (n, m)
+    """
+    both = np.concatenate((coords_1, coords_2)).astype(np.float64)
+    # centering keeps |a|^2 + |b|^2 - 2ab accurate
+    mean = helper.nb_mean_axis_0(both)
+    if normalized:
+        both = (both - mean) / helper.nb_std_axis_0(both)
+    else:
+        both = both - mean
+    coords_1 = both[: coords_1.shape[0]]
+    coords_2 = both[coords_1.shape[0] :]
+    squared_1 = np.sum(coords_1 ** 2, axis=1)
+    squared_2 = np.sum(coords_2 ** 2, axis=1)
+    score_matrix = np.dot(coords_1, coords_2.T)
+    for i in range(score_matrix.shape[0]):
+        for j in range(score_matrix.shape[1]):
+            score_matrix[i, j] = np.exp(
+                -gamma * max(squared_1[i] + squared_2[j] - 2 * score_matrix[i, j], 0.0)
+            )
+    return score_matrix
+
+
+@nb.njit(nogil=True)
+def make_signal_score_matrix(
+    signals_1: np.ndarray, signals_2: np.ndarray, gamma=0.1
+) -> np.ndarray:
+    """
+    Same as make_score_matrix(signals_1, signals_2, get_signal_score, gamma),
+    exp(-gamma * x) is decreasing so the median score comes from the middle squared differences,
+    found by sorting a reused buffer
+
+    Parameters
+    ----------
+    signals_1
+        shape = (n, size)
+    signals_2
+        shape = (m, size)
+    gamma
+    Returns
+    -------
+    matrix; shape = (n, m)
+    """
+    size = signals_1.shape[1]
+    middle = size // 2
+    score_matrix = np.zeros((signals_1.shape[0], signals_2.shape[0]))
+    squared = np.zeros(size)
+    for i in range(signals_1.shape[0]):
+        for j in range(signals_2.shape[0]):
+            for k in range(size):
+                squared[k] = (signals_1[i, k] - signals_2[j, k]) ** 2
+            # insertion sort, signals are short
+            for k in range(1, size):
+                value = squared[k]
+                x = k - 1
+                while x >= 0 and squared[x] > value:
+                    squared[x + 1] = squared[x]
+                    x -= 1
+                squared[x + 1] = value
+            if size % 2:
+                score_matrix[i, j] = np.exp(-gamma * squared[middle])
+            else:
+                score_matrix[i, j] = (
+                    np.exp(-gamma * squared[middle - 1]) + np.exp(-gamma * squared[middle])
+                ) / 2
+    return score_matrix
+
+
+@nb.njit
+def make_caretta_score_row(
+    coords_1: np.ndarray, coords_2: np.ndarray, i: int, gamma, row_scores: np.ndarray
+) -> np.ndarray:
+    """
+    Row i of make_score_matrix(coords_1, coords_2, get_caretta_score, gamma), written into row_scores
+    (used to compute scores inside the DTW recurrence instead of storing the score matrix)
+    """
+    for j in range(coords_2.shape[0]):
+        distance = 0.0
+        for d in range(coords_1.shape[1]):
+            distance += (coords_1[i, d] - coords_2[j, d]) ** 2
+        row_scores[j] = np.exp(-gamma * distance)
+    return row_scores
+
+
+@nb.njit(parallel=True)
+def make_caretta_score_matrix_parallel(
+    coords_1: np.ndarray, coords_2: np.ndarray, gamma, block_size: int = 64
+) -> np.ndarray:
+    """
+    Same as make_score_matrix(coords_1, coords_2, get_caretta_score, gamma)
+    (bit-identical to make_caretta_score_row), with blocks of block_size rows filled in parallel
+
+    Returns
+    -------
+    matrix; shape = (n, m)
+    """
+    n = coords_1.shape[0]
+    score_matrix = np.zeros((n, coords_2.shape[0]), dtype=coords_1.dtype)
+    for block in nb.prange((n + block_size - 1) // block_size):
+        for i in range(block * block_size, min(n, (block + 1) * block_size)):
+            make_caretta_score_row(coords_1, coords_2, i, gamma, score_matrix[i])
+    return score_matrix
+
+
+@nb.njit
+def make_banded_score_matrix(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    score_function,
+    gamma,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    Same as make_score_matrix but only scores pairs inside a DTW band (see dynamic_time_warping.make_band)
+
+    Returns
+    -------
+    scores in flat band storage; shape = (offsets[-1],)
+    """
+    band_scores = np.zeros(offsets[-1])
+    for i in range(1, lo.shape[0]):
+        for j in range(max(lo[i], 1), hi[i] + 1):
+            band_scores[offsets[i] + j - lo[i]] = score_function(
+                coords_1[i - 1], coords_2[j - 1], gamma
+            )
+    return band_scores
+
+
+@nb.njit
+def make_caretta_band_scores(
+    coords_1: np.ndarray,
+    coords_2: np.ndarray,
+    gamma,
+    lo: np.ndarray,
+    hi: np.ndarray,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    make_banded_score_matrix for get_caretta_score, without temporary arrays
+    (used as band function in dynamic_time_warping.dtw_align_in_band), in the precision of coords_1
+    """
+    band_scores = np.zeros(offsets[-1], dtype=coords_1.dtype)
+    for i in range(1, lo.shape[0]):
+        for j in range(max(lo[i], 1), hi[i] + 1):
+            distance = 0.0
+            for d in range(coords_1.shape[1]):
+                distance += (coords_1[i - 1, d] - coords_2[j - 1, d]) ** 2
+            band_scores[offsets[i] + j - lo[i]] = np.exp(-gamma * distance)
+    return band_scores
+
+
+@nb.njit
+def _make_cell_list(coords: np.ndarray, cell_size: float):
+    """
+    Bins the first three dimensions of coords into a grid of cubic cells.
+    Only occupied cells are indexed (at most one per coordinate), so memory doesn't depend on the grid size
+
+    Returns
+    -------
+    order
+        indices of coords sorted by cell
+    cell_ids
+        sorted ids of the occupied cells, (x * grid_shape[1] + y) * grid_shape[2] + z
+    cell_starts
+        position in order of the first coordinate of each occupied cell; shape = (len(cell_ids) + 1,)
+    origin
+    grid_shape
+    """
+    origin = np.zeros(3)
+    for d in range(3):
+        origin[d] = np.min(coords[:, d])
+    grid_shape = np.ones(3, dtype=np.int64)
+    cells = np.zeros((coords.shape[0], 3), dtype=np.int64)
+    for p in range(coords.shape[0]):
+        for d in range(3):
+            cells[p, d] = int((coords[p, d] - origin[d]) / cell_size)
+            grid_shape[d] = max(grid_shape[d], cells[p, d] + 1)
+    all_cell_ids = (cells[:, 0] * grid_shape[1] + cells[:, 1]) * grid_shape[2] + cells[:, 2]
+    order = np.argsort(all_cell_ids, kind="mergesort")
+    sorted_cell_ids = all_cell_ids[order]
+    cell_ids = np.zeros(coords.shape[0], dtype=np.int64)
+    cell_starts = np.zeros(coords.shape[0] + 1, dtype=np.int64)
+    num_cells = 0
+    for p in range(coords.shape[0]):
+        if p == 0 or sorted_cell_ids[p] != sorted_cell_ids[p - 1]:
+            cell_ids[num_cells] = sorted_cell_ids[p]
+            cell_starts[num_cells] = p
+            num_cells += 1
+    cell_starts[num_cells] = coords.shape[0]
+    return order, cell_ids[:num_cells], cell_starts[: num_cells + 1], origin, grid_shape
+
+
+@nb.njit
+def make_sparse_score_matrix(
+    coords_1: np.ndarray, coords_2: np.ndarray, gamma, min_score: float
+):
+    """
+    Caretta scores of only the pairs of coordinates scoring at least min_score,
+    found with a cell list on coords_2 instead of scoring every pair.
+    Pairs are searched in the first three dimensions, further dimensions (e.g. weights) only add to the distance.
+
+    Parameters
+    ----------
+    coords_1
+        shape = (n, d), d >= 3
+    coords_2
+        shape = (m, d)
+    gamma
+    min_score
+        0 < min_score < 1, e.g. 1e-6 drops pairs further apart than ~21A with gamma = 0.03
+
+    Returns
+    -------
+    (indptr, indices, scores) in CSR format; row i scores columns indices[indptr[i]:indptr[i + 1]]
+    scores are in the precision of coords_1
+    """
+    cutoff = -np.log(min_score) / gamma
+    cell_size = np.sqrt(cutoff)
+    order, cell_ids, cell_starts, origin, grid_shape = _make_cell_list(
+        coords_2, cell_size
+    )
+    indptr = np.zeros(coords_1.shape[0] + 1, dtype=np.int64)
+    indices = np.zeros(max(1, 32 * coords_1.shape[0]), dtype=np.int64)
+    scores = np.zeros(indices.shape[0], dtype=coords_1.dtype)
+    cell = np.zeros(3, dtype=np.int64)
+    count = 0
+    for i in range(coords_1.shape[0]):
+        indptr[i] = count
+        for d in range(3):
+            cell[d] = int(np.floor((coords_1[i, d] - origin[d]) / cell_size))
+        for x in range(max(cell[0] - 1, 0), min(cell[0] + 2, grid_shape[0])):
+            for y in range(max(cell[1] - 1, 0), min(cell[1] + 2, grid_shape[1])):
+                for z in range(max(cell[2] - 1, 0), min(cell[2] + 2, grid_shape[2])):
+                    cell_id = (x * grid_shape[1] + y) * grid_shape[2] + z
+                    c = np.searchsorted(cell_ids, cell_id)
+                    if c == cell_ids.shape[0] or cell_ids[c] != cell_id:
+                        continue
+                    for p in range(cell_starts[c], cell_starts[c + 1]):
+                        j = order[p]
+                        distance = 0.0
+                        for d in range(coords_1.shape[1]):
+                            distance += (coords_1[i, d] - coords_2[j, d]) ** 2
+                        if distance > cutoff:
+                            continue
+                        if count == indices.shape[0]:
+                            indices = np.concatenate((indices, np.zeros_like(indices)))
+                            scores = np.concatenate((scores, np.zeros_like(scores)))
+                        indices[count] = j
+                        scores[count] = np.exp(-gamma * distance)
+                        count += 1
+    indptr[coords_1.shape[0]] = count
+    return indptr, indices[:count], scores[:count]
+
+
+@nb.njit
+def make_sparse_score_row(sparse_scores, _, i: int, gamma, row_scores: np.ndarray):
+    """
+    Row i of a sparse score matrix made by make_sparse_score_matrix, written into row_scores
+    (used as row function in the dynamic_time_warping kernels)
+    """
+    indptr, indices, scores = sparse_scores
+    row_scores[:] = 0
+    for k in range(indptr[i], indptr[i + 1]):
+        row_scores[indices[k]] = scores[k]
+    return row_scores
+
+
+@nb.njit
+def make_sparse_band_scores(
+    sparse_scores, _, gamma, lo: np.ndarray, hi: np.ndarray, offsets: np.ndarray
+) -> np.ndarray:
+    """
+    Scores of a sparse score matrix made by make_sparse_score_matrix that fall inside a DTW band
+    (used as band function in dynamic_time_warping.dtw_align_in_band)
+    """
+    indptr, indices, scores = sparse_scores
+    band_scores = np.zeros(offsets[-1], dtype=scores.dtype)
+    for i in range(1, lo.shape[0]):
+        for k in range(indptr[i - 1], indptr[i]):
+            j = indices[k] + 1
+            if lo[i] <= j <= hi[i]:
+                band_scores[offsets[i] + j - lo[i]] = scores[k]
+    return band_scores
+
+
 @nb.njit
 def get_total_score(
     coords_1: np.ndarray, coords_2: np.ndarray, score_function, gamma, normalized=False
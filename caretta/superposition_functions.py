@@ -1,3 +1,8 @@
+import dataclasses
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numba as nb
 import numpy as np
 from geometricus import MomentInvariants, SplitType, GeometricusEmbedding, MomentType
@@ -11,6 +16,152 @@ Each takes coords_1, coords_2, parameters as input
 returns score, superposed_coords_1, superposed_coords_2
 """
 
+# Moment invariants of each structure are cached (keyed by its coordinates and the invariant parameters)
+# so that they're made once per structure across pairwise calls and the shape matrix,
+# least recently used entries are dropped beyond MOMENT_CACHE_SIZE entries
+MOMENT_CACHE_SIZE = 4096
+_moment_cache = OrderedDict()
+_moment_cache_lock = threading.Lock()
+
+
+# "svd" (Kabsch) or "qcp" (quaternion characteristic polynomial, faster),
+# compiled into the superposition functions, so only changeable with set_superposition_engine before they're first run
+SUPERPOSITION_ENGINE = "svd"
+
+
+def set_superposition_engine(engine: str):
+    """
+    Selects how paired coordinates are superposed: "svd" (Kabsch, default) or "qcp" (no SVD, same rotation up to rounding)
+    Needs to be called before any alignment or superposition is run (e.g. before trigger_numba_compilation)
+    """
+    global SUPERPOSITION_ENGINE
+    if engine not in ("svd", "qcp"):
+        raise ValueError(f"engine must be svd or qcp, got {engine}")
+    if engine != SUPERPOSITION_ENGINE and (
+        paired_svd_superpose.signatures or svd_superimpose.signatures
+    ):
+        raise RuntimeError(
+            "superposition engine must be set before superposition functions are compiled"
+        )
+    SUPERPOSITION_ENGINE = engine
+
+
+def set_moment_cache_size(size: int):
+    """
+    Sets the maximum number of cached moment invariants (0 => no caching)
+    """
+    global MOMENT_CACHE_SIZE
+    with _moment_cache_lock:
+        MOMENT_CACHE_SIZE = size
+        while len(_moment_cache) > MOMENT_CACHE_SIZE:
+            _moment_cache.popitem(last=False)
+
+
+def clear_moment_cache():
+    with _moment_cache_lock:
+        _moment_cache.clear()
+
+
+def _get_cached(key, make_function):
+    """
+    Returns cached value of key, or makes it with make_function and caches it
+    """
+    with _moment_cache_lock:
+        if key in _moment_cache:
+            _moment_cache.move_to_end(key)
+            return _moment_cache[key]
+    value = make_function()
+    with _moment_cache_lock:
+        if MOMENT_CACHE_SIZE > 0:
+            _moment_cache[key] = value
+            while len(_moment_cache) > MOMENT_CACHE_SIZE:
+                _moment_cache.popitem(last=False)
+    return value
+
+
+def _get_moment_key(coords, split_type, split_size, upsample_rate, moment_types):
+    """
+    Cache key of a structure's moment invariants
+    """
+    split_type = split_type.name if isinstance(split_type, SplitType) else split_type
+    return (
+        coords.shape,
+        hashlib.blake2b(
+            np.ascontiguousarray(coords, dtype=np.float64).tobytes(), digest_size=16
+        ).digest(),
+        split_type,
+        split_size,
+        # only used to split with RADIUS_UPSAMPLE
+        upsample_rate if split_type == "RADIUS_UPSAMPLE" else None,
+        tuple(x.name if isinstance(x, MomentType) else x for x in moment_types),
+    )
+
+
+def get_moment_invariants(
+    coords,
+    split_type="KMER",
+    split_size=16,
+    upsample_rate=50,
+    moment_types=("O_3", "O_4", "O_5", "F"),
+) -> MomentInvariants:
+    """
+    Cached MomentInvariants.from_coordinates (the returned object is shared, don't modify it)
+
+    Parameters
+    ----------
+    coords
+    split_type
+        name or SplitType
+    split_size
+    upsample_rate
+    moment_types
+        names or MomentTypes
+
+    Returns
+    -------
+    MomentInvariants object
+    """
+    return _get_cached(
+        _get_moment_key(coords, split_type, split_size, upsample_rate, moment_types),
+        lambda: MomentInvariants.from_coordinates(
+            "name",
+            coords,
+            split_type=split_type
+            if isinstance(split_type, SplitType)
+            else SplitType[split_type],
+            split_size=split_size,
+            upsample_rate=upsample_rate,
+            moment_types=[
+                x if isinstance(x, MomentType) else MomentType[x] for x in moment_types
+            ],
+        ),
+    )
+
+
+def _get_scaled_moments(
+    coords, split_type, split_size, upsample_rate, moment_types, scale
+):
+    """
+    Cached moments of get_moment_invariants, log1p-scaled if scale
+    """
+    if not scale:
+        return get_moment_invariants(
+            coords, split_type, split_size, upsample_rate, moment_types
+        ).moments
+    return _get_cached(
+        (
+            "log1p",
+            *_get_moment_key(
+                coords, split_type, split_size, upsample_rate, moment_types
+            ),
+        ),
+        lambda: np.log1p(
+            get_moment_invariants(
+                coords, split_type, split_size, upsample_rate, moment_types
+            ).moments
+        ),
+    )
+
 
 def dtw_svd_superpose_function(
     coords_1, coords_2, parameters: dict,
@@ -19,19 +170,24 @@ def dtw_svd_superpose_function(
     Assumes coords_1 and coords_2 are already in a well-superposed state,
     runs DTW alignment and then superposes with Kabsch on the aligning positions
     """
-    score_matrix = score_functions.make_score_matrix(
-        coords_1,
-        coords_2,
-        score_functions.get_caretta_score,
-        parameters["gamma"],
-        normalized=False,
-    )
-    _, coords_1, coords_2, common_coords_1, common_coords_2 = _align_and_superpose(
-        coords_1,
-        coords_2,
-        score_matrix,
-        parameters["gap_open_penalty"],
-        parameters["gap_extend_penalty"],
+    if parameters.get("low_memory", False):
+        dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align_low_memory_coordinates(
+            coords_1,
+            coords_2,
+            parameters["gamma"],
+            parameters["gap_open_penalty"],
+            parameters["gap_extend_penalty"],
+        )
+    else:
+        dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align_coordinates(
+            coords_1,
+            coords_2,
+            parameters["gamma"],
+            parameters["gap_open_penalty"],
+            parameters["gap_extend_penalty"],
+        )
+    _, coords_1, coords_2, common_coords_1, common_coords_2 = _superpose_aligned(
+        coords_1, coords_2, dtw_aln_array_1, dtw_aln_array_2, score
     )
     return (
         score_functions.get_total_score(
@@ -51,21 +207,31 @@ def signal_superpose_function(coords_1, coords_2, parameters):
     Makes initial superposition of coordinates using DTW alignment of overlapping signals
     A signal is a vector of euclidean distances of first (or last) coordinate to all others in a "size"-residue stretch
     """
-    score_first, c1_first, c2_first = _signal_superpose_index(
-        0,
+    signals_first_1, signals_last_1, middles_first_1, middles_last_1 = _make_signals(
+        coords_1, parameters["size"]
+    )
+    signals_first_2, signals_last_2, middles_first_2, middles_last_2 = _make_signals(
+        coords_2, parameters["size"]
+    )
+    score_first, c1_first, c2_first = _signal_superpose_signals(
         coords_1,
         coords_2,
+        signals_first_1,
+        signals_first_2,
+        middles_first_1,
+        middles_first_2,
         parameters["gap_open_penalty"],
         parameters["gap_extend_penalty"],
-        size=parameters["size"],
     )
-    score_last, c1_last, c2_last = _signal_superpose_index(
-        -1,
+    score_last, c1_last, c2_last = _signal_superpose_signals(
         coords_1,
         coords_2,
+        signals_last_1,
+        signals_last_2,
+        middles_last_1,
+        middles_last_2,
         parameters["gap_open_penalty"],
         parameters["gap_extend_penalty"],
-        size=parameters["size"],
     )
     if score_first > score_last:
         return score_first, c1_first, c2_first
@@ -81,9 +247,10 @@ def signal_svd_superpose_function(coords_1, coords_2, parameters):
     return dtw_svd_superpose_function(coords_1, coords_2, parameters)
 
 
-def moment_superpose_function(coords_1, coords_2, parameters):
+def get_moments(coords, parameters):
     """
-    Uses 4 rotation/translation invariant moments for each "split_size"-mer to run DTW
+    Rotation/translation invariant moments for each "split_size"-mer of coords, as used by moment_superpose_function
+    (fills in missing parameters with their defaults, cached, don't modify)
     """
     if "upsample_rate" not in parameters:
         parameters["upsample_rate"] = 10
@@ -100,30 +267,25 @@ def moment_superpose_function(coords_1, coords_2, parameters):
     if "gap_extend_penalty" not in parameters:
         parameters["gap_extend_penalty"] = 0.0
 
-    moment_types = [MomentType[x] for x in parameters["moment_types"]]
-    moments_1 = MomentInvariants.from_coordinates(
-        "name",
-        coords_1,
-        split_type=SplitType[parameters["split_type"]],
-        split_size=parameters["split_size"],
-        upsample_rate=parameters["upsample_rate"],
-        moment_types=moment_types,
-    ).moments
-    moments_2 = MomentInvariants.from_coordinates(
-        "name",
-        coords_2,
-        split_type=SplitType[parameters["split_type"]],
-        split_size=parameters["split_size"],
-        upsample_rate=parameters["upsample_rate"],
-        moment_types=moment_types,
-    ).moments
-    if parameters["scale"]:
-        moments_1 = np.log1p(moments_1)
-        moments_2 = np.log1p(moments_2)
-    score_matrix = score_functions.make_score_matrix(
+    return _get_scaled_moments(
+        coords,
+        parameters["split_type"],
+        parameters["split_size"],
+        parameters["upsample_rate"],
+        parameters["moment_types"],
+        parameters["scale"],
+    )
+
+
+def moment_superpose_function(coords_1, coords_2, parameters):
+    """
+    Uses 4 rotation/translation invariant moments for each "split_size"-mer to run DTW
+    """
+    moments_1 = get_moments(coords_1, parameters)
+    moments_2 = get_moments(coords_2, parameters)
+    score_matrix = score_functions.make_caretta_score_matrix(
         moments_1,
         moments_2,
-        score_functions.get_caretta_score,
         parameters["gamma_moment"],
         normalized=True,
     )
@@ -133,6 +295,7 @@ def moment_superpose_function(coords_1, coords_2, parameters):
         score_matrix,
         parameters["gap_open_penalty"],
         parameters["gap_extend_penalty"],
+        parameters.get("low_memory", False),
     )
     return score, coords_1, coords_2
 
@@ -141,28 +304,23 @@ def geometricus_superpose_function(coords_1, coords_2, parameters):
     if "upsample_rate" not in parameters:
         parameters["upsample_rate"] = 10
     invariants = [
-        MomentInvariants.from_coordinates(
-            "name1",
-            coords_1,
-            split_type=SplitType[parameters[f"split_type"]],
-            split_size=parameters[f"split_size"],
-            upsample_rate=parameters["upsample_rate"],
-        ),
-        MomentInvariants.from_coordinates(
-            "name2",
-            coords_2,
-            split_type=SplitType[parameters[f"split_type"]],
-            split_size=parameters[f"split_size"],
-            upsample_rate=parameters["upsample_rate"],
-        ),
+        dataclasses.replace(
+            get_moment_invariants(
+                coords,
+                parameters["split_type"],
+                parameters["split_size"],
+                parameters["upsample_rate"],
+            ),
+            name=name,
+        )
+        for name, coords in (("name1", coords_1), ("name2", coords_2))
     ]
     embedder = GeometricusEmbedding.from_invariants(
         invariants, resolution=parameters["resolution"], protein_keys=["name1", "name2"]
     )
-    score_matrix = score_functions.make_score_matrix(
+    score_matrix = score_functions.make_caretta_score_matrix(
         np.array(embedder.proteins_to_shapemers["name1"]),
         np.array(embedder.proteins_to_shapemers["name2"]),
-        score_functions.get_caretta_score,
         gamma=parameters["gamma"],
         normalized=False,
     )
@@ -172,6 +330,7 @@ def geometricus_superpose_function(coords_1, coords_2, parameters):
         score_matrix,
         parameters["gap_open_penalty"],
         parameters["gap_extend_penalty"],
+        parameters.get("low_memory", False),
     )
     return score, coords_1, coords_2
 
@@ -209,34 +368,22 @@ def moment_multiple_superpose_function(coords_1, coords_2, parameters):
         parameters["gap_extend_penalty"] = 0.0
 
     for i in range(parameters["num_split_types"]):
-        moment_types = [MomentType[x] for x in parameters[f"moment_types_{i}"]]
-        moments_1_1 = MomentInvariants.from_coordinates(
-            "name",
-            coords_1,
-            split_type=SplitType[parameters[f"split_type_{i}"]],
-            split_size=parameters[f"split_size_{i}"],
-            upsample_rate=parameters["upsample_rate"],
-            moment_types=moment_types,
-        ).moments
-        moments_2_1 = MomentInvariants.from_coordinates(
-            "name",
-            coords_2,
-            split_type=SplitType[parameters[f"split_type_{i}"]],
-            split_size=parameters[f"split_size_{i}"],
-            upsample_rate=parameters["upsample_rate"],
-            moment_types=moment_types,
-        ).moments
-        if parameters["scale"]:
-            moments_1_1 = np.log1p(moments_1_1)
-            moments_2_1 = np.log1p(moments_2_1)
-        moments_1.append(moments_1_1)
-        moments_2.append(moments_2_1)
+        for coords, moments in ((coords_1, moments_1), (coords_2, moments_2)):
+            moments.append(
+                _get_scaled_moments(
+                    coords,
+                    parameters[f"split_type_{i}"],
+                    parameters[f"split_size_{i}"],
+                    parameters["upsample_rate"],
+                    parameters[f"moment_types_{i}"],
+                    parameters["scale"],
+                )
+            )
     score_matrix = np.zeros((moments_1[0].shape[0], moments_2[0].shape[0]))
     for (m_1, m_2) in zip(moments_1, moments_2):
-        score_matrix += score_functions.make_score_matrix(
+        score_matrix += score_functions.make_caretta_score_matrix(
             m_1,
             m_2,
-            score_functions.get_caretta_score,
             gamma=parameters["gamma_moment"],
             normalized=True,
         )
@@ -246,6 +393,7 @@ def moment_multiple_superpose_function(coords_1, coords_2, parameters):
         score_matrix,
         parameters["gap_open_penalty"],
         parameters["gap_extend_penalty"],
+        parameters.get("low_memory", False),
     )
     return score, coords_1, coords_2
 
@@ -269,15 +417,74 @@ def moment_svd_superpose_function(coords_1, coords_2, parameters):
 
 
 @nb.njit
+def moment_svd_superpose_moments(
+    coords_1,
+    coords_2,
+    moments_1,
+    moments_2,
+    gamma,
+    gamma_moment,
+    gap_open_penalty,
+    gap_extend_penalty,
+):
+    """
+    Same as moment_svd_superpose_function, on moments already made with get_moments
+    """
+    score_matrix = score_functions.make_caretta_score_matrix(
+        moments_1, moments_2, gamma_moment, normalized=True
+    )
+    _, coords_1, coords_2, _, _ = _align_and_superpose(
+        coords_1, coords_2, score_matrix, gap_open_penalty, gap_extend_penalty
+    )
+    dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align_coordinates(
+        coords_1, coords_2, gamma, gap_open_penalty, gap_extend_penalty
+    )
+    _, coords_1, coords_2, common_coords_1, common_coords_2 = _superpose_aligned(
+        coords_1, coords_2, dtw_aln_array_1, dtw_aln_array_2, score
+    )
+    return (
+        score_functions.get_total_score(
+            common_coords_1,
+            common_coords_2,
+            score_functions.get_caretta_score,
+            gamma,
+            False,
+        ),
+        coords_1,
+        coords_2,
+    )
+
+
+@nb.njit(nogil=True)
 def _align_and_superpose(
-    coords_1, coords_2, score_matrix, gap_open_penalty, gap_extend_penalty
+    coords_1,
+    coords_2,
+    score_matrix,
+    gap_open_penalty,
+    gap_extend_penalty,
+    low_memory=False,
 ):
     """
     Runs DTW on a score matrix and Kabsch superposition on resulting alignment
     """
-    dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align(
-        score_matrix, gap_open_penalty, gap_extend_penalty
+    if low_memory:
+        dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align_low_memory(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+    else:
+        dtw_aln_array_1, dtw_aln_array_2, score = dtw.dtw_align(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+    return _superpose_aligned(
+        coords_1, coords_2, dtw_aln_array_1, dtw_aln_array_2, score
     )
+
+
+@nb.njit(nogil=True)
+def _superpose_aligned(coords_1, coords_2, dtw_aln_array_1, dtw_aln_array_2, score):
+    """
+    Kabsch superposition on the aligning positions of a DTW alignment
+    """
     pos_1, pos_2 = helper.get_common_positions(dtw_aln_array_1, dtw_aln_array_2)
     common_coords_1, common_coords_2 = coords_1[pos_1], coords_2[pos_2]
     coords_1, coords_2, common_coords_2 = paired_svd_superpose_with_subset(
@@ -286,10 +493,42 @@ def _align_and_superpose(
     return score, coords_1, coords_2, common_coords_1, common_coords_2
 
 
-@nb.njit
-def paired_svd_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
+@nb.njit(nogil=True)
+def _get_determinant_3(a, b, c, d, e, f, g, h, i):
+    """
+    Determinant of [[a, b, c], [d, e, f], [g, h, i]]
     """
-    Superpose paired coordinates on each other using Kabsch superposition (SVD)
+    return a * (e * i - f * h) - b * (d * i - f * g) + c * (d * h - e * g)
+
+
+@nb.njit(nogil=True)
+def _get_cofactor_4(matrix, r, k):
+    """
+    Cofactor of row r, column k of a 4x4 matrix
+    """
+    # the other three rows / columns in order
+    r_0, r_1, r_2 = int(r == 0), 1 + int(r <= 1), 2 + int(r <= 2)
+    k_0, k_1, k_2 = int(k == 0), 1 + int(k <= 1), 2 + int(k <= 2)
+    return (-1.0) ** (r + k) * _get_determinant_3(
+        matrix[r_0, k_0],
+        matrix[r_0, k_1],
+        matrix[r_0, k_2],
+        matrix[r_1, k_0],
+        matrix[r_1, k_1],
+        matrix[r_1, k_2],
+        matrix[r_2, k_0],
+        matrix[r_2, k_1],
+        matrix[r_2, k_2],
+    )
+
+
+@nb.njit(nogil=True)
+def qcp_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
+    """
+    Superpose paired coordinates on each other using the quaternion characteristic polynomial (QCP) method
+    (Theobald 2005, Liu et al. 2010): the largest eigenvalue of the 4x4 key matrix is found with Newton's method
+    and the rotation comes from its eigenvector, without an SVD
+    Same rotation as paired_svd_superpose up to rounding, falls back to it for degenerate (e.g. collinear) coordinates
 
     Parameters
     ----------
@@ -300,7 +539,107 @@ def paired_svd_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
 
     Returns
     -------
-    rotation matrix, translation matrix for optimal superposition
+    rotation matrix, translation matrix for optimal superposition, RMSD after superposition
+    """
+    num_coords = coords_1.shape[0]
+    centroid_1, centroid_2 = (
+        helper.nb_mean_axis_0(coords_1),
+        helper.nb_mean_axis_0(coords_2),
+    )
+    # correlation matrix of coords_2 (rotated) to coords_1 and the inner products of both
+    correlation = np.zeros((3, 3))
+    inner_product = 0.0
+    for n in range(num_coords):
+        for a in range(3):
+            x_2 = coords_2[n, a] - centroid_2[a]
+            inner_product += x_2 * x_2
+            x_1 = coords_1[n, a] - centroid_1[a]
+            inner_product += x_1 * x_1
+            for b in range(3):
+                correlation[a, b] += x_2 * (coords_1[n, b] - centroid_1[b])
+    e_0 = inner_product / 2
+    s_xx, s_xy, s_xz = correlation[0, 0], correlation[0, 1], correlation[0, 2]
+    s_yx, s_yy, s_yz = correlation[1, 0], correlation[1, 1], correlation[1, 2]
+    s_zx, s_zy, s_zz = correlation[2, 0], correlation[2, 1], correlation[2, 2]
+    key_matrix = np.array(
+        [
+            [s_xx + s_yy + s_zz, s_yz - s_zy, s_zx - s_xz, s_xy - s_yx],
+            [s_yz - s_zy, s_xx - s_yy - s_zz, s_xy + s_yx, s_zx + s_xz],
+            [s_zx - s_xz, s_xy + s_yx, -s_xx + s_yy - s_zz, s_yz + s_zy],
+            [s_xy - s_yx, s_zx + s_xz, s_yz + s_zy, -s_xx - s_yy + s_zz],
+        ]
+    )
+    # characteristic polynomial x^4 + c_2 x^2 + c_1 x + c_0 of the key matrix
+    c_2 = -2.0 * np.sum(correlation ** 2)
+    c_1 = -8.0 * _get_determinant_3(
+        s_xx, s_xy, s_xz, s_yx, s_yy, s_yz, s_zx, s_zy, s_zz
+    )
+    c_0 = 0.0
+    for k in range(4):
+        c_0 += key_matrix[0, k] * _get_cofactor_4(key_matrix, 0, k)
+    # largest eigenvalue, from above (e_0 is an upper bound)
+    eigenvalue = e_0
+    for _ in range(50):
+        eigenvalue_2 = eigenvalue * eigenvalue
+        value = eigenvalue_2 * eigenvalue_2 + c_2 * eigenvalue_2 + c_1 * eigenvalue + c_0
+        derivative = 4 * eigenvalue_2 * eigenvalue + 2 * c_2 * eigenvalue + c_1
+        if derivative == 0.0:
+            break
+        step = value / derivative
+        eigenvalue -= step
+        if abs(step) <= 1e-11 * abs(eigenvalue):
+            break
+    # eigenvector = largest row of the adjugate of key_matrix - eigenvalue * I
+    shifted = key_matrix - eigenvalue * np.eye(4)
+    quaternion = np.zeros(4)
+    row_vector = np.zeros(4)
+    norm = 0.0
+    for r in range(4):
+        for k in range(4):
+            row_vector[k] = _get_cofactor_4(shifted, r, k)
+        row_norm = np.sum(row_vector ** 2)
+        if row_norm > norm:
+            quaternion[:], norm = row_vector, row_norm
+    # the adjugate vanishes as the largest eigenvalue becomes degenerate
+    if norm <= 1e-8 * e_0 ** 6:
+        rotation_matrix, translation_matrix = _svd_superpose(coords_1, coords_2)
+        rmsd = np.sqrt(
+            np.sum(
+                (np.dot(coords_2, rotation_matrix) + translation_matrix - coords_1) ** 2
+            )
+            / num_coords
+        )
+        return rotation_matrix, translation_matrix, rmsd
+    rmsd = np.sqrt(max(0.0, 2.0 * (e_0 - eigenvalue) / num_coords))
+    q_0, q_1, q_2, q_3 = quaternion / np.sqrt(norm)
+    # transposed to rotate row vectors (coords_2 @ rotation_matrix)
+    rotation_matrix = np.array(
+        [
+            [
+                q_0 * q_0 + q_1 * q_1 - q_2 * q_2 - q_3 * q_3,
+                2 * (q_1 * q_2 + q_0 * q_3),
+                2 * (q_1 * q_3 - q_0 * q_2),
+            ],
+            [
+                2 * (q_1 * q_2 - q_0 * q_3),
+                q_0 * q_0 - q_1 * q_1 + q_2 * q_2 - q_3 * q_3,
+                2 * (q_2 * q_3 + q_0 * q_1),
+            ],
+            [
+                2 * (q_1 * q_3 + q_0 * q_2),
+                2 * (q_2 * q_3 - q_0 * q_1),
+                q_0 * q_0 - q_1 * q_1 - q_2 * q_2 + q_3 * q_3,
+            ],
+        ]
+    )
+    translation_matrix = centroid_1 - np.dot(centroid_2, rotation_matrix)
+    return rotation_matrix, translation_matrix, rmsd
+
+
+@nb.njit(nogil=True)
+def _svd_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
+    """
+    Kabsch superposition (SVD), see paired_svd_superpose
     """
     centroid_1, centroid_2 = (
         helper.nb_mean_axis_0(coords_1),
@@ -318,6 +657,29 @@ def paired_svd_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
     return rotation_matrix.astype(np.float64), translation_matrix.astype(np.float64)
 
 
+@nb.njit
+def paired_svd_superpose(coords_1: np.ndarray, coords_2: np.ndarray):
+    """
+    Superpose paired coordinates on each other using Kabsch superposition (SVD),
+    or QCP if selected with set_superposition_engine
+
+    Parameters
+    ----------
+    coords_1
+        numpy array of coordinate data for the first protein; shape = (n, 3)
+    coords_2
+        numpy array of corresponding coordinate data for the second protein; shape = (n, 3)
+
+    Returns
+    -------
+    rotation matrix, translation matrix for optimal superposition
+    """
+    if SUPERPOSITION_ENGINE == "qcp":
+        rotation_matrix, translation_matrix, _ = qcp_superpose(coords_1, coords_2)
+        return rotation_matrix, translation_matrix
+    return _svd_superpose(coords_1, coords_2)
+
+
 @nb.njit
 def paired_svd_superpose_with_subset(
     coords_1, coords_2, common_coords_1, common_coords_2
@@ -343,65 +705,111 @@ def paired_svd_superpose_with_subset(
     return coords_1, coords_2, common_coords_2_rot
 
 
-def _signal_superpose_index(
-    index,
+@nb.njit(nogil=True)
+def _make_signals(coords, size=30, overlap=1):
+    """
+    Signals of each overlapping "size"-residue stretch of coords, for both anchors in one pass
+    A signal is a vector of euclidean distances of the first (or last) coordinate of the stretch to all others in it
+
+    Returns
+    -------
+    signals of first coordinates, signals of last coordinates; shape = (num_stretches, size)
+    first coordinates, last coordinates; shape = (num_stretches, 3)
+    """
+    num_signals = (coords.shape[0] - size) // overlap
+    signals_first = np.zeros((num_signals, size))
+    signals_last = np.zeros((num_signals, size))
+    middles_first = np.zeros((num_signals, coords.shape[1]))
+    middles_last = np.zeros((num_signals, coords.shape[1]))
+    for x in range(num_signals):
+        i = x * overlap
+        middles_first[x] = coords[i]
+        middles_last[x] = coords[i + size - 1]
+        for c in range(size):
+            distance_first = distance_last = 0.0
+            for d in range(coords.shape[1]):
+                distance_first += (coords[i + c, d] - middles_first[x, d]) ** 2
+                distance_last += (coords[i + c, d] - middles_last[x, d]) ** 2
+            signals_first[x, c] = np.sqrt(distance_first)
+            signals_last[x, c] = np.sqrt(distance_last)
+    return signals_first, signals_last, middles_first, middles_last
+
+
+@nb.njit(nogil=True)
+def _signal_superpose_signals(
     coords_1,
     coords_2,
+    signals_1,
+    signals_2,
+    middles_1,
+    middles_2,
     gap_open_penalty=0.0,
     gap_extend_penalty=0.0,
-    size=30,
-    overlap=1,
 ):
     """
-    Makes initial superposition using DTW alignment of overlapping signals
-    A signal is a vector of euclidean distances of first (or last) coordinate to all others in a 30-residue stretch
-    """
-
-    def _make_signal_index(coords, idx):
-        centroid = coords[idx]
-        distances = np.zeros(coords.shape[0])
-        for c in range(coords.shape[0]):
-            distances[c] = np.sqrt(np.sum((coords[c] - centroid) ** 2, axis=-1))
-        return distances
-
-    signals_1 = np.zeros(((coords_1.shape[0] - size) // overlap, size))
-    signals_2 = np.zeros(((coords_2.shape[0] - size) // overlap, size))
-    middles_1 = np.zeros((signals_1.shape[0], coords_1.shape[1]))
-    middles_2 = np.zeros((signals_2.shape[0], coords_2.shape[1]))
-    if index == -1:
-        index = size - 1
-    for x, i in enumerate(range(0, signals_1.shape[0] * overlap, overlap)):
-        signals_1[x] = _make_signal_index(coords_1[i : i + size], index)
-        middles_1[x] = coords_1[i + index]
-    for x, i in enumerate(range(0, signals_2.shape[0] * overlap, overlap)):
-        signals_2[x] = _make_signal_index(coords_2[i : i + size], index)
-        middles_2[x] = coords_2[i + index]
-    score_matrix = score_functions.make_score_matrix(
-        signals_1,
-        signals_2,
-        score_functions.get_signal_score,
-        gamma=0.1,
-        normalized=False,
+    Superposes coords_1 and coords_2 on the anchor coordinates (middles) of DTW-aligned signals (see _make_signals)
+    """
+    score_matrix = score_functions.make_signal_score_matrix(
+        signals_1, signals_2, gamma=0.1
     )
     dtw_1, dtw_2, score = dtw.dtw_align(
         score_matrix, gap_open_penalty, gap_extend_penalty
     )
     pos_1, pos_2 = helper.get_common_positions(dtw_1, dtw_2)
-    aln_coords_1 = np.zeros((len(pos_1), coords_1.shape[1]))
-    aln_coords_2 = np.zeros((len(pos_2), coords_2.shape[1]))
-    for i, (p1, p2) in enumerate(zip(pos_1, pos_2)):
-        aln_coords_1[i] = middles_1[p1]
-        aln_coords_2[i] = middles_2[p2]
     coords_1, coords_2, _ = paired_svd_superpose_with_subset(
-        coords_1, coords_2, aln_coords_1, aln_coords_2
+        coords_1, coords_2, middles_1[pos_1], middles_2[pos_2]
     )
     return score, coords_1, coords_2
 
 
+@nb.njit(nogil=True)
+def _signal_superpose_index(
+    index,
+    coords_1,
+    coords_2,
+    gap_open_penalty=0.0,
+    gap_extend_penalty=0.0,
+    size=30,
+    overlap=1,
+):
+    """
+    Makes initial superposition using DTW alignment of overlapping signals
+    A signal is a vector of euclidean distances of first (index = 0) or last (index = -1) coordinate
+    to all others in a 30-residue stretch
+    """
+    signals_first_1, signals_last_1, middles_first_1, middles_last_1 = _make_signals(
+        coords_1, size, overlap
+    )
+    signals_first_2, signals_last_2, middles_first_2, middles_last_2 = _make_signals(
+        coords_2, size, overlap
+    )
+    if index == 0:
+        return _signal_superpose_signals(
+            coords_1,
+            coords_2,
+            signals_first_1,
+            signals_first_2,
+            middles_first_1,
+            middles_first_2,
+            gap_open_penalty,
+            gap_extend_penalty,
+        )
+    return _signal_superpose_signals(
+        coords_1,
+        coords_2,
+        signals_last_1,
+        signals_last_2,
+        middles_last_1,
+        middles_last_2,
+        gap_open_penalty,
+        gap_extend_penalty,
+    )
+
+
 @nb.njit
 def svd_superimpose(coords_1: np.ndarray, coords_2: np.ndarray):
     """
-    Superimpose paired coordinates on each other using svd
+    Superimpose paired coordinates on each other using svd (or QCP, see set_superposition_engine)
 
     Parameters
     ----------
@@ -414,20 +822,10 @@ def svd_superimpose(coords_1: np.ndarray, coords_2: np.ndarray):
     -------
     rotation matrix, translation matrix for optimal superposition
     """
-    centroid_1, centroid_2 = (
-        helper.nb_mean_axis_0(coords_1),
-        helper.nb_mean_axis_0(coords_2),
-    )
-    coords_1_c, coords_2_c = coords_1 - centroid_1, coords_2 - centroid_2
-    correlation_matrix = np.dot(coords_2_c.T, coords_1_c)
-    u, s, v = np.linalg.svd(correlation_matrix)
-    reflect = np.linalg.det(u) * np.linalg.det(v) < 0
-    if reflect:
-        s[-1] = -s[-1]
-        u[:, -1] = -u[:, -1]
-    rotation_matrix = np.dot(u, v)
-    translation_matrix = centroid_1 - np.dot(centroid_2, rotation_matrix)
-    return rotation_matrix.astype(np.float64), translation_matrix.astype(np.float64)
+    if SUPERPOSITION_ENGINE == "qcp":
+        rotation_matrix, translation_matrix, _ = qcp_superpose(coords_1, coords_2)
+        return rotation_matrix, translation_matrix
+    return _svd_superpose(coords_1, coords_2)
 
 
 @nb.njit
@@ -0,0 +1,356 @@
+import numba as nb
+import numpy as np
+import pytest
+
+from caretta import dynamic_time_warping as dtw, score_functions
+
+GAP_PENALTIES = [(0.0, 0.0), (1.0, 0.01), (0.5, 0.5)]
+KINDS = ["random", "ties", "float32"]
+COORDINATE_KINDS = ["random", "ties"]
+GAMMA = 0.03
+
+
+@nb.njit
+def reference_make_dtw_matrix(
+    score_matrix: np.ndarray,
+    gap_open_penalty: float = 0.0,
+    gap_extend_penalty: float = 0.0,
+):
+    """
+    _make_dtw_matrix as it was before it used _dtw_cell (np.array / np.argmax per cell)
+    """
+    gap_open_penalty *= -1
+    gap_extend_penalty *= -1
+    n, m = score_matrix.shape
+    matrix = np.zeros((n + 1, m + 1, 3), dtype=score_matrix.dtype)
+    matrix[:, 0, :] = dtw.MIN_FLOAT64
+    matrix[0, :, :] = dtw.MIN_FLOAT64
+    matrix[0, 0] = 0
+    backtrack = np.zeros((n + 1, m + 1, 3), dtype=np.int8)
+    for i in range(1, n + 1):
+        matrix[i, 0, 0] = 0
+        matrix[i, 0, 1] = 0
+        matrix[i, 0, 2] = dtw.MIN_FLOAT64 - gap_open_penalty
+        backtrack[i, 0] = 0
+
+    for j in range(1, m + 1):
+        matrix[0, j, 0] = dtw.MIN_FLOAT64 - gap_open_penalty
+        matrix[0, j, 1] = 0
+        matrix[0, j, 2] = 0
+        backtrack[0, j] = 1
+
+    for i in range(1, n + 1):
+        for j in range(1, m + 1):
+            scores_lower = np.array(
+                [
+                    matrix[i - 1, j, 0] + gap_extend_penalty,
+                    matrix[i - 1, j, 1] + gap_open_penalty,
+                ]
+            )
+            index_lower = np.argmax(scores_lower)
+            matrix[i, j, 0] = scores_lower[index_lower]
+            backtrack[i, j, 0] = index_lower
+
+            scores_upper = np.array(
+                [
+                    matrix[i, j - 1, 1] + gap_open_penalty,
+                    matrix[i, j - 1, 2] + gap_extend_penalty,
+                ]
+            )
+            index_upper = np.argmax(scores_upper)
+            matrix[i, j, 2] = scores_upper[index_upper]
+            backtrack[i, j, 2] = index_upper + 1
+
+            scores = np.array(
+                [
+                    matrix[i, j, 0],
+                    matrix[i - 1, j - 1, 1] + score_matrix[i - 1, j - 1],
+                    matrix[i, j, 2],
+                ]
+            )
+            index = np.argmax(scores)
+            matrix[i, j, 1] = scores[index]
+            backtrack[i, j, 1] = index
+    return matrix, backtrack
+
+
+def reference_dtw_align(score_matrix, gap_open_penalty, gap_extend_penalty):
+    """
+    dtw_align on reference_make_dtw_matrix
+    """
+    matrix, backtrack = reference_make_dtw_matrix(
+        score_matrix, gap_open_penalty, gap_extend_penalty
+    )
+    n, m = score_matrix.shape
+    scores = np.array([matrix[n, m, 0], matrix[n, m, 1], matrix[n, m, 2]])
+    index = np.argmax(scores)
+    aln_1, aln_2 = dtw._get_dtw_alignment(index, backtrack, n, m)
+    return aln_1, aln_2, scores[index]
+
+
+def make_score_matrices(kind, num=20, seed=0):
+    """
+    Random score matrices of random shapes
+    "ties" => small integer scores, so that many cells have equal candidates
+    """
+    rng = np.random.default_rng(seed)
+    matrices = []
+    for _ in range(num):
+        n, m = rng.integers(1, 50, 2)
+        if kind == "ties":
+            matrices.append(rng.integers(0, 3, (n, m)).astype(np.float64))
+        elif kind == "float32":
+            matrices.append(rng.random((n, m)).astype(np.float32))
+        else:
+            matrices.append(rng.random((n, m)))
+    return matrices
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_make_dtw_matrix_matches_reference(kind, gap_open_penalty, gap_extend_penalty):
+    for score_matrix in make_score_matrices(kind):
+        matrix, backtrack = dtw._make_dtw_matrix(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+        reference_matrix, reference_backtrack = reference_make_dtw_matrix(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+        assert matrix.dtype == reference_matrix.dtype
+        assert backtrack.dtype == reference_backtrack.dtype
+        np.testing.assert_array_equal(matrix, reference_matrix)
+        np.testing.assert_array_equal(backtrack, reference_backtrack)
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_dtw_align_matches_reference(kind, gap_open_penalty, gap_extend_penalty):
+    for score_matrix in make_score_matrices(kind):
+        aln_1, aln_2, score = dtw.dtw_align(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+        reference_aln_1, reference_aln_2, reference_score = reference_dtw_align(
+            score_matrix, gap_open_penalty, gap_extend_penalty
+        )
+        np.testing.assert_array_equal(aln_1, reference_aln_1)
+        np.testing.assert_array_equal(aln_2, reference_aln_2)
+        assert score == reference_score
+
+
+def make_coordinate_pairs(kind, num=20, seed=0):
+    """
+    Pairs of random coordinate sets of random lengths
+    "ties" => coordinates on a small integer grid, so that many pairs have equal scores
+    """
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(num):
+        n, m = rng.integers(1, 50, 2)
+        if kind == "ties":
+            pairs.append(
+                (
+                    rng.integers(0, 3, (n, 3)).astype(np.float64),
+                    rng.integers(0, 3, (m, 3)).astype(np.float64),
+                )
+            )
+        else:
+            coords_1 = np.cumsum(rng.normal(size=(n, 3)), axis=0)
+            pairs.append((coords_1, coords_1[:m] + rng.normal(size=(min(n, m), 3))))
+    return pairs
+
+
+def dtw_align_on_score_matrix(coords_1, coords_2, gap_open_penalty, gap_extend_penalty):
+    """
+    dtw_align on the stored caretta score matrix, the path the fused kernels replace
+    """
+    return dtw.dtw_align(
+        score_functions.make_score_matrix(
+            coords_1, coords_2, score_functions.get_caretta_score, GAMMA
+        ),
+        gap_open_penalty,
+        gap_extend_penalty,
+    )
+
+
+def assert_same_alignment(result, expected):
+    np.testing.assert_array_equal(result[0], expected[0])
+    np.testing.assert_array_equal(result[1], expected[1])
+    assert result[2] == expected[2]
+
+
+@pytest.mark.parametrize("kind", COORDINATE_KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_dtw_align_coordinates_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty
+):
+    for coords_1, coords_2 in make_coordinate_pairs(kind):
+        assert_same_alignment(
+            dtw.dtw_align_coordinates(
+                coords_1, coords_2, GAMMA, gap_open_penalty, gap_extend_penalty
+            ),
+            dtw_align_on_score_matrix(
+                coords_1, coords_2, gap_open_penalty, gap_extend_penalty
+            ),
+        )
+
+
+@pytest.mark.parametrize("kind", COORDINATE_KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+@pytest.mark.parametrize("block_size", [0, 1, 7])
+def test_dtw_align_low_memory_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty, block_size
+):
+    for coords_1, coords_2 in make_coordinate_pairs(kind):
+        expected = dtw_align_on_score_matrix(
+            coords_1, coords_2, gap_open_penalty, gap_extend_penalty
+        )
+        score_matrix = score_functions.make_score_matrix(
+            coords_1, coords_2, score_functions.get_caretta_score, GAMMA
+        )
+        assert_same_alignment(
+            dtw.dtw_align_low_memory(
+                score_matrix, gap_open_penalty, gap_extend_penalty, block_size
+            ),
+            expected,
+        )
+        assert_same_alignment(
+            dtw.dtw_align_low_memory_coordinates(
+                coords_1,
+                coords_2,
+                GAMMA,
+                gap_open_penalty,
+                gap_extend_penalty,
+                block_size,
+            ),
+            expected,
+        )
+
+
+@pytest.mark.parametrize("kind", COORDINATE_KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_dtw_score_coordinates_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty
+):
+    for coords_1, coords_2 in make_coordinate_pairs(kind):
+        _, _, expected = dtw_align_on_score_matrix(
+            coords_1, coords_2, gap_open_penalty, gap_extend_penalty
+        )
+        assert (
+            dtw.dtw_score_coordinates(
+                coords_1, coords_2, GAMMA, gap_open_penalty, gap_extend_penalty
+            )
+            == expected
+        )
+
+
+@pytest.mark.parametrize("kind", ["random", "ties"])
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+@pytest.mark.parametrize("tile_size", [1, 7, 256])
+def test_dtw_align_wavefront_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty, tile_size
+):
+    for score_matrix in make_score_matrices(kind):
+        assert_same_alignment(
+            dtw.dtw_align_wavefront(
+                score_matrix, gap_open_penalty, gap_extend_penalty, tile_size
+            ),
+            dtw.dtw_align(score_matrix, gap_open_penalty, gap_extend_penalty),
+        )
+
+
+@pytest.mark.parametrize("kind", COORDINATE_KINDS)
+@pytest.mark.parametrize("block_size", [1, 7, 64])
+def test_make_caretta_score_matrix_parallel_matches_score_rows(kind, block_size):
+    for coords_1, coords_2 in make_coordinate_pairs(kind):
+        row_scores = np.zeros(coords_2.shape[0])
+        expected = np.array(
+            [
+                score_functions.make_caretta_score_row(
+                    coords_1, coords_2, i, GAMMA, row_scores
+                ).copy()
+                for i in range(coords_1.shape[0])
+            ]
+        )
+        np.testing.assert_array_equal(
+            score_functions.make_caretta_score_matrix_parallel(
+                coords_1, coords_2, GAMMA, block_size
+            ),
+            expected,
+        )
+
+
+@pytest.mark.parametrize("kind", COORDINATE_KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_dtw_align_parallel_coordinates_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty
+):
+    for coords_1, coords_2 in make_coordinate_pairs(kind):
+        assert_same_alignment(
+            dtw.dtw_align_parallel_coordinates(
+                coords_1, coords_2, GAMMA, gap_open_penalty, gap_extend_penalty
+            ),
+            dtw_align_on_score_matrix(
+                coords_1, coords_2, gap_open_penalty, gap_extend_penalty
+            ),
+        )
+
+
+@pytest.mark.parametrize("kind", KINDS)
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+def test_dtw_align_banded_full_band_matches_dtw_align(
+    kind, gap_open_penalty, gap_extend_penalty
+):
+    for score_matrix in make_score_matrices(kind):
+        n, m = score_matrix.shape
+        expected = dtw.dtw_align(score_matrix, gap_open_penalty, gap_extend_penalty)
+        shuffled = np.random.default_rng(n * m).permutation(score_matrix.ravel())
+        seeds = [
+            dtw.get_diagonal_band(n, m),
+            # the path of another matrix of the same shape
+            dtw.get_path_band(
+                *dtw.dtw_align(shuffled.reshape(n, m), gap_open_penalty, gap_extend_penalty)[:2],
+                n,
+            ),
+        ]
+        for lower, upper in seeds:
+            assert_same_alignment(
+                dtw.dtw_align_banded(
+                    score_matrix,
+                    gap_open_penalty,
+                    gap_extend_penalty,
+                    lower,
+                    upper,
+                    max(n, m),
+                ),
+                expected,
+            )
+
+
+@pytest.mark.parametrize("gap_open_penalty, gap_extend_penalty", GAP_PENALTIES)
+@pytest.mark.parametrize("power", [0.33, 0.5, 2.0, 3.0])
+def test_dtw_align_banded_widens_narrow_band(gap_open_penalty, gap_extend_penalty, power):
+    n, m = 60, 70
+    # scores fall off with the distance to a curved path j = (m - 1) (i / (n - 1))^power,
+    # which leaves the diagonal by up to ~25 columns
+    rows, columns = np.arange(n)[:, None], np.arange(m)[None, :]
+    score_matrix = np.exp(
+        -(((columns - (m - 1) * (rows / (n - 1)) ** power) / 10.0) ** 2)
+    )
+    lower, upper = dtw.get_diagonal_band(n, m)
+    lo, hi, offsets = dtw.make_band(lower, upper, 1, m)
+    aln_1, aln_2, _ = dtw.dtw_align_band(
+        dtw._get_score_matrix_band(score_matrix, score_matrix, 0.0, lo, hi, offsets),
+        lo,
+        hi,
+        offsets,
+        gap_open_penalty,
+        gap_extend_penalty,
+    )
+    # the first band is too narrow
+    assert dtw.touches_band_edge(aln_1, aln_2, lo, hi, m)
+    assert_same_alignment(
+        dtw.dtw_align_banded(
+            score_matrix, gap_open_penalty, gap_extend_penalty, lower, upper, 1
+        ),
+        dtw.dtw_align(score_matrix, gap_open_penalty, gap_extend_penalty),
+    )
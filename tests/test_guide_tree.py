@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from caretta import guide_tree as gt
+
+
+def make_embeddings(num=40, seed=0):
+    """
+    Random non-negative embeddings of random sizes, some with duplicate rows
+    """
+    rng = np.random.default_rng(seed)
+    embeddings = []
+    for index in range(num):
+        n = rng.integers(3, 60)
+        embedding = rng.random((n, rng.integers(1, 8)))
+        if index % 2:
+            embedding = embedding[rng.integers(0, max(1, n // 3), n)]
+        embeddings.append(embedding)
+    return embeddings
+
+
+def make_clustered_embedding(num_clusters=4, cluster_size=15, seed=0):
+    """
+    Tight clusters far apart, so that a small k leaves the nearest neighbour graph disconnected
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.random((num_clusters, 5)) * 1000
+    return np.concatenate(
+        [center + rng.random((cluster_size, 5)) for center in centers]
+    )
+
+
+def assert_valid_tree(tree, branch_lengths, length):
+    assert tree.shape == (2 * length - 3, 2)
+    assert branch_lengths.shape == (2 * length - 3, 1)
+    assert np.all(branch_lengths >= 0)
+    children = np.concatenate((tree[:-1, 0], tree[-1]))
+    # every leaf and intermediate node is a child exactly once
+    np.testing.assert_array_equal(np.sort(children), np.arange(2 * length - 2))
+    parents = tree[:-1:2, 1]
+    np.testing.assert_array_equal(tree[1:-1:2, 1], parents)
+    np.testing.assert_array_equal(np.sort(parents), np.arange(length, 2 * length - 2))
+    # intermediate nodes are made after their children
+    assert np.all(tree[:-1, 0] < tree[:-1, 1])
+
+
+@pytest.mark.parametrize("metric", gt.METRICS)
+@pytest.mark.parametrize("linkage", gt.LINKAGES)
+@pytest.mark.parametrize("k", [1, 3, 10])
+@pytest.mark.parametrize("exact_limit", [4096, 0])
+def test_knn_linkage_makes_valid_tree(metric, linkage, k, exact_limit):
+    for embedding in make_embeddings():
+        tree, branch_lengths = gt.knn_linkage(embedding, k, metric, linkage, exact_limit)
+        assert_valid_tree(tree, branch_lengths, embedding.shape[0])
+
+
+@pytest.mark.parametrize("linkage", gt.LINKAGES)
+@pytest.mark.parametrize("exact_limit", [4096, 0])
+def test_knn_linkage_links_disconnected_graph(linkage, exact_limit):
+    embedding = make_clustered_embedding()
+    tree, branch_lengths = gt.knn_linkage(embedding, 1, "euclidean", linkage, exact_limit)
+    assert_valid_tree(tree, branch_lengths, embedding.shape[0])
+    # each cluster is merged on its own before the clusters are linked
+    tree, branch_lengths = gt.knn_linkage(embedding, 3, "euclidean", linkage, exact_limit)
+    assert_valid_tree(tree, branch_lengths, embedding.shape[0])
+    members = [{i} for i in range(embedding.shape[0])]
+    for x in range(0, tree.shape[0] - 1, 2):
+        members.append(members[tree[x, 0]] | members[tree[x + 1, 0]])
+    for cluster in range(4):
+        assert set(range(cluster * 15, (cluster + 1) * 15)) in members
+
+
+def test_knn_linkage_duplicate_embeddings():
+    embedding = np.repeat(np.random.default_rng(0).random((4, 3)), 5, axis=0)
+    for linkage in gt.LINKAGES:
+        for k in [1, 3, 10]:
+            tree, branch_lengths = gt.knn_linkage(embedding, k, "braycurtis", linkage)
+            assert_valid_tree(tree, branch_lengths, embedding.shape[0])
+
+
+@pytest.mark.parametrize("metric", gt.METRICS)
+def test_nearest_neighbours_descent_matches_exact(metric):
+    embedding = make_clustered_embedding(num_clusters=5, cluster_size=12, seed=1)
+    neighbours, distances = gt.get_nearest_neighbours(embedding, 5, metric, exact_limit=10)
+    exact_neighbours, exact_distances = gt.get_nearest_neighbours(embedding, 5, metric)
+    np.testing.assert_array_equal(neighbours, exact_neighbours)
+    np.testing.assert_array_equal(distances, exact_distances)
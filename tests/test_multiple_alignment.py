@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from geometricus import Structure
+
+from caretta import multiple_alignment
+
+
+@pytest.mark.parametrize("min_score", [0.0, 1e-6, 0.5])
+def test_check_min_score_accepts_valid_range(min_score):
+    multiple_alignment.check_min_score(min_score)
+
+
+@pytest.mark.parametrize("min_score", [-0.1, 1.0, 2.0, float("nan")])
+def test_check_min_score_rejects_invalid_range(min_score):
+    with pytest.raises(ValueError, match="min_score"):
+        multiple_alignment.check_min_score(min_score)
+    with pytest.raises(ValueError, match="min_score"):
+        multiple_alignment.StructureMultiple(
+            [],
+            {},
+            {**multiple_alignment.DEFAULT_SUPERPOSITION_PARAMETERS, "min_score": min_score},
+        )
+
+
+def test_refinement_statistics_counts_iterations():
+    msa = multiple_alignment.StructureMultiple(
+        [], {}, dict(multiple_alignment.DEFAULT_SUPERPOSITION_PARAMETERS)
+    )
+    assert msa.get_refinement_statistics() == {}
+    msa._add_refinement_iterations([1, 3, 3, 0], 3)
+    msa._add_refinement_iterations([5], 5)
+    msa._add_refinement_iterations([1], 3)
+    assert msa.refinement_iterations.tolist() == [1, 2, 0, 2, 0, 1]
+    assert msa.get_refinement_statistics() == {0: 1, 1: 2, 3: 2, 5: 1}
+
+
+def make_structure_multiple(**parameters):
+    rng = np.random.default_rng(0)
+    return multiple_alignment.StructureMultiple(
+        [Structure(f"s{i}", 10, rng.normal(size=(10, 3))) for i in range(2)],
+        {},
+        {**multiple_alignment.DEFAULT_SUPERPOSITION_PARAMETERS, **parameters},
+    )
+
+
+def test_make_pairwise_dtw_matrix_clears_pairwise_alignments():
+    msa = make_structure_multiple()
+    msa.pairwise_alignments = {"stale": None}
+    msa.make_pairwise_dtw_matrix(
+        0.0, 0.0, score_only=True, pairs=np.zeros((0, 2), dtype=np.int64)
+    )
+    assert msa.pairwise_alignments is None
+    msa.make_pairwise_dtw_matrix(
+        0.0, 0.0, keep_alignments=True, pairs=np.zeros((0, 2), dtype=np.int64)
+    )
+    assert msa.pairwise_alignments == {}
+
+
+@pytest.mark.parametrize(
+    "name, value", [("gamma", 0.1), ("gap_open_penalty", 1.0), ("gap_extend_penalty", 0.1)]
+)
+def test_pairwise_alignment_key_has_superposition_settings(name, value):
+    key = make_structure_multiple()._get_pairwise_alignment_key(0, 1, 1.0, 0.01, 3)
+    assert key == make_structure_multiple()._get_pairwise_alignment_key(
+        0, 1, 1.0, 0.01, 3
+    )
+    assert key != make_structure_multiple(
+        **{name: value}
+    )._get_pairwise_alignment_key(0, 1, 1.0, 0.01, 3)
+    msa = make_structure_multiple()
+    msa.superposition_function = multiple_alignment.superposition_functions.moment_superpose_function
+    assert key != msa._get_pairwise_alignment_key(0, 1, 1.0, 0.01, 3)
+
+
+@pytest.mark.parametrize(
+    "full, sparse_full, score_only, knn, distance_file",
+    [
+        (False, 0, False, 0, None),
+        (False, 0, False, 0, "distances.dat"),
+        (True, 0, True, 0, None),
+        (False, 10, True, 0, None),
+        (False, 0, False, 10, None),
+    ],
+)
+def test_check_distance_options_accepts_valid_combinations(
+    full, sparse_full, score_only, knn, distance_file
+):
+    multiple_alignment.check_distance_options(
+        full, sparse_full, score_only, knn, distance_file
+    )
+
+
+@pytest.mark.parametrize(
+    "full, sparse_full, score_only, knn, distance_file, match",
+    [
+        (True, 0, False, 0, "distances.dat", "distance_file"),
+        (False, 10, False, 0, "distances.dat", "distance_file"),
+        (False, 0, False, 10, "distances.dat", "distance_file"),
+        (False, 0, True, 0, None, "score_only"),
+        (False, 0, True, 10, None, "score_only"),
+    ],
+)
+def test_check_distance_options_rejects_ignored_options(
+    full, sparse_full, score_only, knn, distance_file, match
+):
+    with pytest.raises(ValueError, match=match):
+        multiple_alignment.check_distance_options(
+            full, sparse_full, score_only, knn, distance_file
+        )
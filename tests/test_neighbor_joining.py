@@ -0,0 +1,136 @@
+import numba as nb
+import numpy as np
+import pytest
+
+from caretta import neighbor_joining as nj
+
+
+@nb.njit
+def reference_find_join_nodes(distance_matrix):
+    """
+    _find_join_nodes as it was before row sums were cached (O(n^2) row sums per join)
+    """
+    n = distance_matrix.shape[0]
+    min_ij = np.array([0, 0], dtype=np.uint64)
+    min_q = np.inf
+    for i in range(n):
+        for j in range(n):
+            if i != j:
+                q = (
+                    (n - 2) * distance_matrix[i, j]
+                    - np.sum(distance_matrix[i, :])
+                    - np.sum(distance_matrix[j, :])
+                )
+                if q < min_q:
+                    min_ij[0], min_ij[1] = i, j
+                    min_q = q
+    return min_ij
+
+
+@nb.njit
+def reference_find_branch_length(distance_matrix, i, j):
+    n = distance_matrix.shape[0]
+    delta_i_u = 0.5 * distance_matrix[i, j] + (0.5 / (n - 2)) * (
+        np.sum(distance_matrix[i, :]) - np.sum(distance_matrix[j, :])
+    )
+    delta_j_u = distance_matrix[i, j] - delta_i_u
+    return np.array([delta_i_u, delta_j_u])
+
+
+@nb.njit
+def reference_neighbor_joining(distance_matrix):
+    """
+    neighbor_joining as it was before the distance matrix was reduced in place
+    """
+    length = n = distance_matrix.shape[0]
+    tree = np.zeros((length ** 2, 2), dtype=np.uint64)
+    branch_lengths = np.zeros((length ** 2, 1), dtype=np.float64)
+    index = 0
+    true_indices = np.array(list(range(length)))
+    num_intermediate_nodes = 0
+    while n > 3:
+        min_ij = reference_find_join_nodes(distance_matrix)
+        delta_ij_u = reference_find_branch_length(distance_matrix, min_ij[0], min_ij[1])
+        intermediate_node = num_intermediate_nodes + length
+        num_intermediate_nodes += 1
+        tree[index] = np.array((true_indices[min_ij[0]], intermediate_node))
+        branch_lengths[index] = delta_ij_u[0]
+        index += 1
+        tree[index] = np.array((true_indices[min_ij[1]], intermediate_node))
+        branch_lengths[index] = delta_ij_u[1]
+        index += 1
+        indices = np.array([i for i in range(n) if i != min_ij[0] and i != min_ij[1]])
+        new_distance_matrix = np.zeros((n - 1, n - 1))
+        new_distance_matrix[1:, 1:] = distance_matrix[indices, :][:, indices]
+        for i in range(len(indices)):
+            new_distance_matrix[0, i + 1] = new_distance_matrix[i + 1, 0] = 0.5 * (
+                distance_matrix[min_ij[0], indices[i]]
+                + distance_matrix[min_ij[1], indices[i]]
+                - distance_matrix[min_ij[0], min_ij[1]]
+            )
+        distance_matrix = new_distance_matrix
+        n = distance_matrix.shape[0]
+        true_indices = np.array(
+            [intermediate_node] + [true_indices[i] for i in indices]
+        )
+    delta_ij_u = reference_find_branch_length(distance_matrix, 1, 2)
+    intermediate_node = num_intermediate_nodes + length
+    tree[index] = np.array((true_indices[1], intermediate_node))
+    branch_lengths[index] = delta_ij_u[0]
+    index += 1
+    tree[index] = np.array((true_indices[2], intermediate_node))
+    branch_lengths[index] = delta_ij_u[1]
+    index += 1
+    tree[index] = np.array((true_indices[0], intermediate_node))
+    branch_lengths[index] = 0.5 * (
+        distance_matrix[1, 0] + distance_matrix[2, 0] - distance_matrix[1, 2]
+    )
+    index += 1
+    return tree[:index], branch_lengths[:index]
+
+
+def make_distance_matrices(num=20, seed=0, max_size=100):
+    """
+    Random symmetric distance matrices of random sizes, without ties in Q
+    """
+    rng = np.random.default_rng(seed)
+    matrices = []
+    for _ in range(num):
+        n = rng.integers(4, max_size)
+        points = rng.normal(size=(n, 5))
+        matrix = np.sqrt(((points[:, None] - points[None]) ** 2).sum(-1))
+        matrices.append(matrix)
+    return matrices
+
+
+@pytest.mark.parametrize("prune", [False, True])
+def test_neighbor_joining_matches_reference(prune):
+    for distance_matrix in make_distance_matrices():
+        tree, branch_lengths = nj.neighbor_joining(distance_matrix, prune)
+        reference_tree, reference_branch_lengths = reference_neighbor_joining(
+            distance_matrix
+        )
+        np.testing.assert_array_equal(tree, reference_tree)
+        np.testing.assert_array_equal(branch_lengths, reference_branch_lengths)
+
+
+@pytest.mark.parametrize("prune", [False, True])
+def test_neighbor_joining_memmap_overwrite_matches_reference(tmp_path, prune):
+    for index, distance_matrix in enumerate(make_distance_matrices(num=5, seed=1)):
+        distance_matrix = distance_matrix.astype(np.float32)
+        memmap = np.memmap(
+            tmp_path / f"distances_{index}.dat",
+            dtype=np.float32,
+            mode="w+",
+            shape=distance_matrix.shape,
+        )
+        memmap[:] = distance_matrix
+        tree, branch_lengths = nj.neighbor_joining(memmap, prune, True)
+        reference_tree, reference_branch_lengths = reference_neighbor_joining(
+            distance_matrix.astype(np.float64)
+        )
+        np.testing.assert_array_equal(tree, reference_tree)
+        # the reduced distances are stored in float32
+        np.testing.assert_allclose(
+            branch_lengths, reference_branch_lengths, rtol=1e-4, atol=1e-5
+        )
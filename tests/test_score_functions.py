@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from caretta import dynamic_time_warping as dtw, score_functions
+
+GAMMA = 0.03
+
+
+def make_chain(n, seed):
+    """
+    Random walk with ~3.8A steps, about the extent of a protein chain
+    """
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(size=(n, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=1, keepdims=True)
+    return np.cumsum(steps, axis=0)
+
+
+def densify(sparse_scores, n, m):
+    indptr, indices, scores = sparse_scores
+    matrix = np.zeros((n, m), dtype=scores.dtype)
+    for i in range(n):
+        matrix[i, indices[indptr[i] : indptr[i + 1]]] = scores[indptr[i] : indptr[i + 1]]
+    return matrix
+
+
+@pytest.mark.parametrize("min_score", [0.999, 0.9999, 1 - 1e-12])
+def test_make_sparse_score_matrix_min_score_close_to_1(min_score):
+    coords_1, coords_2 = make_chain(300, 0), make_chain(300, 1)
+    coords_2[::10] = coords_1[::10]
+    sparse_scores = score_functions.make_sparse_score_matrix(
+        coords_1, coords_2, GAMMA, min_score
+    )
+    dense = score_functions.make_caretta_score_matrix(coords_1, coords_2, GAMMA)
+    # only (near) identical coordinates are close enough
+    np.testing.assert_array_equal(
+        densify(sparse_scores, 300, 300) > 0, dense >= min_score
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_make_sparse_score_matrix_tiny_min_score_matches_dense(seed):
+    coords_1, coords_2 = make_chain(120, seed), make_chain(90, seed + 100)
+    sparse_scores = score_functions.make_sparse_score_matrix(
+        coords_1, coords_2, GAMMA, 1e-300
+    )
+    np.testing.assert_allclose(
+        densify(sparse_scores, 120, 90),
+        score_functions.make_caretta_score_matrix(coords_1, coords_2, GAMMA),
+        rtol=1e-12,
+    )
+    aln_1, aln_2, score = dtw.dtw_align_rows(
+        sparse_scores,
+        sparse_scores,
+        score_functions.make_sparse_score_row,
+        GAMMA,
+        120,
+        90,
+        1.0,
+        0.01,
+    )
+    expected = dtw.dtw_align_coordinates(coords_1, coords_2, GAMMA, 1.0, 0.01)
+    np.testing.assert_array_equal(aln_1, expected[0])
+    np.testing.assert_array_equal(aln_2, expected[1])
+    assert score == expected[2]
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from caretta import superposition_functions as sf
+
+KINDS = ["random", "planar", "collinear", "reflected"]
+
+
+def make_rotation(rng):
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    return q * np.sign(np.linalg.det(q))
+
+
+def make_point_set_pairs(kind, num=50, seed=0):
+    """
+    (coords_1, coords_2) pairs, coords_2 a rotated, shifted and perturbed copy of coords_1
+    "planar" / "collinear" => coords_1 in a plane / on a line
+    "reflected" => coords_2 is mirrored, so that the best rotation is not a reflection of coords_1
+    """
+    rng = np.random.default_rng(seed)
+    pairs = []
+    for _ in range(num):
+        n = rng.integers(3, 100)
+        coords_1 = rng.normal(size=(n, 3)) * 10
+        if kind == "planar":
+            coords_1[:, 2] = 0
+        elif kind == "collinear":
+            coords_1 = np.outer(rng.normal(size=n) * 10, rng.normal(size=3))
+        coords_1 = coords_1 @ make_rotation(rng) + rng.normal(size=3) * 20
+        coords_2 = coords_1 @ make_rotation(rng) + rng.normal(size=3) * 20
+        if kind == "reflected":
+            coords_2[:, 0] *= -1
+        if kind != "collinear":
+            coords_2 += rng.normal(size=(n, 3))
+        pairs.append((coords_1, coords_2))
+    return pairs
+
+
+def get_rmsd(coords_1, coords_2, rotation_matrix, translation_matrix):
+    return np.sqrt(
+        np.sum((coords_2 @ rotation_matrix + translation_matrix - coords_1) ** 2)
+        / coords_1.shape[0]
+    )
+
+
+@pytest.mark.parametrize("kind", KINDS)
+def test_qcp_superpose_matches_svd_superpose(kind):
+    for coords_1, coords_2 in make_point_set_pairs(kind):
+        rotation_matrix, translation_matrix, rmsd = sf.qcp_superpose(coords_1, coords_2)
+        svd_rotation_matrix, svd_translation_matrix = sf._svd_superpose(
+            coords_1, coords_2
+        )
+        np.testing.assert_allclose(
+            rotation_matrix @ rotation_matrix.T, np.eye(3), atol=1e-10
+        )
+        assert np.linalg.det(rotation_matrix) == pytest.approx(1.0)
+        svd_rmsd = get_rmsd(coords_1, coords_2, svd_rotation_matrix, svd_translation_matrix)
+        assert get_rmsd(
+            coords_1, coords_2, rotation_matrix, translation_matrix
+        ) == pytest.approx(svd_rmsd, abs=1e-10)
+        # the reported RMSD is that of the returned superposition
+        assert rmsd == pytest.approx(svd_rmsd, abs=1e-10)
+        # the rotation of collinear coordinates around their line is arbitrary, the superposed coordinates aren't
+        np.testing.assert_allclose(
+            coords_2 @ rotation_matrix + translation_matrix,
+            coords_2 @ svd_rotation_matrix + svd_translation_matrix,
+            atol=1e-9,
+        )
+
+
+def test_set_superposition_engine_after_compilation():
+    coords = np.random.default_rng(0).normal(size=(10, 3))
+    sf.paired_svd_superpose(coords, coords)
+    with pytest.raises(RuntimeError):
+        sf.set_superposition_engine("qcp")
+    # setting the engine already in use is fine
+    sf.set_superposition_engine("svd")
+    with pytest.raises(ValueError):
+        sf.set_superposition_engine("quaternion")
+    assert sf.SUPERPOSITION_ENGINE == "svd"